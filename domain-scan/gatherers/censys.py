@@ -1,10 +1,14 @@
+import io
 import os
 import csv
 import re
+import gzip
+import json
 import time
 import datetime
-import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from scanners import utils
 from censys import certificates, export
 import censys
@@ -17,23 +21,33 @@ import censys
 # --censys_key: Censys API key.
 #
 # To use the paginated search (which all accounts can do):
-# --delay: How long to wait between requests. Defaults to 5s.
-#          If you have researcher credentials, use 2s.
+# --delay: Average time between requests, across all workers.
+#          Defaults to 5s. If you have researcher credentials, use 2s.
+# --burst: How many requests can be made at once before --delay
+#          kicks in. Defaults to 1.
+# --workers: How many pages to fetch at once. Defaults to 5.
 # --start: What page of results to start on. Defaults to 1.
 # --end:   What page of results to end on. Defaults to last page.
 # --force: Ignore cached pages.
 #
+# Each page is cached as it's fetched, so an interrupted run picks up
+# where it left off: cached pages are used (without waiting on the
+# rate limit) and only the rest are fetched. Pages that failed are
+# tried again.
+#
 # To use the SQL export (which "researcher" accounts can do):
 # --export: Turn on export mode.
 # --timeout: Override timeout for waiting on job completion (in seconds).
+# --workers: How many result files to download at once. Defaults to 5.
 # --force: Ignore cached export data.
 #
 # Export mode is much more thorough and quick. It will execute a SQL
 # query against Censys' export API. This will create a "job" in Censys'
 # queue, which the script will then repeatedly check against until
 # the job is done (or 20 minutes as a timeout). When the job is done,
-# the resulting CSV file will be downloaded to disk and cached, and
-# then read from for hostnames.
+# the resulting CSV files (there can be several, and they may be
+# gzipped) are all downloaded at once. Each is read for hostnames as
+# it downloads, and cached to disk along the way.
 #
 # However, export mode does require Censys credentials for an account
 # that has been enabled as a "researcher". If you don't have that, but
@@ -41,15 +55,18 @@ import censys
 # know that the paginated mode might top out at 250 pages, because
 # the paginated mode talks to an Elasticsearch database which is
 # configured to a maximum of 25,000 records (100 records per page).
-#
-# TODO: Right now this only handle one download file. In theory, the
-# export API can return an array of multiple download files.
 
 # Hostnames beginning with a wildcard prefix will have the prefix stripped.
 wildcard_pattern = re.compile("^\*\.")
 redacted_pattern = re.compile("^(\?\.)+")
 
 
+# Censys is searched for one suffix at a time, unless a --query
+# replaces the search.
+def queries_by_suffix(options):
+    return not options.get("query")
+
+
 def gather(suffix, options, extra={}):
     # Register a (free) Censys.io account to get a UID and API key.
     uid = options.get("censys_id", None)
@@ -64,21 +81,27 @@ def gather(suffix, options, extra={}):
         exit(1)
 
     if options.get("export", False):
-        hostnames_map = export_mode(suffix, options, uid, api_key)
+        hostnames = export_mode(suffix, options, uid, api_key)
     else:
-        hostnames_map = paginated_mode(suffix, options, uid, api_key)
+        hostnames = paginated_mode(suffix, options, uid, api_key)
 
-    # Iterator doesn't buy much efficiency, since we paginated already.
-    # Necessary evil to de-dupe before returning hostnames, though.
-    for hostname in hostnames_map.keys():
+    # Paginated mode yields each hostname as its page comes in.
+    for hostname in hostnames:
         yield hostname
 
 
+# Yields each (de-duped) hostname as the page it's on is fetched.
 def paginated_mode(suffix, options, uid, api_key):
-    # Cache hostnames in a dict for de-duping.
-    hostnames_map = {}
+    # Track hostnames in a set for de-duping.
+    seen = set()
+
+    # Each worker thread gets its own API client (and HTTP session).
+    clients = threading.local()
 
-    certificate_api = certificates.CensysCertificates(uid, api_key)
+    def certificate_api():
+        if not hasattr(clients, "api"):
+            clients.api = certificates.CensysCertificates(uid, api_key)
+        return clients.api
 
     if 'query' in options and options['query']:
         query = options['query']
@@ -86,8 +109,11 @@ def paginated_mode(suffix, options, uid, api_key):
         query = "parsed.subject.common_name:\"%s\" or parsed.extensions.subject_alt_name.dns_names:\"%s\"" % (suffix, suffix)
     logging.debug("Censys query:\n%s\n" % query)
 
-    # time to sleep between requests (defaults to 5s)
-    delay = int(options.get("delay", 5))
+    # Average time between requests (defaults to 5s), shared by all
+    # workers, and how many pages to fetch at once.
+    delay = float(options.get("delay", 5))
+    limiter = utils.TokenBucket(1.0 / delay, burst=int(options.get("burst", 1)))
+    workers = int(options.get("workers", 5))
 
     # Censys page size, fixed
     page_size = 100
@@ -98,7 +124,8 @@ def paginated_mode(suffix, options, uid, api_key):
     # End page defaults to whatever the API says is the last one.
     end_page = options.get("end", None)
     if end_page is None:
-        end_page = get_end_page(query, certificate_api)
+        limiter.acquire()
+        end_page = get_end_page(query, certificate_api())
         if end_page is None:
             logging.warn("Error looking up number of pages.")
             exit(1)
@@ -112,62 +139,75 @@ def paginated_mode(suffix, options, uid, api_key):
         "parsed.extensions.subject_alt_name.dns_names"
     ]
 
-    current_page = start_page
-
     logging.warn("Fetching up to %i records, starting at page %i." % (max_records, start_page))
-    last_cached = False
     force = options.get("force", False)
 
-    while current_page <= end_page:
-        if (not last_cached) and (current_page > start_page):
-            logging.debug("(Waiting %is before fetching page %i.)" % (delay, current_page))
-            last_cached = False
-            time.sleep(delay)
+    # A page's certs, from the cache or the API, or None if the API
+    # gave an error (which is cached, but retried on the next run).
+    def fetch(page):
+        if force is False:
+            certs = utils.cache_load(str(page), "censys")
+            if (certs is not None) and not ((certs.__class__ is dict) and certs.get('invalid')):
+                logging.warn("\t[%i] Cached page." % page)
+                return certs
+
+        limiter.acquire()
+        logging.debug("Fetching page %i." % page)
+
+        try:
+            certs = list(certificate_api().search(query, fields=fields, page=page, max_records=page_size))
+        except censys.base.CensysException:
+            logging.warn(utils.format_last_exception())
+            logging.warn("Censys error, skipping page %i." % page)
+            utils.cache_invalid(str(page), "censys")
+            return None
+
+        utils.cache_save(certs, str(page), "censys")
+        return certs
 
-        logging.debug("Fetching page %i." % current_page)
+    pages = range(start_page, end_page + 1)
+    done = 0
 
-        cache_page = utils.cache_path(str(current_page), "censys")
-        if (force is False) and (os.path.exists(cache_page)):
-            logging.warn("\t[%i] Cached page." % current_page)
-            last_cached = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, page): page for page in pages}
 
-            certs_raw = open(cache_page).read()
-            certs = json.loads(certs_raw)
-            if (certs.__class__ is dict) and certs.get('invalid'):
-                continue
-        else:
+        for future in as_completed(futures):
+            page = futures[future]
             try:
-                certs = list(certificate_api.search(query, fields=fields, page=current_page, max_records=page_size))
-                utils.write(utils.json_for(certs), cache_page)
-            except censys.base.CensysException:
-                logging.warn(utils.format_last_exception())
-                logging.warn("Censys error, skipping page %i." % current_page)
-                utils.write(utils.invalid({}), cache_page)
-                continue
+                certs = future.result()
             except:
                 logging.warn(utils.format_last_exception())
-                logging.warn("Unexpected error, skipping page %i." % current_page)
-                utils.write(utils.invalid({}), cache_page)
+                logging.warn("Unexpected error, stopping at page %i." % page)
+                utils.cache_invalid(str(page), "censys")
+                for pending in futures:
+                    pending.cancel()
                 exit(1)
 
-        for cert in certs:
-            # Common name + SANs
-            names = cert.get('parsed.subject.common_name', []) + cert.get('parsed.extensions.subject_alt_name.dns_names', [])
-            logging.debug(names)
-
-            for name in names:
-                hostnames_map[sanitize_name(name)] = None
+            done += 1
+            logging.debug("[%i/%i] pages fetched." % (done, len(pages)))
 
-        current_page += 1
+            for name in names_from(certs or []):
+                if name not in seen:
+                    seen.add(name)
+                    yield name
 
     logging.debug("Done fetching from API.")
 
-    return hostnames_map
+
+# Sanitized names (common name + SANs) from a page of certs.
+def names_from(certs):
+    for cert in certs:
+        names = cert.get('parsed.subject.common_name', []) + cert.get('parsed.extensions.subject_alt_name.dns_names', [])
+        logging.debug(names)
+
+        for name in names:
+            yield sanitize_name(name)
 
 
+# Yields each (de-duped) hostname as the export's files are read.
 def export_mode(suffix, options, uid, api_key):
-    # Cache hostnames in a dict for de-duping.
-    hostnames_map = {}
+    # Track hostnames in a set for de-duping.
+    seen = set()
 
     # Default timeout to 20 minutes.
     timeout = int(options.get("timeout", (60 * 60 * 20)))
@@ -186,15 +226,22 @@ def export_mode(suffix, options, uid, api_key):
     query = "SELECT parsed.subject.common_name, parsed.extensions.subject_alt_name.dns_names from FLATTEN([certificates.certificates], parsed.extensions.subject_alt_name.dns_names) where parsed.subject.common_name LIKE \"%%%s\" OR parsed.extensions.subject_alt_name.dns_names LIKE \"%%%s\";" % (suffix, suffix)
     logging.debug("Censys query:\n%s\n" % query)
 
-    download_file = utils.cache_path("export", "censys", ext="csv")
-
     force = options.get("force", False)
 
-    if (force is False) and os.path.exists(download_file):
+    # Each result file is cached as it's downloaded, and the list of
+    # them once they've all finished.
+    cached_files = export_cache()
+
+    # Export files downloaded this time, by index, and whether each
+    # was gzipped.
+    downloaded = {}
+
+    if (force is False) and (cached_files is not None):
         logging.warn("Using cached download data.")
+        sources = [(read_cached, path) for path in cached_files]
     else:
         logging.warn("Kicking off SQL query job.")
-        results_url = None
+        results_urls = None
 
         try:
             job = export_api.new_job(query, format='csv', flatten=True)
@@ -220,7 +267,7 @@ def export_mode(suffix, options, uid, api_key):
 
                 elif status['status'] == 'success':
                     logging.warn("[%is] Job complete!" % elapsed)
-                    results_url = status['download_paths'][0]
+                    results_urls = status['download_paths']
                     break
 
                 if (elapsed > timeout):
@@ -230,27 +277,140 @@ def export_mode(suffix, options, uid, api_key):
         except censys.base.CensysException:
             logging.warn(utils.format_last_exception())
             logging.warn("Censys error, aborting.")
+            exit(1)
 
         # At this point, the job is complete and we need to download
-        # the resulting CSV URL in results_url.
-        logging.warn("Downloading results of SQL query.")
-        utils.download(results_url, download_file)
+        # the resulting CSVs in results_urls.
+        logging.warn("Downloading %i result file(s) of SQL query." % len(results_urls))
+        sources = [(download, (url, index, downloaded)) for index, url in enumerate(results_urls)]
+
+    # Each file is read by its own thread, which hands over batches of
+    # names as it goes, so hostnames are yielded while the files are
+    # still downloading.
+    workers = min(len(sources), int(options.get("workers", 5)))
+    producers = [batches_from(reader, source) for reader, source in sources]
+
+    try:
+        for batch in utils.parallel_batches(producers, workers):
+            for name in batch:
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+    except Exception as error:
+        logging.warn("Error reading export results: %s" % error)
+        exit(1)
+
+    # Only now that every file is complete is the download cached.
+    if downloaded:
+        paths = [export_path(index, downloaded[index]) for index in sorted(downloaded)]
+        manifest = [os.path.basename(path) for path in paths]
+        utils.write(json.dumps(manifest), utils.cache_path("export", "censys", ext="json"))
+
+
+# A function reading batches of names from an export file.
+def batches_from(reader, source):
+    def batches():
+        batch = []
+        for row in csv.reader(reader(source)):
+            batch.extend(names_from_row(row))
+            if len(batch) >= 1000:
+                yield batch
+                batch = []
+        yield batch
+    return batches
+
+
+# Sanitized names from a row of export results (common name, SAN).
+def names_from_row(row):
+    if (not row) or (not row[0]) or (row[0].lower().startswith("parsed_subject_common_name")):
+        return []
+
+    names = [name.lower() for name in row[:2]]
+    return [sanitize_name(name) for name in names if name]
+
+
+# Where a downloaded export file is cached.
+def export_path(index, gzipped):
+    return utils.cache_path("export-%i" % index, "censys", ext=("csv.gz" if gzipped else "csv"))
+
+
+# Paths to a complete cached export, or None. An export cached before
+# exports could have several files is a single export.csv.
+def export_cache():
+    manifest = utils.cache_path("export", "censys", ext="json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            names = json.load(f)
+        return [os.path.join(os.path.dirname(manifest), name) for name in names]
+
+    single = utils.cache_path("export", "censys", ext="csv")
+    if os.path.exists(single):
+        return [single]
+
+    return None
+
+
+# Text of a cached export file, as it's read.
+def read_cached(path):
+    return text_stream(open(path, 'rb'))
+
+
+# Text of an export file, as it downloads. The raw bytes are cached
+# along the way, and only put in place once the download finishes.
+def download(source):
+    url, index, downloaded = source
+
+    response = utils.http_session().get(url, stream=True, timeout=60)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    partial = utils.cache_path("export-%i" % index, "censys", ext="partial")
+    utils.mkdir_p(os.path.dirname(partial))
+
+    try:
+        with open(partial, 'wb') as cache_file:
+            raw = io.BufferedReader(TeeReader(response.raw, cache_file))
+            gzipped = is_gzipped(raw)
+            for line in text_stream(raw):
+                yield line
+    finally:
+        response.close()
+
+    os.replace(partial, export_path(index, gzipped))
+    downloaded[index] = gzipped
+
+
+# Decoded text lines from a buffered binary stream, gunzipping if
+# need be.
+def text_stream(raw):
+    try:
+        stream = gzip.GzipFile(fileobj=raw) if is_gzipped(raw) else raw
+        for line in io.TextIOWrapper(stream, encoding='utf-8', newline=''):
+            yield line
+    finally:
+        raw.close()
+
+
+def is_gzipped(raw):
+    return raw.peek(2)[:2] == b'\x1f\x8b'
+
 
-    # Read in downloaded CSV file, run any hostnames in each line
-    # through the sanitizer, and de-dupe using the map.
-    with open(download_file, newline='') as csvfile:
-        for row in csv.reader(csvfile):
-            if (not row[0]) or (row[0].lower().startswith("parsed_subject_common_name")):
-                continue
+# A raw stream that copies everything read from `source` to `sink`.
+class TeeReader(io.RawIOBase):
 
-            names = [row[0].lower(), row[1].lower()]
-            # logging.debug(names)
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
 
-            for name in names:
-                if name:
-                    hostnames_map[sanitize_name(name)] = None
+    def readable(self):
+        return True
 
-    return hostnames_map
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        if data:
+            self.sink.write(data)
+        buffer[:len(data)] = data
+        return len(data)
 
 
 # Given a hostname from Censys, remove * and ? marks.
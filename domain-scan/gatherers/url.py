@@ -1,6 +1,5 @@
 from scanners import utils
 import os
-import requests
 import logging
 
 # url
@@ -27,7 +26,7 @@ def gather(suffix, options, extra={}):
         remote_path = os.path.join(utils.cache_dir(), "url.csv")
 
         try:
-            response = requests.get(url)
+            response = utils.http_session().get(url)
             utils.write(response.text, remote_path)
         except:
             logging.error("Remote URL not downloaded successfully.")
@@ -6,6 +6,7 @@ from scanners import utils
 
 
 workers = 1
+depends = ["pshtt"]
 pa11y = os.environ.get("PA11Y_PATH", "pa11y")
 headers = [
     "redirectedTo",
@@ -17,13 +18,10 @@ headers = [
 ]
 
 
+# Redirect info comes from the shared pshtt index. A domain without
+# valid pshtt data is just scanned as-is.
 def get_from_pshtt_cache(domain):
-    pshtt_cache = utils.cache_path(domain, "pshtt")
-    pshtt_raw = open(pshtt_cache).read()
-    pshtt_data = json.loads(pshtt_raw)
-    if type(pshtt_data) == list:
-        pshtt_data = pshtt_data[0]
-    return pshtt_data
+    return utils.pshtt_record(domain) or {}
 
 
 def get_domain_to_scan(pshtt_data, domain):
@@ -37,27 +35,12 @@ def get_domain_to_scan(pshtt_data, domain):
     return domain_to_scan
 
 
-def get_a11y_cache(domain):
-    return utils.cache_path(domain, "a11y")
-
-
-def domain_is_cached(cache):
-    return os.path.exists(cache)
-
-
-def cache_is_not_forced(options):
-    return options.get("force", False) is False
-
-
-def cache_errors(errors, domain, cache):
-    cachable = json.dumps({'results': errors})
+def cache_errors(errors, domain):
     logging.debug("Writing to cache: %s" % domain)
-    content = cachable
-    destination = cache
-    utils.write(content, destination)
+    utils.cache_save({'results': errors}, domain, "a11y")
 
 
-def run_a11y_scan(domain, cache):
+def run_a11y_scan(domain):
     logging.debug("[%s][a11y]" % domain)
     pa11y = os.environ.get("PA11Y_PATH", "pa11y")
     command = [pa11y, domain, "--reporter", "json", "--config", "config/pa11y_config.json", "--level", "none", "--timeout", "300000"]
@@ -74,31 +57,24 @@ def run_a11y_scan(domain, cache):
             'type': ''
         }]
 
-    cache_errors(results, domain, cache)
+    cache_errors(results, domain)
 
     return results
 
 
 def get_errors_from_scan_or_cache(domain, options):
-    a11y_cache = get_a11y_cache(domain)
-    the_domain_is_cached = domain_is_cached(a11y_cache)
-    the_cache_is_not_forced = cache_is_not_forced(options)
-    logging.debug("the_domain_is_cached: %s" % the_domain_is_cached)
-    logging.debug("the_cache_is_not_forced: %s" % the_cache_is_not_forced)
-
-    # the_domain_is_cached: True
-    # the_cache_is_not_forced: False
+    # None if it's not cached, expired, or the cache is forced.
+    data = utils.cache_fresh(domain, "a11y", options)
+
     results = []
-    if the_domain_is_cached and the_cache_is_not_forced:
+    if data is not None:
         logging.debug("\tCached.")
-        raw = open(a11y_cache).read()
-        data = json.loads(raw)
         if not data.get('invalid'):
             logging.debug("Getting from cache: %s" % domain)
             results = data.get('results')
     else:
         logging.debug("\tNot cached.")
-        results = run_a11y_scan(domain, a11y_cache)
+        results = run_a11y_scan(domain)
     return results
 
 
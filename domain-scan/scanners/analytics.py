@@ -2,7 +2,6 @@
 from scanners import utils
 import logging
 import os
-import requests
 
 ###
 # == analytics ==
@@ -29,7 +28,7 @@ def init(options):
         analytics_path = os.path.join(utils.cache_dir(), "analytics.csv")
 
         try:
-            response = requests.get(analytics_file)
+            response = utils.http_session().get(analytics_file)
             utils.write(response.text, analytics_path)
         except:
             no_csv = "--analytics URL not downloaded successfully."
@@ -58,8 +57,7 @@ def scan(domain, options):
         'participating': (domain in analytics_domains)
     }
 
-    cache = utils.cache_path(domain, "analytics")
-    utils.write(utils.json_for(data), cache)
+    utils.cache_save(data, domain, "analytics")
 
     yield [data['participating']]
 
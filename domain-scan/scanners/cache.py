@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+###
+# Cache backends.
+#
+# Scanners cache what they find for each domain, keyed by the
+# "operation" (usually the scanner's name) and the domain. By default
+# that's one file per entry, at cache/<operation>/<domain>.json.
+#
+# For very large runs, --cache=sqlite keeps every entry in a single
+# SQLite file instead (cache/cache.sqlite3), which avoids leaving
+# millions of small files on disk and is much faster to check and
+# read from on warm-cache reruns.
+#
+# Each entry also has the time it was written (as a Unix timestamp),
+# so that entries can expire. See --max-age, below.
+#
+# Scanners don't talk to these directly: they go through
+# utils.cache_load and utils.cache_save (or utils.cache_read and
+# utils.cache_write, for already-encoded content).
+###
+
+
+# One JSON file per domain per operation. An entry's timestamp is
+# its file's modification time.
+class FileCache(object):
+    name = "files"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, domain, operation, ext="json"):
+        return os.path.join(self.cache_dir, operation, ("%s.%s" % (domain, ext)))
+
+    def exists(self, domain, operation):
+        return os.path.exists(self.path(domain, operation))
+
+    # Entries are read as bytes, since they may not be text.
+    def read(self, domain, operation):
+        path = self.path(domain, operation)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    # When an entry was written, or None if there isn't one.
+    def updated(self, domain, operation):
+        try:
+            return os.path.getmtime(self.path(domain, operation))
+        except OSError:
+            return None
+
+    # `updated` backdates an entry (e.g. when copying between caches).
+    def write(self, content, domain, operation, updated=None):
+        path = self.path(domain, operation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(content)
+        if updated is not None:
+            os.utime(path, (updated, updated))
+
+    # All domains with an entry for an operation.
+    def domains(self, operation):
+        directory = os.path.join(self.cache_dir, operation)
+        if not os.path.isdir(directory):
+            return
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".json"):
+                yield entry.name[:-len(".json")]
+
+    # All operations with at least one entry.
+    def operations(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return sorted(
+            entry.name for entry in os.scandir(self.cache_dir)
+            if entry.is_dir()
+        )
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Every entry in one SQLite file.
+#
+# Writes are committed in batches: every `batch_size` writes, or
+# `batch_interval` seconds after the first uncommitted one, whichever
+# comes first (and on flush/close). A timer does the committing when
+# writes stop coming, since an open write transaction holds SQLite's
+# write lock, and other processes sharing the file (like --shard
+# scans) can't write until it's committed.
+# Reads on the same connection see uncommitted writes, so a scanner
+# that writes an entry can read it straight back.
+class SqliteCache(object):
+    name = "sqlite"
+
+    def __init__(self, filename, batch_size=500, batch_interval=5):
+        self.filename = filename
+        self.batch_size = int(batch_size)
+        self.batch_interval = float(batch_interval)
+
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.last_commit = time.time()
+        self.timer = None
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+
+        # One connection, shared by all scanning threads behind a lock.
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "operation TEXT NOT NULL, "
+            "domain TEXT NOT NULL, "
+            "content TEXT, "
+            "updated REAL, "
+            "PRIMARY KEY (operation, domain))"
+        )
+
+        # Caches created before entries had timestamps get the column
+        # added, and their existing entries have no known age.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(cache)")]
+        if "updated" not in columns:
+            self.connection.execute("ALTER TABLE cache ADD COLUMN updated REAL")
+
+        self.connection.commit()
+
+    def exists(self, domain, operation):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM cache WHERE operation = ? AND domain = ?",
+                (operation, domain)
+            ).fetchone()
+        return row is not None
+
+    def read(self, domain, operation):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content FROM cache WHERE operation = ? AND domain = ?",
+                (operation, domain)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def updated(self, domain, operation):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT updated FROM cache WHERE operation = ? AND domain = ?",
+                (operation, domain)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def write(self, content, domain, operation, updated=None):
+        with self.lock:
+            self._insert(content, domain, operation, updated)
+            if (self.pending >= self.batch_size) or ((time.time() - self.last_commit) >= self.batch_interval):
+                self._commit()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_interval, self._commit_pending)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # Write many (content, domain, operation[, updated]) entries in
+    # one transaction.
+    def write_many(self, entries):
+        with self.lock:
+            for entry in entries:
+                self._insert(*entry)
+            self._commit()
+
+    def domains(self, operation):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain FROM cache WHERE operation = ? ORDER BY domain",
+                (operation,)
+            ).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def operations(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT operation FROM cache ORDER BY operation"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self._commit()
+                self.connection.close()
+                self.connection = None
+
+    def _insert(self, content, domain, operation, updated=None):
+        if updated is None:
+            updated = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (operation, domain, content, updated) VALUES (?, ?, ?, ?)",
+            (operation, domain, content, updated)
+        )
+        self.pending += 1
+
+    def _commit_pending(self):
+        with self.lock:
+            if self.connection is not None:
+                self._commit()
+
+    def _commit(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending > 0:
+            logging.debug("Committing %i cache entries." % self.pending)
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+        self.timer = None
+
+
+backends = {
+    FileCache.name: FileCache,
+    SqliteCache.name: SqliteCache,
+}
+
+
+# Build the backend named by --cache, rooted in the given cache dir.
+def backend_for(name, cache_dir, options=None):
+    options = options or {}
+
+    if name == SqliteCache.name:
+        filename = options.get("cache-file") or os.path.join(cache_dir, "cache.sqlite3")
+        # Shards share the file with each other, so they commit each
+        # write rather than hold the write lock for a whole batch.
+        return SqliteCache(
+            filename,
+            batch_size=options.get("cache-batch", 1 if options.get("shard") else 500),
+            batch_interval=options.get("cache-batch-interval", 5)
+        )
+    elif name == FileCache.name:
+        return FileCache(cache_dir)
+    else:
+        raise ValueError("Unknown cache backend: %s (choose from: %s)" % (name, str.join(", ", sorted(backends))))
+
+
+###
+# Cache expiry.
+#
+# By default, cached entries never expire (short of --force, which
+# ignores the cache entirely). --max-age sets how old an entry can
+# get before it's rescanned, either for every operation or per
+# operation, e.g. --max-age=30d,pshtt:7d expires pshtt entries after
+# a week and everything else after 30 days.
+#
+# Ages are a number followed by a unit: s, m, h, d or w.
+###
+
+age_units = {
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+}
+
+
+# Seconds in an age, e.g. "7d".
+def seconds_for(age):
+    age = age.strip().lower()
+    if (len(age) < 2) or (age[-1] not in age_units):
+        raise ValueError("Invalid cache age: %s (use e.g. 12h, 7d, 2w)" % age)
+
+    try:
+        number = float(age[:-1])
+    except ValueError:
+        raise ValueError("Invalid cache age: %s (use e.g. 12h, 7d, 2w)" % age)
+
+    return number * age_units[age[-1]]
+
+
+# Parse --max-age into a default max age and per-operation max ages,
+# all in seconds. A max age of None means entries never expire.
+def max_ages_for(spec):
+    default = None
+    by_operation = {}
+
+    for piece in (spec or "").split(","):
+        piece = piece.strip()
+        if not piece:
+            continue
+
+        if ":" in piece:
+            operation, age = piece.split(":", 1)
+            by_operation[operation] = seconds_for(age)
+        else:
+            default = seconds_for(piece)
+
+    return default, by_operation
+
+
+# Whether an entry written at `updated` is older than `max_age`.
+# Entries with no known timestamp count as expired.
+def expired(updated, max_age, now=None):
+    if max_age is None:
+        return False
+    if updated is None:
+        return True
+    if now is None:
+        now = time.time()
+    return (now - updated) > max_age
+
+
+###
+# Cache codecs.
+#
+# How cached data is encoded is chosen per operation, with
+# --cache-codec. e.g. --cache-codec=compact,sslyze:zstd uses compact
+# JSON by default, and zstd-compressed JSON for sslyze.
+#
+# * json: prettified JSON (the default, and the historical format)
+# * compact: JSON without indentation or extra whitespace
+# * msgpack: MessagePack (requires the `msgpack` package)
+# * zstd: zstd-compressed compact JSON (requires `zstandard`)
+#
+# Reading doesn't depend on the setting: the encoding of each entry
+# is detected from its first bytes, so caches written with any
+# codec (including older plain JSON caches) can always be read.
+###
+
+codecs = ["json", "compact", "msgpack", "zstd"]
+
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+
+# Parse --cache-codec into a default codec and per-operation codecs.
+def codecs_for(spec):
+    default = "json"
+    by_operation = {}
+
+    for piece in (spec or "").split(","):
+        piece = piece.strip()
+        if not piece:
+            continue
+
+        if ":" in piece:
+            operation, codec = piece.split(":", 1)
+        else:
+            operation, codec = None, piece
+
+        if codec not in codecs:
+            raise ValueError("Unknown cache codec: %s (choose from: %s)" % (codec, str.join(", ", codecs)))
+
+        if operation:
+            by_operation[operation] = codec
+        else:
+            default = codec
+
+    return default, by_operation
+
+
+def encode(data, codec="json", default=None):
+    if codec == "json":
+        return json.dumps(data, sort_keys=True, indent=2, default=default)
+    elif codec == "compact":
+        return json.dumps(data, separators=(',', ':'), default=default)
+    elif codec == "msgpack":
+        return msgpack_module().packb(data, use_bin_type=True, default=default)
+    elif codec == "zstd":
+        compact = encode(data, "compact", default).encode('utf-8')
+        return zstd_module().ZstdCompressor().compress(compact)
+    else:
+        raise ValueError("Unknown cache codec: %s" % codec)
+
+
+# Decode cached content, whichever codec it was written with.
+def decode(raw):
+    if isinstance(raw, str):
+        return json.loads(raw)
+
+    raw = bytes(raw)
+
+    if raw.startswith(zstd_magic):
+        return decode(zstd_module().ZstdDecompressor().decompress(raw))
+
+    # JSON is always ASCII-led (or whitespace-led). MessagePack maps
+    # and arrays always start with a byte of 0x80 or higher.
+    if raw and (raw[0] >= 0x80):
+        return msgpack_module().unpackb(raw, raw=False)
+
+    return json.loads(raw.decode('utf-8'))
+
+
+# Optional dependencies, only needed for the codecs that use them.
+def msgpack_module():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError("The msgpack cache codec requires the `msgpack` package.")
+    return msgpack
+
+
+def zstd_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstd cache codec requires the `zstandard` package.")
+    return zstandard
+
+
+codec_modules = {"msgpack": msgpack_module, "zstd": zstd_module}
+
+
+# Parse --cache-codec (see codecs_for), and check that the packages
+# its codecs need are installed, so that a bad setting is caught
+# before anything's scanned. Raises ValueError or ImportError.
+def check_codecs(spec):
+    default, by_operation = codecs_for(spec)
+    for codec in set([default] + list(by_operation.values())):
+        if codec in codec_modules:
+            codec_modules[codec]()
+    return default, by_operation
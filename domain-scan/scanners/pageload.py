@@ -19,6 +19,9 @@ init = None
 # to make the default number of workers small.
 workers = 2
 
+# Starts from pshtt's canonical endpoint, so wait for it per-domain.
+depends = ["pshtt"]
+
 
 def scan(domain, options):
     logging.debug("[%s][pageload]" % domain)
@@ -47,13 +50,11 @@ def scan(domain, options):
         url = domain
 
     # We'll cache prettified JSON from the output.
-    cache = utils.cache_path(domain, "pageload")
+    data = utils.cache_fresh(domain, "pageload", options)
 
     # If we've got it cached, use that.
-    if (options.get("force", False) is False) and (os.path.exists(cache)):
+    if data is not None:
         logging.debug("\tCached.")
-        raw = open(cache).read()
-        data = json.loads(raw)
         if data.get('invalid'):
             return None
 
@@ -62,12 +63,12 @@ def scan(domain, options):
         logging.debug("\t %s %s --reporter=json --ignore-ssl-errors" % (command, url))
         raw = utils.scan([command, url, "--reporter=json", "--ignore-ssl-errors"])
         if not raw:
-            utils.write(utils.invalid({}), cache)
+            utils.cache_invalid(domain, "pageload")
             return None
 
-        # It had better be JSON, which we can cache in prettified form.
+        # It had better be JSON, which we can cache.
         data = json.loads(raw)
-        utils.write(utils.json_for(data), cache)
+        utils.cache_save(data, domain, "pageload")
 
     yield [data['metrics'][metric] for metric in interesting_metrics]
 
@@ -2,12 +2,17 @@ import logging
 from scanners import utils
 import os
 import json
+import asyncio
 
 ###
 # == pshtt ==
 #
 # Inspect a site's TLS configuration using DHS NCATS' pshtt tool.
 #
+# With --engine=library, pshtt is run in-process through its Python
+# API rather than its command line. That saves starting up a Python
+# interpreter (and reloading the preload list) for every run, and
+# serializing its results to JSON and back.
 ###
 
 command = os.environ.get("PSHTT_PATH", "pshtt")
@@ -18,6 +23,14 @@ timeout = 30
 # default to a custom user agent, can be overridden
 user_agent = os.environ.get("PSHTT_USER_AGENT", "github.com/18f/domain-scan, pshtt.py")
 
+# pshtt takes any number of domains at once, and starting it up is a
+# good part of the cost of scanning one, so `scan` hands it domains
+# in batches of this many (see scan_batch).
+batch_size = 20
+
+# Can run in-process, with --engine=library.
+engines = ["cli", "library"]
+
 # save (and look for) preload file in cache/preload-list.json
 # same format as inspect.py uses
 preload_cache = utils.cache_single("preload-list.json")
@@ -26,7 +39,20 @@ preload_cache = utils.cache_single("preload-list.json")
 # The preload list cache is only important across individual
 # executions of pshtt. Not intended to be cached across
 # individual executions of domain-scan itself.
+#
+# Shards of one scan share it, so a --shard leaves it alone rather
+# than deleting it out from under the others.
 def init(options):
+    if options.get("engine") == "library":
+        try:
+            pshtt_module()
+        except ImportError as error:
+            logging.error(str(error))
+            return False
+
+    if options.get("shard"):
+        return True
+
     if os.path.exists(preload_cache):
         logging.warn("Clearing cached preload-list.json file before scanning.")
         os.remove(preload_cache)
@@ -36,38 +62,139 @@ def init(options):
 def scan(domain, options):
     logging.debug("[%s][pshtt]" % domain)
 
-    # cache output from pshtt
-    cache_pshtt = utils.cache_path(domain, "pshtt", ext="json")
+    data = cached(domain, options)
+    if data is None:
+        data = save(domain, run([domain], options))
+
+    for row in rows_for(data):
+        yield row
+
+
+# Scan several domains with one run of pshtt. Yields each domain and
+# its rows, and caches each domain's results separately, just like
+# scan() does.
+def scan_batch(domains, options):
+    data = {}
+    for domain in domains:
+        logging.debug("[%s][pshtt]" % domain)
+        data[domain] = cached(domain, options)
+
+    to_scan = [domain for domain in domains if data[domain] is None]
+    if to_scan:
+        results = results_by_domain(run(to_scan, options))
+
+        for domain in to_scan:
+            # If the whole batch failed, give each domain its own try.
+            if (results is None) and (len(to_scan) > 1):
+                result = run([domain], options)
+            else:
+                result = results and results.get(domain.lower())
+            data[domain] = save(domain, result)
+
+    for domain in domains:
+        yield domain, list(rows_for(data[domain]))
+
+
+# Used by `scan --async`: the same scan, without holding a thread
+# while pshtt runs.
+async def async_scan(domain, options):
+    logging.debug("[%s][pshtt]" % domain)
+
+    data = cached(domain, options)
+    if data is None:
+        if options.get("engine") == "library":
+            loop = asyncio.get_event_loop()
+            data = save(domain, await loop.run_in_executor(None, library_results, [domain]))
+        else:
+            logging.debug("\t %s %s" % (command, domain))
+            data = save(domain, parse(await utils.scan_async(command_for(domain))))
+
+    return list(rows_for(data))
 
-    force = options.get("force", False)
-    data = None
 
-    if (force is False) and (os.path.exists(cache_pshtt)):
+# Cached pshtt data for a domain, or None if it needs to be scanned.
+def cached(domain, options):
+    data = utils.cache_fresh(domain, "pshtt", options)
+    if data is not None:
         logging.debug("\tCached.")
-        raw = open(cache_pshtt).read()
-        data = json.loads(raw)
-        if (data.__class__ is dict) and data.get('invalid'):
-            return None
-
-    else:
-        logging.debug("\t %s %s" % (command, domain))
-
-        raw = utils.scan([
-            command,
-            domain,
-            '--json',
-            '--user-agent', '\"%s\"' % user_agent,
-            '--timeout', str(timeout),
-            '--preload-cache', preload_cache
-        ])
-
-        if not raw:
-            utils.write(utils.invalid({}), cache_pshtt)
-            logging.warn("\tBad news scanning, sorry!")
-            return None
-
-        data = json.loads(raw)
-        utils.write(utils.json_for(data), utils.cache_path(domain, "pshtt"))
+    return data
+
+
+# Scan domains with whichever engine was asked for, and return pshtt's
+# results (a list of them, one per domain), or None.
+def run(domains, options):
+    if options.get("engine") == "library":
+        return library_results(domains)
+
+    logging.debug("\t %s %s" % (command, str.join(" ", domains)))
+    return parse(utils.scan(command_for(*domains)))
+
+
+def command_for(*domains):
+    return [command] + list(domains) + [
+        '--json',
+        '--user-agent', '\"%s\"' % user_agent,
+        '--timeout', str(timeout),
+        '--preload-cache', preload_cache
+    ]
+
+
+# pshtt's JSON output (a list of results), or None.
+def parse(raw):
+    if not raw:
+        return None
+    return json.loads(raw)
+
+
+# The in-process engine: the same options the command line gets.
+def library_results(domains):
+    logging.debug("\t[library] pshtt %s" % str.join(" ", domains))
+    try:
+        return list(pshtt_module().inspect_domains(domains, {
+            'user_agent': user_agent,
+            'timeout': timeout,
+            'preload_cache': preload_cache
+        }))
+    except Exception:
+        logging.warn(utils.format_last_exception())
+        return None
+
+
+# pshtt's Python API, only needed for --engine=library.
+def pshtt_module():
+    try:
+        from pshtt import pshtt
+    except ImportError:
+        raise ImportError("--engine=library requires the `pshtt` package.")
+    return pshtt
+
+
+# Each domain's results from a run of pshtt over several domains, in
+# the same format as a run over one of them (a list of one result).
+def results_by_domain(results):
+    if results is None:
+        return None
+    return {result['Domain'].lower(): [result] for result in results if result.get('Domain')}
+
+
+# Cache a domain's parsed pshtt output, and return it.
+def save(domain, data):
+    if not data:
+        utils.cache_invalid(domain, "pshtt")
+        utils.index_pshtt(domain, None)
+        logging.warn("\tBad news scanning, sorry!")
+        return None
+
+    utils.cache_save(data, domain, "pshtt")
+
+    # Keep the shared pshtt index in step with what's cached.
+    utils.index_pshtt(domain, data)
+    return data
+
+
+def rows_for(data):
+    if (not data) or ((data.__class__ is dict) and data.get('invalid')):
+        return
 
     # pshtt scanner uses JSON arrays, even for single items
     data = data[0]
@@ -0,0 +1,125 @@
+import os
+import functools
+import threading
+
+###
+# Base ("registrable") domains, from the Public Suffix List.
+#
+# The base domain of a hostname is the public suffix it's under, plus
+# one more label. For most .gov hostnames that's the last two labels,
+# but not always: the base domain of `www.sd.k12.ca.us` is
+# `sd.k12.ca.us`, and of `www.agency.fed.us` is `agency.fed.us`.
+#
+# A copy of the list is bundled in config/public_suffix_list.dat
+# (from https://publicsuffix.org/list/). Only its ICANN section is
+# used: the private section lists things like `cloudfront.net` and
+# `github.io`, which would make each customer of those services its
+# own base domain.
+#
+# The list is loaded into a trie once, on first use, and lookups are
+# memoized, since the same base domains come up over and over.
+###
+
+default_list = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "public_suffix_list.dat")
+
+# How many hostnames' base domains to remember.
+cache_size = 100000
+
+
+# A trie of suffix rules, keyed by label from the right. A node has
+# True as a key if a rule ends there, and "!" if an exception does.
+class SuffixList(object):
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            exception = rule.startswith("!")
+            if exception:
+                rule = rule[1:]
+
+            node = self.root
+            for label in reversed(rule.split(".")):
+                node = node.setdefault(label, {})
+            node["!" if exception else True] = True
+
+    @classmethod
+    def load(cls, filename=default_list, private=False):
+        with open(filename, encoding='utf-8') as f:
+            return cls(rules_from(f, private=private))
+
+    # How many labels at the end of a hostname (given as a list of
+    # labels) are its public suffix.
+    def suffix_length(self, labels):
+        # Unlisted TLDs are public suffixes (the implicit "*" rule).
+        length = 1
+        node = self.root
+
+        for depth, label in enumerate(reversed(labels), 1):
+            child = node.get(label)
+
+            # e.g. !city.kawasaki.jp: city.kawasaki.jp is registrable,
+            # despite *.kawasaki.jp.
+            if (child is not None) and ("!" in child):
+                return depth - 1
+
+            wildcard = node.get("*")
+            if (wildcard is not None) and (True in wildcard):
+                length = depth
+
+            if child is None:
+                break
+            if True in child:
+                length = depth
+            node = child
+
+        return length
+
+    # The base domain of a hostname. A hostname that is itself a public
+    # suffix is its own base domain.
+    def base_domain_for(self, hostname):
+        labels = hostname.rstrip(".").split(".")
+        length = self.suffix_length([label.lower() for label in labels])
+        return str.join(".", labels[-(length + 1):])
+
+
+# Rules from the lines of a suffix list file.
+def rules_from(lines, private=False):
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith("// ===BEGIN PRIVATE DOMAINS==="):
+            if not private:
+                return
+            continue
+
+        if (not line) or line.startswith("//"):
+            continue
+
+        # Rules end at the first whitespace.
+        yield line.split()[0].lower()
+
+
+# The bundled list, loaded the first time it's needed.
+suffix_list = None
+suffix_list_lock = threading.Lock()
+
+
+def default_suffix_list():
+    global suffix_list
+    with suffix_list_lock:
+        if suffix_list is None:
+            suffix_list = SuffixList.load()
+        return suffix_list
+
+
+@functools.lru_cache(maxsize=cache_size)
+def base_domain_for(hostname):
+    return default_suffix_list().base_domain_for(hostname)
+
+
+# Base domains for a whole column of hostnames at once, in the same
+# order. Each distinct hostname is only looked up once.
+def base_domains_for(hostnames):
+    hostnames = list(hostnames)
+    bases = {hostname: base_domain_for(hostname) for hostname in set(hostnames)}
+    return [bases[hostname] for hostname in hostnames]
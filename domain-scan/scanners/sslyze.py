@@ -1,10 +1,17 @@
 import logging
 from scanners import utils
 import os
+import tempfile
+import types
+import asyncio
+import hashlib
+import threading
+import collections
 
 import json
 import cryptography
 import cryptography.hazmat.backends.openssl
+import cryptography.hazmat.primitives.serialization
 from cryptography.hazmat.primitives.asymmetric import ec, dsa, rsa
 
 ###
@@ -14,14 +21,154 @@ from cryptography.hazmat.primitives.asymmetric import ec, dsa, rsa
 #
 # If data exists for a domain from `pshtt`, will check results
 # and only process domains with valid HTTPS, or broken chains.
+#
+# With --engine=library, sslyze is run in-process through its Python
+# API rather than its command line, and only runs (and keeps) what
+# the results here are built from: the protocol/cipher scans and
+# certificate info. Its results are cached in the same format as the
+# command line's JSON output, so either engine can read the other's.
 ###
 
 command = os.environ.get("SSLYZE_PATH", "sslyze")
 
+# Reads pshtt's cache to pick the endpoint to scan.
+depends = ["pshtt"]
+
+# Can run in-process, with --engine=library.
+engines = ["cli", "library"]
+
+# sslyze scans any number of targets in one run (and concurrently),
+# so `scan` hands it domains in batches of this many (see scan_batch).
+batch_size = 10
+
 
 def scan(domain, options):
     logging.debug("[%s][sslyze]" % domain)
 
+    scan_domain = target_for(domain)
+    if scan_domain is None:
+        return None
+
+    data = cached(domain, options)
+    if data is None:
+        # use scan_domain (possibly www-prefixed) to do actual scan
+        results = run([scan_domain], options)
+        if results is None:
+            data = failed(domain)
+        else:
+            data = save(domain, results_for(scan_domain, results))
+
+    for row in rows_for(scan_domain, data):
+        yield row
+
+
+# Used by `scan --async`: the same scan, without holding a thread
+# while sslyze runs.
+async def async_scan(domain, options):
+    logging.debug("[%s][sslyze]" % domain)
+
+    scan_domain = target_for(domain)
+    if scan_domain is None:
+        return []
+
+    data = cached(domain, options)
+    if data is None:
+        if options.get("engine") == "library":
+            loop = asyncio.get_event_loop()
+            results = await loop.run_in_executor(None, library_results, [scan_domain])
+        else:
+            json_out = scratch_file()
+            logging.debug("\t %s %s" % (command, scan_domain))
+
+            try:
+                if (await utils.scan_async(command_for(scan_domain, json_out))) is None:
+                    results = None
+                else:
+                    results = read_json(json_out)
+            finally:
+                os.remove(json_out)
+
+        if results is None:
+            data = failed(domain)
+        else:
+            data = save(domain, results_for(scan_domain, results))
+
+    return list(rows_for(scan_domain, data))
+
+
+# Scan several domains with one run of sslyze. Yields each domain and
+# its rows, and caches each domain's results separately, in the same
+# format as a run over just that domain.
+def scan_batch(domains, options):
+    targets = {}
+    data = {}
+    for domain in domains:
+        logging.debug("[%s][sslyze]" % domain)
+        targets[domain] = target_for(domain)
+        if targets[domain] is not None:
+            data[domain] = cached(domain, options)
+
+    to_scan = [domain for domain in data if data[domain] is None]
+    if to_scan:
+        # Two domains can share a target (e.g. example.gov and www.example.gov).
+        scan_domains = sorted(set(targets[domain] for domain in to_scan))
+        results = run(scan_domains, options)
+
+        # If the whole batch failed, give each target its own try, and
+        # only cache a failure for the ones that fail on their own.
+        retried = {}
+        for domain in to_scan:
+            target = targets[domain]
+            target_results = results
+            if (results is None) and (len(scan_domains) > 1):
+                if target not in retried:
+                    retried[target] = run([target], options)
+                target_results = retried[target]
+
+            if target_results is None:
+                data[domain] = failed(domain)
+            else:
+                data[domain] = save(domain, results_for(target, target_results))
+
+    for domain in domains:
+        if targets[domain] is None:
+            yield domain, []
+        else:
+            yield domain, list(rows_for(targets[domain], data[domain]))
+
+
+def init(options):
+    global cert_index_size
+    cert_index_size = int(options.get("cert-cache-size", cert_index_size))
+
+    if options.get("engine") == "library":
+        try:
+            sslyze_module()
+        except ImportError as error:
+            logging.error(str(error))
+            return False
+    return True
+
+
+# Scan targets with whichever engine was asked for, and return the
+# results parsed, in the command line's JSON format, or None.
+def run(scan_domains, options):
+    if options.get("engine") == "library":
+        return library_results(scan_domains)
+
+    json_out = scratch_file()
+    logging.debug("\t %s %s" % (command, str.join(" ", scan_domains)))
+
+    try:
+        if utils.scan(command_for(scan_domains, json_out)) is None:
+            return None
+        return read_json(json_out)
+    finally:
+        os.remove(json_out)
+
+
+# The hostname to actually scan, or None to skip this domain.
+def target_for(domain):
     # Optional: skip domains which don't support HTTPS in pshtt scan.
     if utils.domain_doesnt_support_https(domain):
         logging.debug("\tSkipping, HTTPS not supported.")
@@ -30,64 +177,233 @@ def scan(domain, options):
     # Optional: if pshtt data says canonical endpoint uses www and this domain
     # doesn't have it, add it.
     if utils.domain_uses_www(domain):
-        scan_domain = "www.%s" % domain
+        return "www.%s" % domain
     else:
-        scan_domain = domain
+        return domain
 
-    # cache JSON from sslyze
-    cache_json = utils.cache_path(domain, "sslyze")
-    # because sslyze manages its own output (can't yet print to stdout),
-    # we have to mkdir_p the path ourselves
-    utils.mkdir_p(os.path.dirname(cache_json))
 
-    force = options.get("force", False)
+# Cached sslyze data for a domain, or None if it needs to be scanned.
+def cached(domain, options):
+    try:
+        data = utils.cache_fresh(domain, "sslyze", options)
+    except ValueError:
+        logging.warn("Error decoding cached data.  Cache probably corrupted.")
+        return {'invalid': True}
 
-    if (force is False) and (os.path.exists(cache_json)):
+    if data is not None:
         logging.debug("\tCached.")
-        raw_json = open(cache_json).read()
-        try:
-            data = json.loads(raw_json)
-            if (data.__class__ is dict) and data.get('invalid'):
-                return None
-        except json.decoder.JSONDecodeError as err:
-            logging.warn("Error decoding JSON.  Cache probably corrupted.")
-            return None
+    return data
+
+
+# Because sslyze manages its own output (can't yet print to stdout),
+# it writes to a scratch file, which is then read into the cache.
+def scratch_file():
+    handle, path = tempfile.mkstemp(prefix="sslyze-", suffix=".json")
+    os.close(handle)
+    return path
+
+
+# This is --regular minus --heartbleed
+# See: https://github.com/nabla-c0d3/sslyze/issues/217
+def command_for(scan_domains, json_out):
+    if isinstance(scan_domains, str):
+        scan_domains = [scan_domains]
+
+    return [
+        command,
+        "--sslv2", "--sslv3", "--tlsv1", "--tlsv1_1", "--tlsv1_2",
+        "--reneg", "--resum", "--certinfo",
+        "--http_get", "--hide_rejected_ciphers",
+        "--compression", "--openssl_ccs",
+        "--fallback", "--quiet"
+    ] + list(scan_domains) + [
+        "--json_out=%s" % json_out
+    ]
+
+
+def failed(domain):
+    # TODO: save standard invalid JSON data...?
+    utils.cache_invalid(domain, "sslyze")
+    logging.warn("\tBad news scanning, sorry!")
+    return None
+
+
+# The JSON sslyze wrote out, parsed, or None.
+def read_json(json_out):
+    with open(json_out, encoding='utf-8') as f:
+        raw_json = f.read()
+
+    if not raw_json:
+        logging.warn("\tBad news reading JSON, sorry!")
+        return None
+
+    try:
+        return json.loads(raw_json)
+    except json.decoder.JSONDecodeError:
+        logging.warn("\tError decoding JSON from sslyze.")
+        return None
+
+
+###
+# The in-process engine (--engine=library).
+#
+# Connects to each target, then queues up the scan commands that
+# parse_sslyze reads. A single target is scanned synchronously in the
+# calling thread; a batch of them goes through sslyze's concurrent
+# scanner, which spreads them across its own pool of processes.
+###
+
+library_commands = ["sslv2", "sslv3", "tlsv1", "tlsv1_1", "tlsv1_2", "certinfo"]
+
 
+def library_results(scan_domains):
+    sslyze = sslyze_module()
+    logging.debug("\t[library] sslyze %s" % str.join(" ", scan_domains))
+
+    accepted = []
+    invalid = []
+    servers = []
+    for scan_domain in scan_domains:
+        try:
+            server_info = sslyze.ServerConnectivityInfo(hostname=scan_domain)
+            server_info.test_connectivity_to_server()
+        except sslyze.ServerConnectivityError as error:
+            invalid.append({'server_string': scan_domain, 'error_message': str(error)})
+            continue
+        servers.append(server_info)
+
+    if len(servers) == 1:
+        scanner = sslyze.SynchronousScanner()
+        results = {}
+        for name in library_commands:
+            try:
+                results[name] = scanner.run_scan_command(servers[0], sslyze.commands[name]())
+            except Exception as error:
+                results[name] = error
+        results = {servers[0].hostname: results}
     else:
-        # use scan_domain (possibly www-prefixed) to do actual scan
-        logging.debug("\t %s %s" % (command, scan_domain))
-
-        # This is --regular minus --heartbleed
-        # See: https://github.com/nabla-c0d3/sslyze/issues/217
-        raw_response = utils.scan([
-            command,
-            "--sslv2", "--sslv3", "--tlsv1", "--tlsv1_1", "--tlsv1_2",
-            "--reneg", "--resum", "--certinfo",
-            "--http_get", "--hide_rejected_ciphers",
-            "--compression", "--openssl_ccs",
-            "--fallback", "--quiet",
-            scan_domain, "--json_out=%s" % cache_json
-        ])
-
-        if raw_response is None:
-            # TODO: save standard invalid JSON data...?
-            utils.write(utils.invalid({}), cache_json)
-            logging.warn("\tBad news scanning, sorry!")
-            return None
+        scanner = sslyze.ConcurrentScanner()
+        for server_info in servers:
+            for name in library_commands:
+                scanner.queue_scan_command(server_info, sslyze.commands[name]())
+
+        # Results come back from other processes, so match them up by hostname.
+        results = {server_info.hostname: {} for server_info in servers}
+        for result in scanner.get_results():
+            results[result.server_info.hostname][result.scan_command.get_cli_argument()] = result
+
+    for server_info in servers:
+        accepted.append({
+            'server_info': {
+                'hostname': server_info.hostname,
+                'port': server_info.port,
+                'ip_address': server_info.ip_address
+            },
+            'commands_results': {
+                name: command_result_for(name, results[server_info.hostname].get(name), sslyze)
+                for name in library_commands
+            }
+        })
+
+    return {'accepted_targets': accepted, 'invalid_targets': invalid}
+
+
+# Just the fields parse_sslyze reads, in the same shape as the
+# command line's JSON output.
+def command_result_for(name, result, sslyze):
+    if (result is None) or isinstance(result, (Exception, sslyze.PluginRaisedExceptionScanResult)):
+        if isinstance(result, sslyze.PluginRaisedExceptionScanResult):
+            message = result.error_message
+        else:
+            message = str(result)
+        return {'error_message': message}
+
+    if name == "certinfo":
+        return {
+            'certificate_chain': [pem_for(cert) for cert in result.certificate_chain],
+            'verified_certificate_chain': [pem_for(cert) for cert in (result.verified_certificate_chain or [])],
+            'has_sha1_in_certificate_chain': result.has_sha1_in_certificate_chain
+        }
+
+    return {
+        'accepted_cipher_list': [
+            {'openssl_name': cipher.openssl_name, 'dh_info': cipher.dh_info}
+            for cipher in result.accepted_cipher_list
+        ]
+    }
 
-        raw_json = utils.scan(["cat", cache_json])
-        if not raw_json:
-            logging.warn("\tBad news reading JSON, sorry!")
-            return None
 
-        utils.write(raw_json, cache_json)
+def pem_for(cert):
+    pem = cert.public_bytes(cryptography.hazmat.primitives.serialization.Encoding.PEM)
+    return {'as_pem': pem.decode('utf-8')}
+
+
+# sslyze's Python API, only needed for --engine=library.
+def sslyze_module():
+    try:
+        from sslyze.concurrent_scanner import ConcurrentScanner, PluginRaisedExceptionScanResult
+        from sslyze.synchronous_scanner import SynchronousScanner
+        from sslyze.server_connectivity import ServerConnectivityInfo, ServerConnectivityError
+        from sslyze.plugins.openssl_cipher_suites_plugin import (
+            Sslv20ScanCommand, Sslv30ScanCommand, Tlsv10ScanCommand,
+            Tlsv11ScanCommand, Tlsv12ScanCommand)
+        from sslyze.plugins.certificate_info_plugin import CertificateInfoScanCommand
+    except ImportError:
+        raise ImportError("--engine=library requires the `sslyze` package (1.x).")
+
+    return types.SimpleNamespace(
+        ConcurrentScanner=ConcurrentScanner,
+        PluginRaisedExceptionScanResult=PluginRaisedExceptionScanResult,
+        SynchronousScanner=SynchronousScanner,
+        ServerConnectivityInfo=ServerConnectivityInfo,
+        ServerConnectivityError=ServerConnectivityError,
+        commands={
+            "sslv2": Sslv20ScanCommand,
+            "sslv3": Sslv30ScanCommand,
+            "tlsv1": Tlsv10ScanCommand,
+            "tlsv1_1": Tlsv11ScanCommand,
+            "tlsv1_2": Tlsv12ScanCommand,
+            "certinfo": CertificateInfoScanCommand,
+        }
+    )
+
 
-    data = parse_sslyze(raw_json)
+# One target's share of the output of a run over several targets: the
+# same output, minus the other targets' results.
+def results_for(scan_domain, results):
+    accepted = [
+        target for target in results.get('accepted_targets', [])
+        if target.get('server_info', {}).get('hostname', '').lower() == scan_domain.lower()
+    ]
+    invalid = [
+        target for target in results.get('invalid_targets', [])
+        if str(target.get('server_string', '')).lower().split(":")[0] == scan_domain.lower()
+    ]
+    return dict(results, accepted_targets=accepted, invalid_targets=invalid)
 
+
+# Given sslyze's parsed JSON, cache it and hand it back.
+def save(domain, data):
     if data is None:
-        logging.warn("\tNo valid target for scanning, couldn't connect.")
         return None
 
+    utils.cache_save(data, domain, "sslyze")
+    return data
+
+
+def rows_for(scan_domain, data):
+    if not data:
+        return
+
+    if (data.__class__ is dict) and data.get('invalid'):
+        return
+
+    data = parse_sslyze(data)
+
+    if data is None:
+        logging.warn("\tNo valid target for scanning, couldn't connect.")
+        return
+
     yield [
         scan_domain,
         data['protocols']['sslv2'], data['protocols']['sslv3'],
@@ -127,7 +443,7 @@ headers = [
     "Errors"
 ]
 
-# Get the relevant fields out of sslyze's JSON format.
+# Get the relevant fields out of sslyze's (already decoded) JSON format.
 #
 # Certificate PEM data must be separately parsed using
 # the Python cryptography module.
@@ -137,9 +453,7 @@ headers = [
 # to disk for caching would be prohibitively complex.
 
 
-def parse_sslyze(raw_json):
-
-    data = json.loads(raw_json)
+def parse_sslyze(data):
 
     # 1. Isolate first successful scanned IP.
     if len(data['accepted_targets']) == 0:
@@ -228,8 +542,8 @@ def parse_sslyze(raw_json):
         # Constructed chain may not be there if it didn't validate.
         constructed_chain = target['certinfo']['verified_certificate_chain']
 
-        highest_served = parse_cert(served_chain[-1])
-        issuer = cert_issuer_name(highest_served)
+        highest_served = cert_for(served_chain[-1])
+        issuer = highest_served.issuer_name()
 
         if issuer:
             data['certs']['served_issuer'] = issuer
@@ -237,44 +551,26 @@ def parse_sslyze(raw_json):
             data['certs']['served_issuer'] = "(None found)"
 
         if (constructed_chain and (len(constructed_chain) > 0)):
-            highest_constructed = parse_cert(constructed_chain[-1])
-            issuer = cert_issuer_name(highest_constructed)
+            highest_constructed = cert_for(constructed_chain[-1])
+            issuer = highest_constructed.issuer_name()
             if issuer:
                 data['certs']['constructed_issuer'] = issuer
             else:
                 data['certs']['constructed_issuer'] = "(None constructed)"
 
-        leaf = parse_cert(served_chain[0])
-        leaf_key = leaf.public_key()
-
-        if hasattr(leaf_key, "key_size"):
-            data['certs']['key_length'] = leaf_key.key_size
-        elif hasattr(leaf_key, "curve"):
-            data['certs']['key_length'] = leaf_key.curve.key_size
-        else:
-            data['certs']['key_length'] = None
-
-        if isinstance(leaf_key, rsa.RSAPublicKey):
-            leaf_key_type = "RSA"
-        elif isinstance(leaf_key, dsa.DSAPublicKey):
-            leaf_key_type = "DSA"
-        elif isinstance(leaf_key, ec.EllipticCurvePublicKey):
-            leaf_key_type = "ECDSA"
-        else:
-            leaf_key_type == str(leaf_key.__class__)
-
-        data['certs']['key_type'] = leaf_key_type
+        leaf = cert_for(served_chain[0])
+        data['certs']['key_type'], data['certs']['key_length'] = leaf.key_info()
 
         # Signature of the leaf certificate only.
-        data['certs']['leaf_signature'] = leaf.signature_hash_algorithm.name
+        data['certs']['leaf_signature'] = leaf.signature_algorithm()
 
         # Beginning and expiration dates of the leaf certificate
-        data['certs']['not_before'] = leaf.not_valid_before
-        data['certs']['not_after'] = leaf.not_valid_after
+        data['certs']['not_before'] = leaf.parsed.not_valid_before
+        data['certs']['not_after'] = leaf.parsed.not_valid_after
 
         any_sha1_served = False
         for cert in served_chain:
-            if parse_cert(cert).signature_hash_algorithm.name == "sha1":
+            if cert_for(cert).signature_algorithm() == "sha1":
                 any_sha1_served = True
 
         data['certs']['any_sha1_served'] = any_sha1_served
@@ -285,11 +581,72 @@ def parse_sslyze(raw_json):
     return data
 
 
-# Given the cert sub-obj from the sslyze JSON, use
-# the cryptography module to parse its PEM contents.
-def parse_cert(cert):
+###
+# Parsed certificates.
+#
+# The same certificates (above all, the intermediates of the common
+# CAs) are served by domain after domain, and each one turns up
+# several times in a domain's results. So each distinct certificate
+# is parsed once per run: parsed certificates, and the fields read
+# from them, are kept by a hash of their PEM, across all domains.
+#
+# The least recently used are evicted past --cert-cache-size
+# (defaults to 10,000 certificates), which init() reads.
+###
+
+cert_index = collections.OrderedDict()
+cert_index_lock = threading.Lock()
+cert_index_size = 10000
+
+
+# The ParsedCert for a cert sub-obj from the sslyze JSON.
+def cert_for(cert):
+    pem = cert['as_pem'].encode('utf-8')
+    digest = hashlib.sha256(pem).digest()
+
+    with cert_index_lock:
+        if digest in cert_index:
+            cert_index.move_to_end(digest)
+            return cert_index[digest]
+
+    parsed = ParsedCert(parse_pem(pem))
+
+    with cert_index_lock:
+        cert_index[digest] = parsed
+        while len(cert_index) > cert_index_size:
+            cert_index.popitem(last=False)
+
+    return parsed
+
+
+# A certificate parsed with the cryptography module, and the fields
+# parse_sslyze reads from it, each worked out the first time it's
+# asked for.
+class ParsedCert(object):
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+        self.fields = {}
+
+    def field(self, name, function):
+        if name not in self.fields:
+            self.fields[name] = function(self.parsed)
+        return self.fields[name]
+
+    def issuer_name(self):
+        return self.field('issuer_name', cert_issuer_name)
+
+    def signature_algorithm(self):
+        return self.field('signature_algorithm', lambda parsed: parsed.signature_hash_algorithm.name)
+
+    # (key type, key length)
+    def key_info(self):
+        return self.field('key_info', cert_key_info)
+
+
+# Use the cryptography module to parse a PEM certificate.
+def parse_pem(pem_bytes):
     backend = cryptography.hazmat.backends.openssl.backend
-    pem_bytes = cert['as_pem'].encode('utf-8')
     return cryptography.x509.load_pem_x509_certificate(pem_bytes, backend)
 
 
@@ -304,6 +661,29 @@ def cert_issuer_name(parsed):
     return attrs[0].value
 
 
+# Given a parsed cert, its key's type and length.
+def cert_key_info(parsed):
+    key = parsed.public_key()
+
+    if hasattr(key, "key_size"):
+        key_length = key.key_size
+    elif hasattr(key, "curve"):
+        key_length = key.curve.key_size
+    else:
+        key_length = None
+
+    if isinstance(key, rsa.RSAPublicKey):
+        key_type = "RSA"
+    elif isinstance(key, dsa.DSAPublicKey):
+        key_type = "DSA"
+    elif isinstance(key, ec.EllipticCurvePublicKey):
+        key_type = "ECDSA"
+    else:
+        key_type = str(key.__class__)
+
+    return key_type, key_length
+
+
 # examines whether the protocol version turned out ot be supported
 def supported_protocol(target, protocol):
     if target[protocol].get("error_message", None) is not None:
@@ -1,91 +1,129 @@
 from datetime import datetime, timedelta
 import logging
 import re
-import requests
+import heapq
 import time
 
-command = None
-
-
-def starttls_check_url(domain):
-    return 'https://starttls.info/api/check/%s' % domain
+from scanners import utils
 
+command = None
 
-def poll_starttls_info_status(domain):
-    """
-    Poll the starttls.info API endpoint until the status of the info for a
-    given `domain` is 'DONE'.
-
-    We poll every 5 seconds.
-    """
-    poll_interval = 5
-    max_poll = 300    # 5 minutes
-    time_elapsed = 0
 
-    while True:
-        if time_elapsed >= max_poll:
-            logging.error("Timed out polling for updated info from starttls.info for %s" % domain)
-            break
-
-        logging.debug("Checking starttls.info status for %s" % domain)
+# starttls.info is polled for many domains at once (see scan_batch),
+# so `scan` hands it domains in batches of this many.
+batch_size = 50
 
-        start_time = time.clock()
+# How often to check on a domain that's being (re-)checked, and how
+# long to wait for it.
+poll_interval = 5
+max_poll = 300    # 5 minutes
 
-        r = requests.get(starttls_check_url(domain))
-        if r.json()['status'] == 'DONE':
-            return r
+# A 1-day refresh rate is arbitrary. We want to encourage people to use
+# this dashboard as a way to track their progress on implementing
+# improvements to their security, and it'll be more effective as
+# encouragement if we reward people's work promptly.
+results_max_age = timedelta(days=1)
 
-        finish_time = time.clock()
-        sleep_time = max(0, poll_interval - (finish_time - start_time))
-        time.sleep(sleep_time)
-        time_elapsed += time.clock() - start_time
 
+def starttls_check_url(domain):
+    return 'https://starttls.info/api/check/%s' % domain
 
-def refresh_starttls_results(domain):
-    """
-    Send a `reset` POST request to the STARTTLS API endpoint to ask the
-    server to refresh the results for `domain`.
 
-    After the reset request is sent, we poll the endpoint until it is done
-    refreshing the results, then return the complete set of new results.
-    """
-    logging.debug('Refreshing STARTTLS results for %s' % domain)
-    requests.post(starttls_check_url(domain), data={'reset': 'true'})
-    return poll_starttls_info_status(domain)
+def scan(domain, options):
+    for scanned, rows in scan_batch([domain], options):
+        for row in rows:
+            yield row
+
+
+# Check a batch of domains over one pooled HTTP session (see
+# utils.http_session), without a thread (or a sleep) per domain.
+#
+# Every domain's current results are fetched first, and a refresh is
+# asked for for each one whose results are stale. Then all the
+# domains still being checked are polled from one loop, each every
+# `poll_interval` seconds, until they're done or `max_poll` seconds
+# have passed. Yields each domain and its rows as soon as it's done.
+# A domain whose request (or response) fails gets no rows, and the
+# rest of the batch carries on.
+def scan_batch(domains, options):
+    session = utils.http_session()
+    pending = []
+
+    for domain in domains:
+        logging.debug("[%s][starttls]" % domain)
+
+        try:
+            rows = start_check(session, domain)
+        except Exception as error:
+            logging.warn("[%s][starttls] Error checking starttls.info: %s" % (domain, error))
+            yield domain, []
+            continue
+
+        if rows is not None:
+            yield domain, rows
+            continue
+
+        now = time.monotonic()
+        heapq.heappush(pending, (now + poll_interval, now + max_poll, domain))
+
+    while pending:
+        next_poll, deadline, domain = heapq.heappop(pending)
+        time.sleep(max(0, next_poll - time.monotonic()))
 
+        logging.debug("Checking starttls.info status for %s" % domain)
+        try:
+            data = session.get(starttls_check_url(domain)).json()
+            rows = list(rows_for(data)) if (data['status'] == 'DONE') else None
+        except Exception as error:
+            logging.warn("[%s][starttls] Error polling starttls.info: %s" % (domain, error))
+            yield domain, []
+            continue
+
+        if rows is not None:
+            yield domain, rows
+        elif time.monotonic() >= deadline:
+            logging.error("Timed out polling for updated info from starttls.info for %s" % domain)
+            yield domain, []
+        else:
+            heapq.heappush(pending, (time.monotonic() + poll_interval, deadline, domain))
 
-def scan(domain, options):
-    logging.debug("[%s][starttls]" % domain)
 
+# Fetch a domain's current results, and ask for a refresh if they're
+# stale. Returns its rows if they're fresh, or None if it needs polling.
+def start_check(session, domain):
     # Query the starttls.info API endpoint
-    r = requests.get(starttls_check_url(domain))
+    data = session.get(starttls_check_url(domain)).json()
 
     # It's possible to query the endpoint while it is re-checking the results
     # for this domain. In this case, poll until the scan is done so we get
     # complete and up-to-date results.
-    if r.json()['status'] == 'IN PROGRESS':
-        r = poll_starttls_info_status(domain)
+    if data['status'] == 'IN PROGRESS':
+        return None
 
     # starttls.info doesn't automatically re-check domains, but we can ask it
     # to do so if the results aren't fresh enough.
+    if is_stale(data):
+        logging.debug('Refreshing STARTTLS results for %s' % domain)
+        session.post(starttls_check_url(domain), data={'reset': 'true'})
+        return None
+
+    return list(rows_for(data))
 
-    # A 1-day refresh rate is arbitrary. We want to encourage people to use
-    # this dashboard as a way to track their progress on implementing
-    # improvements to their security, and it'll be more effective as
-    # encouragement if we reward people's work promptly.
-    results_max_age = timedelta(days=1)
-    last_updated = datetime.strptime(r.json()['status_changed'],
+
+def is_stale(data):
+    last_updated = datetime.strptime(data['status_changed'],
                                      "%Y-%m-%dT%H:%M:%S.%fZ")
-    if last_updated < datetime.utcnow() - results_max_age:
-        r = refresh_starttls_results(domain)
+    return last_updated < datetime.utcnow() - results_max_age
+
 
+def rows_for(data):
     # The STARTTLS.info API is not great, and returns most of its useful info
     # in a big blob of HTML instead of a nice JSON data model. We'll use
     # regexes to parse it for now :'(. Hopefully once starttls.info is open
     # sourced, we will be able to contribute and improve this state of affairs.
 
     # starttls.info can return multiple rows, one for each MX endpoint
-    for mx in r.json()['actual_targets']:
+    for mx in data['actual_targets']:
         description = mx['description']
 
         if mx['failed'] is True:
@@ -95,8 +133,9 @@ def scan(domain, options):
             # is sort of annoying, but we can't do anything about it now.
             # Hopefully we can help clean up the API once the project is open
             # source.
-            yield [r.json()['status_changed'], mx['name'], not mx['failed'],
+            yield [data['status_changed'], mx['name'], not mx['failed'],
                    mx['description'], None, None, None, None, None]
+            continue
         else:
             # TODO: starttls.info doesn't indicate the key *type*, and seems to
             # assume everything is using RSA. Does anybody use ECC for
@@ -137,7 +176,7 @@ def scan(domain, options):
             tlsv12 = bool(re.search(tlsv12_re, description))
 
         yield [
-            r.json()['status_changed'],
+            data['status_changed'],
             mx['name'],
             not mx['failed'],
             None,
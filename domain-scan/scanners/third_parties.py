@@ -38,6 +38,9 @@ init = None
 # Should be able to handle the full complement.
 workers = 10
 
+# Needs pshtt's canonical URL and redirect data, when available.
+depends = ["pshtt"]
+
 
 ######################################
 #
@@ -135,13 +138,11 @@ def scan(domain, options):
     # calculated_domain = re.sub("https?:\/\/", "", url)
 
     # We'll cache prettified JSON from the output.
-    cache = utils.cache_path(domain, "third_parties")
+    data = utils.cache_fresh(domain, "third_parties", options)
 
     # If we've got it cached, use that.
-    if (options.get("force", False) is False) and (os.path.exists(cache)):
+    if data is not None:
         logging.debug("\tCached.")
-        raw = open(cache).read()
-        data = json.loads(raw)
         if data.get('invalid'):
             return None
 
@@ -150,12 +151,12 @@ def scan(domain, options):
         logging.debug("\t %s %s --modules=domains --reporter=json --timeout=%i --ignore-ssl-errors" % (command, url, timeout))
         raw = utils.scan([command, url, "--modules=domains", "--reporter=json", "--timeout=%i" % timeout, "--ignore-ssl-errors"], allowed_return_codes=[252])
         if not raw:
-            utils.write(utils.invalid({}), cache)
+            utils.cache_invalid(domain, "third_parties")
             return None
 
-        # It had better be JSON, which we can cache in prettified form.
+        # It had better be JSON, which we can cache.
         data = json.loads(raw)
-        utils.write(utils.json_for(data), cache)
+        utils.cache_save(data, domain, "third_parties")
 
     services = services_for(data, domain, options)
 
@@ -198,6 +199,8 @@ def services_for(data, domain, options):
     hostnames = list(hosts.keys())
     hostnames.sort()
 
+    base_domain = utils.base_domain_for(domain)
+
     for host in hostnames:
         if host.startswith("www."):
             www_host = host
@@ -216,7 +219,7 @@ def services_for(data, domain, options):
             continue
 
         # internal if it shares the same base domain
-        if (utils.base_domain_for(host) == utils.base_domain_for(domain)):
+        if (utils.base_domain_for(host) == base_domain):
             services['internal'].append(host)
         # otherwise external
         else:
@@ -16,70 +16,129 @@ import os
 command = os.environ.get("SSLLABS_PATH", "ssllabs-scan")
 workers = 1
 
+# Skips domains using cached pshtt data, so run after pshtt in --pipeline mode.
+depends = ["pshtt"]
+
+
+# ssllabs-scan assesses any number of hosts in one run, so `scan`
+# hands it domains in batches of this many (see scan_batch).
+batch_size = 10
+
 
 def scan(domain, options):
     logging.debug("[%s][tls]" % domain)
 
+    scan_domain = target_for(domain)
+    if scan_domain is None:
+        return None
+
+    # cache reformatted JSON from ssllabs
+    data = cached(domain, options)
+    if data is None:
+        logging.debug("\t %s %s" % (command, scan_domain))
+
+        results = results_by_host(utils.scan(command_for([scan_domain], options)))
+        if results is None:
+            return None
+            # raise Exception("Invalid data from ssllabs-scan: %s" % raw)
+
+        data = save(domain, results.get(scan_domain.lower()))
+
+    for row in rows_for(data):
+        yield row
+
+
+# Scan several domains with one run of ssllabs-scan. Yields each
+# domain and its rows, and caches each domain's results separately.
+def scan_batch(domains, options):
+    targets = {}
+    data = {}
+    for domain in domains:
+        logging.debug("[%s][tls]" % domain)
+        targets[domain] = target_for(domain)
+        if targets[domain] is not None:
+            data[domain] = cached(domain, options)
+
+    to_scan = [domain for domain in data if data[domain] is None]
+    if to_scan:
+        scan_domains = sorted(set(targets[domain] for domain in to_scan))
+        logging.debug("\t %s %s" % (command, str.join(" ", scan_domains)))
+
+        results = results_by_host(utils.scan(command_for(scan_domains, options)))
+        if results is not None:
+            for domain in to_scan:
+                data[domain] = save(domain, results.get(targets[domain].lower()))
+
+    for domain in domains:
+        yield domain, list(rows_for(data.get(domain)))
+
+
+# The hostname to actually scan, or None to skip this domain.
+def target_for(domain):
     # If pshtt data exists, check to see if we can skip.
     if utils.domain_doesnt_support_https(domain):
         logging.debug("\tSkipping, HTTPS not supported.")
         return None
 
-    # cache reformatted JSON from ssllabs
-    cache = utils.cache_path(domain, "tls")
-
     # Optional: if pshtt data says canonical endpoint uses www and this domain
     # doesn't have it, add it.
     if utils.domain_uses_www(domain):
-        scan_domain = "www.%s" % domain
+        return "www.%s" % domain
     else:
-        scan_domain = domain
+        return domain
 
-    force = options.get("force", False)
 
-    if (force is False) and (os.path.exists(cache)):
+# Cached SSL Labs data for a domain, or None if it needs to be scanned.
+def cached(domain, options):
+    data = utils.cache_fresh(domain, "tls", options)
+    if data is not None:
         logging.debug("\tCached.")
-        raw = open(cache).read()
-        data = json.loads(raw)
+    return data
 
-        if data.get('invalid'):
-            return None
+
+def command_for(scan_domains, options):
+    usecache = str(not options.get("force", False)).lower()
+
+    if options.get("debug"):
+        verbosity = "--verbosity=debug"
     else:
-        logging.debug("\t %s %s" % (command, scan_domain))
+        verbosity = "--quiet"
 
-        usecache = str(not force).lower()
-
-        if options.get("debug"):
-            cmd = [command, "--usecache=%s" % usecache,
-                   "--verbosity=debug", scan_domain]
-        else:
-            cmd = [command, "--usecache=%s" % usecache,
-                   "--quiet", scan_domain]
-
-        raw = utils.scan(cmd)
-        if raw:
-            data = json.loads(raw)
-
-            # if SSL Labs gave us back an error response, cache this
-            # as an invalid entry.
-            if len(data) < 1:
-                utils.write(utils.invalid({'response': data}), cache)
-                return None
-
-            # we only give ssllabs-scan one at a time,
-            # so we can de-pluralize this
-            data = data[0]
-
-            # if SSL Labs had an error hitting the site, cache this
-            # as an invalid entry.
-            if data["status"] == "ERROR":
-                utils.write(utils.invalid(data), cache)
-                return None
-
-            utils.write(utils.json_for(data), cache)
-        else:
-            return None
-            # raise Exception("Invalid data from ssllabs-scan: %s" % raw)
+    return [command, "--usecache=%s" % usecache, verbosity] + list(scan_domains)
+
+
+# ssllabs-scan's output (a list of results, one per host), by host,
+# or None if it didn't give us any.
+def results_by_host(raw):
+    if not raw:
+        return None
+    return {
+        result.get('host', '').lower(): result
+        for result in json.loads(raw)
+    }
+
+
+# Cache a host's result, and return it, or None if it's no good.
+def save(domain, data):
+    # if SSL Labs gave us back an error response (or nothing at all
+    # for this host), cache this as an invalid entry.
+    if data is None:
+        utils.cache_invalid(domain, "tls", {'response': []})
+        return None
+
+    # if SSL Labs had an error hitting the site, cache this
+    # as an invalid entry.
+    if data["status"] == "ERROR":
+        utils.cache_invalid(domain, "tls", data)
+        return None
+
+    utils.cache_save(data, domain, "tls")
+    return data
+
+
+def rows_for(data):
+    if (not data) or data.get('invalid'):
+        return
 
     # can return multiple rows, one for each 'endpoint'
     for endpoint in data['endpoints']:
@@ -1,17 +1,29 @@
 import os
 import re
 import errno
+import asyncio
 import subprocess
 import sys
 import shutil
 import traceback
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import time
+import collections
+import atexit
+import heapq
+import tempfile
 import json
-import urllib
 import csv
 import logging
 import datetime
 import strict_rfc3339
 import requests
+import requests.adapters
+import urllib3.util.retry
+from scanners import cache
+from scanners import psl
 
 def run_service(service_name, domain, options):
     service_name = service_name.lower()
@@ -28,7 +40,7 @@ def run_service(service_name, domain, options):
     }
     # this may need to get refactored abit - the result here might need to get
     # turned into a celery task
-    result = json.loads(requests.get(url, data=json.dumps(data)).text)
+    result = json.loads(http_session().get(url, data=json.dumps(data)).text)
     # result then gets saved to a database
     # then this function returns a dictionary of some information about the function
     # how long it took to run in seconds
@@ -54,8 +66,67 @@ def download(url, destination):
     # make sure path is present
     mkdir_p(os.path.dirname(destination))
 
-    filename, headers = urllib.request.urlretrieve(url, destination)
-    return filename
+    response = http_session().get(url, stream=True)
+    response.raise_for_status()
+    with open(destination, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    return destination
+
+
+###
+# Shared HTTP sessions.
+#
+# HTTP requests go through http_session() rather than bare
+# requests.get/post, so that connections are kept alive and reused
+# instead of paying for a new TCP (and TLS) handshake per request.
+#
+# Each thread gets its own session (requests doesn't promise that
+# sessions are thread-safe), with:
+#
+# * a pool of up to --http-pool-size (default 10) connections per host
+# * a timeout of --http-timeout seconds (default 30) on every request
+# * up to --http-retries retries (default 3), with exponential backoff,
+#   of requests that fail to connect or get a 429 or 5xx response.
+#   Only idempotent requests (e.g. GET, not POST) are retried.
+###
+
+http_local = threading.local()
+
+
+class HTTPSession(requests.Session):
+
+    def __init__(self, timeout=30, retries=3, pool_size=10, backoff=0.5):
+        super(HTTPSession, self).__init__()
+        self.timeout = timeout
+
+        retry = urllib3.util.retry.Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(HTTPSession, self).request(method, url, **kwargs)
+
+
+# This thread's session, set up from the command line options.
+def http_session():
+    session = getattr(http_local, "session", None)
+    if session is None:
+        cli_options = options()
+        session = HTTPSession(
+            timeout=float(cli_options.get("http-timeout", 30)),
+            retries=int(cli_options.get("http-retries", 3)),
+            pool_size=int(cli_options.get("http-pool-size", 10))
+        )
+        http_local.session = session
+    return session
 
 
 # read options from the command line
@@ -187,6 +258,20 @@ def scan(command, env=None, allowed_return_codes=[]):
             logging.warn("Error running %s." % (str(command)))
             return None
 
+
+# Same as scan(), but as a coroutine that doesn't block the event
+# loop (or hold a thread) while the command runs.
+async def scan_async(command, env=None, allowed_return_codes=[]):
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=subprocess.PIPE, env=env)
+    stdout, _ = await process.communicate()
+
+    if (process.returncode == 0) or (process.returncode in allowed_return_codes):
+        return str(stdout, encoding='UTF-8')
+    else:
+        logging.warn("Error running %s." % (str(command)))
+        return None
+
 # Turn shell on, when shell=False won't work.
 
 
@@ -210,12 +295,141 @@ def cache_single(filename):
     return os.path.join(cache_dir(), filename)
 
 
+# The cache backend for this process, chosen with --cache (defaults
+# to one file per entry). See scanners/cache.py.
+cache_store = None
+cache_store_lock = threading.Lock()
+
+
+def cache_backend():
+    global cache_store
+    with cache_store_lock:
+        if cache_store is None:
+            cli_options = options()
+            cache_store = cache.backend_for(cli_options.get("cache", "files"), cache_dir(), cli_options)
+            atexit.register(cache_store.close)
+        return cache_store
+
+
+# Whether anything is cached for a domain and operation.
+def cache_exists(domain, operation):
+    return cache_backend().exists(domain, operation)
+
+
+# The raw cached content for a domain and operation, or None.
+def cache_read(domain, operation):
+    return cache_backend().read(domain, operation)
+
+
+# Cache content (usually from json_for or invalid) for a domain and operation.
+def cache_write(content, domain, operation):
+    cache_backend().write(content, domain, operation)
+
+
+# Commit any batched cache writes.
+def cache_flush():
+    if cache_store is not None:
+        cache_store.flush()
+
+
+# Which codec to encode an operation's cached data with, from
+# --cache-codec. See scanners/cache.py.
+cache_codecs = None
+
+
+def cache_codec_for(operation):
+    global cache_codecs
+    if cache_codecs is None:
+        cache_codecs = cache.codecs_for(options().get("cache-codec"))
+    default, by_operation = cache_codecs
+    return by_operation.get(operation, default)
+
+
+# Cache data (anything json_for can handle) for a domain and operation,
+# encoded with that operation's codec.
+def cache_save(data, domain, operation):
+    content = cache.encode(data, cache_codec_for(operation), default=format_datetime)
+    cache_write(content, domain, operation)
+
+
+# Cache an invalid response for a domain and operation.
+def cache_invalid(domain, operation, data=None):
+    if data is None:
+        data = {}
+    data['invalid'] = True
+    cache_save(data, domain, operation)
+
+
+# Decoded cached data for a domain and operation (whatever codec it
+# was written with), or None if nothing's cached.
+def cache_load(domain, operation):
+    raw = cache_read(domain, operation)
+    if raw is None:
+        return None
+    return cache.decode(raw)
+
+
+# When a domain's entry for an operation was cached, as a Unix
+# timestamp, or None.
+def cache_updated(domain, operation):
+    return cache_backend().updated(domain, operation)
+
+
+# How old an operation's cached entries can get, in seconds, from
+# --max-age. None means they never expire. See scanners/cache.py.
+cache_max_ages = None
+
+
+def cache_max_age_for(operation):
+    global cache_max_ages
+    if cache_max_ages is None:
+        cache_max_ages = cache.max_ages_for(options().get("max-age"))
+    default, by_operation = cache_max_ages
+    return by_operation.get(operation, default)
+
+
+def cache_expired(domain, operation):
+    max_age = cache_max_age_for(operation)
+    if max_age is None:
+        return False
+    return cache.expired(cache_updated(domain, operation), max_age)
+
+
+# Entries that were expired, but were used anyway because of
+# --stale-while-revalidate, as (domain, operation) pairs. `scan`
+# rescans these after it's written its results.
+cache_stale = set()
+cache_stale_lock = threading.Lock()
+
+
+# What a scanner should use from the cache for a domain: the decoded
+# data if it's there and fresh enough, or None if it should be
+# (re)scanned. --force ignores the cache entirely.
+#
+# With --stale-while-revalidate, expired data is still returned, and
+# the entry is noted in cache_stale so that it can be refreshed later.
+def cache_fresh(domain, operation, options):
+    if options.get("force", False) is not False:
+        return None
+
+    data = cache_load(domain, operation)
+    if (data is None) or (not cache_expired(domain, operation)):
+        return data
+
+    if options.get("stale-while-revalidate"):
+        logging.debug("\tStale, will revalidate.")
+        with cache_stale_lock:
+            cache_stale.add((domain, operation))
+        return data
+
+    logging.debug("\tExpired.")
+    return None
+
+
 # Used to quickly get cached data for a domain.
 def data_for(domain, operation):
-    path = cache_path(domain, operation)
-    if os.path.exists(path):
-        raw = open(path).read()
-        data = json.loads(raw)
+    data = cache_load(domain, operation)
+    if data is not None:
         if isinstance(data, dict) and (data.get('invalid', False)):
             return None
         else:
@@ -237,9 +451,99 @@ def utc_timestamp():
     return strict_rfc3339.now_to_rfc3339_utcoffset()
 
 
-# return base domain for a subdomain
+# The base ("registrable") domain of a hostname, according to the
+# Public Suffix List, e.g. sd.k12.ca.us for www.sd.k12.ca.us.
+# See scanners/psl.py.
 def base_domain_for(subdomain):
-    return str.join(".", subdomain.split(".")[-2:])
+    return psl.base_domain_for(subdomain)
+
+
+# Base domains for a list of hostnames, in the same order.
+def base_domains_for(subdomains):
+    return psl.base_domains_for(subdomains)
+
+
+###
+# A process-wide index of pshtt results, so that the scanners
+# that consult pshtt's cache (often several times per domain)
+# only read and parse each domain's pshtt JSON once.
+#
+# Only the handful of fields the other scanners use are kept.
+# The least recently used records are evicted past
+# --pshtt-index-size (defaults to 100,000 domains).
+###
+
+pshtt_index = collections.OrderedDict()
+pshtt_index_lock = threading.Lock()
+pshtt_index_size = int(options().get("pshtt-index-size", 100000))
+
+
+# The compact record for a domain, or None if there's no (valid)
+# pshtt data cached for it.
+def pshtt_record(domain):
+    with pshtt_index_lock:
+        if domain in pshtt_index:
+            pshtt_index.move_to_end(domain)
+            return pshtt_index[domain] or None
+
+    data = data_for(domain, "pshtt")
+
+    # Nothing cached (yet): don't remember that, pshtt may still run.
+    if data == {}:
+        return None
+
+    return index_pshtt(domain, data)
+
+
+# Add (or replace) a domain's record, given its full pshtt data.
+# Invalid data is remembered as False.
+def index_pshtt(domain, data):
+    record = compact_pshtt(data)
+
+    with pshtt_index_lock:
+        pshtt_index[domain] = record
+        pshtt_index.move_to_end(domain)
+        while len(pshtt_index) > pshtt_index_size:
+            pshtt_index.popitem(last=False)
+
+    return record or None
+
+
+def compact_pshtt(data):
+    if (not data) or ((data.__class__ is dict) and data.get('invalid')):
+        return False
+
+    # pshtt scanner uses JSON arrays, even for single items
+    inspection = data[0]
+
+    endpoints = inspection.get("endpoints") or {}
+
+    def endpoint_used(endpoint):
+        endpoint = endpoint or {}
+        return bool(endpoint.get("live") and (not endpoint.get("https_bad_hostname")))
+
+    return {
+        'Canonical URL': inspection.get("Canonical URL"),
+        'Live': inspection.get("Live"),
+        'Redirect': inspection.get("Redirect"),
+        'Redirect To': inspection.get("Redirect To"),
+        'HTTPS Used': (endpoint_used(endpoints.get("https")) or endpoint_used(endpoints.get("httpswww")))
+    }
+
+
+# Read every cached pshtt result into the index at once (up to
+# its size limit), rather than one at a time as they're asked for.
+def preload_pshtt_index():
+    count = 0
+    for domain in cache_backend().domains("pshtt"):
+        if count >= pshtt_index_size:
+            break
+
+        index_pshtt(domain, data_for(domain, "pshtt"))
+        count += 1
+
+    logging.debug("Preloaded %i pshtt records." % count)
+    return count
 
 
 # Check whether we have HTTP behavior data cached for a domain.
@@ -247,23 +551,11 @@ def base_domain_for(subdomain):
 # Useful for saving time on TLS-related scanning.
 def domain_doesnt_support_https(domain):
     # Make sure we have the cached data.
-    inspection = data_for(domain, "pshtt")
+    inspection = pshtt_record(domain)
     if not inspection:
         return False
 
-    if (inspection.__class__ is dict) and inspection.get('invalid'):
-        return False
-
-    # TODO: kill this
-    inspection = inspection[0]
-
-    https = inspection.get("endpoints").get("https")
-    httpswww = inspection.get("endpoints").get("httpswww")
-
-    def endpoint_used(endpoint):
-        return endpoint.get("live") and (not endpoint.get("https_bad_hostname"))
-
-    return (not (endpoint_used(https) or endpoint_used(httpswww)))
+    return (not inspection['HTTPS Used'])
 
 
 # Check whether we have HTTP behavior data cached for a domain.
@@ -274,14 +566,9 @@ def domain_uses_www(domain):
         return False
 
     # Make sure we have the data.
-    inspection = data_for(domain, "pshtt")
+    inspection = pshtt_record(domain)
     if not inspection:
         return False
-    if (inspection.__class__ is dict) and inspection.get('invalid'):
-        return False
-
-    # TODO: kill this
-    inspection = inspection[0]
 
     # We know the canonical URL, return True if it's www.
     url = inspection.get("Canonical URL")
@@ -296,11 +583,9 @@ def domain_uses_www(domain):
 # Useful for skipping scans on non-live domains.
 def domain_not_live(domain):
     # Make sure we have the data.
-    inspection = data_for(domain, "pshtt")
+    inspection = pshtt_record(domain)
     if not inspection:
         return False
-    # TODO: kill this
-    inspection = inspection[0]
 
     return (not inspection.get("Live"))
 
@@ -310,11 +595,9 @@ def domain_not_live(domain):
 # Useful for skipping scans on redirect domains.
 def domain_is_redirect(domain):
     # Make sure we have the data.
-    inspection = data_for(domain, "pshtt")
+    inspection = pshtt_record(domain)
     if not inspection:
         return False
-    # TODO: kill this
-    inspection = inspection[0]
 
     return (inspection.get("Redirect") is True)
 
@@ -324,11 +607,9 @@ def domain_is_redirect(domain):
 # Useful for focusing scans on the right endpoint.
 def domain_canonical(domain):
     # Make sure we have the data.
-    inspection = data_for(domain, "pshtt")
+    inspection = pshtt_record(domain)
     if not inspection:
         return False
-    # TODO: kill this
-    inspection = inspection[0]
 
     return (inspection.get("Canonical URL"))
 
@@ -350,51 +631,337 @@ def load_domains(domain_csv, whole_rows=False):
     return domains
 
 
-# Sort a CSV by domain name, "in-place" (by making a temporary copy).
-# This loads the whole thing into memory: it's not a great solution for
-# super-large lists of domains.
-def sort_csv(input_filename):
-    logging.warn("Sorting %s..." % input_filename)
-
-    input_file = open(input_filename, encoding='utf-8', newline='')
-    tmp_filename = "%s.tmp" % input_filename
-    tmp_file = open(tmp_filename, 'w', newline='')
-    tmp_writer = csv.writer(tmp_file)
-
-    # store list of domains, to sort at the end
-    domains = []
+# Run `producers` (functions that each return an iterable of batches)
+# on up to `workers` threads, and yield their batches as they come in,
+# in no particular order.
+#
+# Batches are handed over through a bounded queue. If a producer
+# raises, or the consumer stops early (e.g. closes this generator),
+# the other producers are told to stop, and the queue is drained so
+# that none of them stays blocked on it. The first error a producer
+# raised is re-raised once all the threads are done.
+def parallel_batches(producers, workers, queue_size=100):
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    finished = object()
+
+    # Hand something over, unless the consumer has stopped listening.
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    # index rows by domain
-    rows = {}
-    header = None
+    def produce(producer):
+        if stop.is_set():
+            return
+        try:
+            for batch in producer():
+                if not put(batch):
+                    return
+            put(finished)
+        except Exception as error:
+            put(error)
+
+    error = None
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    futures = [executor.submit(produce, producer) for producer in producers]
+    try:
+        remaining = len(futures)
+        while remaining > 0:
+            item = batches.get()
+            if item is finished:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                error = item
+                break
+            else:
+                yield item
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        while any(not future.done() for future in futures):
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown(wait=True)
+
+    if error is not None:
+        raise error
+
+
+# A token bucket rate limiter that can be shared between threads.
+# Up to `burst` calls to acquire() go through at once, and after that
+# they're let through at an average of `rate` per second.
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a call is allowed.
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + ((now - self.updated) * self.rate))
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# Writes rows to a CSV from a single background thread, so any number
+# of scanning threads can hand it rows without a lock, and without
+# their rows interleaving.
+#
+# Rows are written in batches, and the file is flushed at most once
+# every `flush_interval` seconds (and when closed). Intervals shorter
+# than `min_flush_interval` are raised to it, since the writer thread
+# waits that long for rows between flushes, and would spin otherwise.
+class ResultWriter(object):
+    _done = object()
+    min_flush_interval = 0.1
+
+    def __init__(self, filename, headers=None, flush_interval=5, max_queued=10000):
+        self.filename = filename
+        self.flush_interval = max(float(flush_interval), self.min_flush_interval)
+        self.rows = 0
+        self.error = None
+
+        mkdir_p(os.path.dirname(filename) or ".")
+        self.file = open(filename, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if headers:
+            self.writer.writerow(headers)
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self._run, name="writer:%s" % filename)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a row to be written.
+    def writerow(self, row):
+        self.queue.put([row])
+
+    # Queue several rows, to be written together.
+    def writerows(self, rows):
+        rows = list(rows)
+        if rows:
+            self.queue.put(rows)
+
+    # Write out anything still queued, and close the file.
+    def close(self):
+        self.queue.put(self._done)
+        self.thread.join()
+        self.file.close()
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        last_flush = time.time()
+        done = False
+
+        while not done:
+            timeout = max(0, self.flush_interval - (time.time() - last_flush))
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+
+            # Take whatever else is already waiting, without blocking.
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for rows in batch:
+                if rows is self._done:
+                    done = True
+                    continue
+                try:
+                    self.writer.writerows(rows)
+                    self.rows += len(rows)
+                except Exception as error:
+                    logging.warn("Error writing to %s: %s" % (self.filename, error))
+                    self.error = error
+
+            if done or ((time.time() - last_flush) >= self.flush_interval):
+                self.file.flush()
+                last_flush = time.time()
 
-    for row in csv.reader(input_file):
-        # keep the header around
-        if (row[0].lower().startswith("domain")):
-            header = row
-            continue
 
-        # index domain for later reference
-        domain = row[0]
-        domains.append(domain)
-        rows[domain] = row
+# Sort a CSV by domain name, "in-place" (by making a temporary copy).
+#
+# This is an external merge sort, so memory use is bounded no matter
+# how big the CSV is: rows are read in chunks of `chunk_size` (from
+# --sort-chunk-size, default 100,000), each chunk is sorted and
+# spilled to a temporary file next to the CSV, and the sorted chunks
+# are then merged into the final file.
+#
+# Rows for the same domain are all kept (scanners like `tls` write one
+# per endpoint), in the order they were in originally.
+def sort_csv(input_filename, chunk_size=None):
+    logging.warn("Sorting %s..." % input_filename)
 
-    # straight alphabet sort
-    domains.sort()
+    if chunk_size is None:
+        chunk_size = int(options().get("sort-chunk-size", 100000))
 
-    # write out to a new file
-    tmp_writer.writerow(header)
-    for domain in domains:
-        tmp_writer.writerow(rows[domain])
+    directory = os.path.dirname(os.path.abspath(input_filename))
+    header = None
+    chunks = []
 
-    # close the file handles
-    input_file.close()
-    tmp_file.close()
+    try:
+        with open(input_filename, encoding='utf-8', newline='') as input_file:
+            rows = []
+            for row in csv.reader(input_file):
+                if not row:
+                    continue
+
+                # keep the header around
+                if (header is None) and (row[0].lower().startswith("domain")):
+                    header = row
+                    continue
+
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    chunks.append(sorted_chunk(rows, directory))
+                    rows = []
+
+            if rows or (not chunks):
+                chunks.append(sorted_chunk(rows, directory))
+
+        # Merge the sorted chunks into a new file. Ties go to the
+        # earlier chunk, so rows for a domain keep their order.
+        tmp_filename = "%s.tmp" % input_filename
+        with open(tmp_filename, 'w', newline='') as tmp_file:
+            tmp_writer = csv.writer(tmp_file)
+            if header is not None:
+                tmp_writer.writerow(header)
+
+            chunk_files = [open(chunk, encoding='utf-8', newline='') for chunk in chunks]
+            try:
+                readers = [csv.reader(chunk_file) for chunk_file in chunk_files]
+                for row in heapq.merge(*readers, key=sort_key):
+                    tmp_writer.writerow(row)
+            finally:
+                for chunk_file in chunk_files:
+                    chunk_file.close()
+
+    finally:
+        for chunk in chunks:
+            os.remove(chunk)
 
     # replace the original
     shutil.move(tmp_filename, input_filename)
 
 
+# Rows sort by domain name (the first column). Sorting chunks and
+# merging them are both stable, so ties stay in their original order.
+def sort_key(row):
+    return row[0]
+
+
+# Sort one chunk of rows (stably) and write it to a temporary file,
+# returning its path.
+def sorted_chunk(rows, directory):
+    rows.sort(key=sort_key)
+
+    handle, path = tempfile.mkstemp(prefix="sort-", suffix=".csv", dir=directory)
+    with os.fdopen(handle, 'w', encoding='utf-8', newline='') as chunk_file:
+        csv.writer(chunk_file).writerows(rows)
+    return path
+
+
+# De-dupes hostnames from several sources, remembering which sources
+# each one came from, without having to hold them all in memory.
+#
+# Each hostname's sources are kept as a bitmask (bit i for sources[i]).
+# Once more than `limit` hostnames are held, they're written out in
+# sorted order to a temporary file in `directory`, and the next ones
+# start over in memory. Iterating merges all of those sorted runs back
+# together, yielding each hostname once, in sorted order, with all of
+# its sources combined.
+class HostnameSet(object):
+
+    def __init__(self, sources, limit=1000000, directory=None):
+        self.sources = list(sources)
+        self.bits = {source: (1 << index) for index, source in enumerate(self.sources)}
+        self.limit = int(limit)
+        self.directory = directory
+
+        self.masks = {}
+        self.runs = []
+
+    def add(self, hostname, source):
+        self.masks[hostname] = self.masks.get(hostname, 0) | self.bits[source]
+        if len(self.masks) > self.limit:
+            self.spill()
+
+    # Write the hostnames held in memory to a sorted run on disk.
+    def spill(self):
+        handle, path = tempfile.mkstemp(prefix="hostnames-", suffix=".txt", dir=self.directory)
+        with os.fdopen(handle, 'w', encoding='utf-8') as run_file:
+            for hostname, mask in sorted(self.masks.items()):
+                run_file.write("%s\t%x\n" % (hostname, mask))
+
+        logging.debug("Spilled %i hostnames to %s." % (len(self.masks), path))
+        self.runs.append(path)
+        self.masks = {}
+
+    # (hostname, [sources]) for every hostname, sorted by hostname.
+    def __iter__(self):
+        run_files = [open(path, encoding='utf-8') for path in self.runs]
+        try:
+            runs = [read_run(run_file) for run_file in run_files]
+            runs.append(sorted(self.masks.items()))
+
+            current, current_mask = None, 0
+            for hostname, mask in heapq.merge(*runs):
+                if hostname != current:
+                    if current is not None:
+                        yield current, self.sources_for(current_mask)
+                    current, current_mask = hostname, 0
+                current_mask |= mask
+
+            if current is not None:
+                yield current, self.sources_for(current_mask)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def sources_for(self, mask):
+        return [source for source in self.sources if mask & self.bits[source]]
+
+    # Remove any runs spilled to disk.
+    def close(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+        self.masks = {}
+
+
+# (hostname, mask) pairs from a run written by HostnameSet.spill.
+def read_run(run_file):
+    for line in run_file:
+        hostname, mask = line.rstrip("\n").split("\t")
+        yield hostname, int(mask, 16)
+
+
 # Given a user-input domain suffix, normalize it.
 def normalize_suffix(suffix):
     if suffix is None:
@@ -409,3 +976,68 @@ def normalize_suffix(suffix):
 # Assumes suffixes always begin with a dot.
 def suffix_pattern(suffix):
     return re.compile("\\%s$" % suffix)
+
+
+# Filters hostnames down to the ones worth keeping, counting how many
+# each check drops:
+#
+# * suffix: doesn't end in one of `suffixes` (e.g. [".gov", ".fed.us"])
+# * parents: is a base domain (or www.base), unless `include_parents`
+# * whitelist: isn't under one of the `parents` base domains, if given
+#
+# Suffixes are matched a label at a time, from the right, against a
+# trie of all of them at once, and parents are kept in a set, so the
+# cost per hostname doesn't grow with the number of either.
+class HostnameFilter(object):
+
+    def __init__(self, suffixes, parents=None, include_parents=False):
+        self.suffixes = {}
+        for suffix in suffixes:
+            node = self.suffixes
+            for label in reversed(normalize_suffix(suffix).split(".")[1:]):
+                node = node.setdefault(label, {})
+            node[None] = True
+
+        self.parents = set(parents) if parents else None
+        self.include_parents = include_parents
+
+        self.kept = 0
+        self.drops = collections.OrderedDict([
+            ("suffix", 0), ("parents", 0), ("whitelist", 0)
+        ])
+
+    def allows(self, hostname):
+        if not self.has_suffix(hostname):
+            self.drops["suffix"] += 1
+            return False
+
+        if (not self.include_parents) or (self.parents is not None):
+            base = base_domain_for(hostname)
+
+            if (not self.include_parents) and ((hostname == base) or (hostname == "www.%s" % base)):
+                self.drops["parents"] += 1
+                return False
+
+            if (self.parents is not None) and (base not in self.parents):
+                self.drops["whitelist"] += 1
+                return False
+
+        self.kept += 1
+        return True
+
+    # Whether a hostname ends in one of the suffixes (with at least one
+    # label in front of it).
+    def has_suffix(self, hostname):
+        labels = hostname.split(".")
+        node = self.suffixes
+        for depth in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[depth])
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def report(self):
+        drops = ", ".join("%i by %s" % (count, name) for name, count in self.drops.items())
+        return "Kept %i hostnames, dropped %s." % (self.kept, drops)
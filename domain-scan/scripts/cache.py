@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from scanners import utils
+from scanners import cache
+
+##
+#
+# Copies cached scan data between cache backends, to migrate an
+# existing cache/ directory of per-domain JSON files into a single
+# SQLite file (or back out again).
+#
+# commands:
+#   import: copy cache/<operation>/<domain>.json files into SQLite
+#   export: copy entries from SQLite back out into files
+#
+# options:
+#   output: where the cache/ directory is (defaults to ./)
+#   cache-file: SQLite file (defaults to cache/cache.sqlite3)
+#   operations: comma-separated operations to copy (defaults to all)
+#   batch: entries per transaction when importing (defaults to 5000)
+
+
+def main():
+    options = utils.options()
+
+    if (len(options["_"]) < 1) or (options["_"][0] not in ["import", "export"]):
+        print("Specify a command: import or export.")
+        exit(1)
+    command = options["_"][0]
+
+    files = cache.backend_for("files", utils.cache_dir(), options)
+    sqlite = cache.backend_for("sqlite", utils.cache_dir(), options)
+
+    if command == "import":
+        source, destination = files, sqlite
+    else:
+        source, destination = sqlite, files
+
+    if options.get("operations"):
+        operations = options["operations"].split(",")
+    else:
+        operations = source.operations()
+
+    batch_size = int(options.get("batch", 5000))
+
+    for operation in operations:
+        print("Copying %s..." % operation)
+
+        count = 0
+        batch = []
+        for domain in source.domains(operation):
+            # Entries keep their timestamps, so --max-age still applies.
+            batch.append((source.read(domain, operation), domain, operation, source.updated(domain, operation)))
+            count += 1
+
+            if len(batch) >= batch_size:
+                write_batch(destination, batch)
+                batch = []
+                print("Processing: %i" % count)
+
+        write_batch(destination, batch)
+        print("Copied %i %s entries." % (count, operation))
+
+    destination.close()
+    source.close()
+    print("Done.")
+
+
+def write_batch(destination, batch):
+    if hasattr(destination, "write_many"):
+        destination.write_many(batch)
+    else:
+        for content, domain, operation, updated in batch:
+            destination.write(content, domain, operation, updated)
+
+
+if __name__ == '__main__':
+    main()
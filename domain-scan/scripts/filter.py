@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
 from scanners import utils
+import bz2
 import csv
+import gzip
+import mmap
+import multiprocessing
 import os
-import re
 
 ##
 #
@@ -11,15 +14,29 @@ import re
 # Expects suffixes to be able to be applied to the end of a given line.
 #
 # options:
-#   _[0]: input file (required)
+#   _[0]: input file (required), optionally gzipped (.gz) or bzipped (.bz2)
 #
 #   name: name of dataset (e.g. 'rdns', 'ct')
 #   filter: name of filter to apply (defaults to value of --name)
-#   suffix: suffix to filter on (e.g. '.gov')
+#   suffix: suffix to filter on (e.g. '.gov'), or several, comma-separated
 #   encoding: input file encoding (defaults to 'latin-1')
+#   processes: how many processes to filter with (defaults to # of CPUs)
 #
 #   max: cut off loop after this many lines
 #   debug: display output when matching each line
+#
+# Filtering is done by several processes at once. An uncompressed
+# input file is memory-mapped and split into one contiguous range
+# (ending on a newline) per process. A compressed one is decompressed
+# by the main process and handed out in chunks of lines. Each process
+# checks the raw bytes of each line for a matching suffix before
+# decoding it, and keeps its own set of unique hostnames, which are
+# combined at the end.
+#
+# --max and --debug go line by line in a single process instead.
+
+# Compressed input is handed to processes in chunks of about this size.
+chunk_size = 8 * 1024 * 1024
 
 
 def main():
@@ -30,8 +47,7 @@ def main():
 
     name = options.get('name', 'hostnames')
     filter_name = options.get('filter', name)
-    filter = filters.get(filter_name, None)
-    if filter is None:
+    if filters.get(filter_name, None) is None:
         print("No filter by that name. Specify one with --filter.")
         exit(1)
 
@@ -54,33 +70,97 @@ def main():
         print("Input file doesn't exist.")
         exit(1)
 
-    suffix = options.get("suffix", ".gov")
-
-    # if it has a ., make sure the . is escaped
-    if suffix.startswith("."):
-        suffix = "\\%s" % suffix
-    pattern = re.compile("%s\n?$" % suffix)
+    suffixes = options.get("suffix", ".gov").split(",")
 
     max = int(options.get("max", -1))
+    processes = int(options.get("processes", multiprocessing.cpu_count()))
 
     # Proceed
 
+    settings = (filter_name, suffixes, encoding)
+
+    if debug or (max > 0):
+        matched, missed, names = filter_serially(input_filename, settings, max, debug)
+    elif compression_for(input_filename):
+        matched, missed, names = filter_stream(input_filename, settings, processes)
+    else:
+        matched, missed, names = filter_mapped(input_filename, settings, processes)
+
+    hostnames = list(names)
+    hostnames.sort()
+
+    print("Matched %i (%i unique), missed on %i." % (matched, len(hostnames), missed))
+
+    print("Writing out CSV.")
+    for hostname in hostnames:
+        out_writer.writerow([hostname])
+    out_file.close()
+
+    print("Done.")
+
+
+# Split an uncompressed file into one range per process, each ending
+# on a line boundary, and filter the ranges in parallel.
+def filter_mapped(input_filename, settings, processes):
+    size = os.path.getsize(input_filename)
+    if size == 0:
+        return 0, 0, set()
+
+    boundaries = [0]
+    with open(input_filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for index in range(1, processes):
+                newline = mapped.find(b"\n", (size * index) // processes)
+                boundary = (newline + 1) if newline >= 0 else size
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+
+    ranges = [
+        (input_filename, start, end, settings)
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
+
+    print("Filtering %i bytes in %i ranges." % (size, len(ranges)))
+    with multiprocessing.Pool(len(ranges)) as pool:
+        return combine(pool.imap_unordered(filter_range, ranges), every=1)
+
+
+# Decompress a file in the main process, and filter chunks of it in
+# parallel.
+def filter_stream(input_filename, settings, processes):
+    with multiprocessing.Pool(processes) as pool:
+        tasks = ((chunk, settings) for chunk in chunks_of(input_filename))
+        return combine(pool.imap_unordered(filter_chunk, tasks), every=100)
+
+
+# Filter a file line by line, for --max and --debug.
+def filter_serially(input_filename, settings, max, debug):
+    filter_name, suffixes, encoding = settings
+    line_filter = filters[filter_name]
+    hostname_filter = utils.HostnameFilter(suffixes, include_parents=True)
+
     missed = 0
     matched = 0
-    name_map = {}
+    names = set()
     curr = 0
 
-    with open(input_filename, encoding=encoding) as f:
-
+    with open_input(input_filename) as f:
         try:
             for line in f:
+                # Blank lines aren't counted as misses (see filter_lines).
+                blank = not line.rstrip()
+                line = line.decode(encoding)
 
-                if pattern.search(line):
-                    hostname = filter(line)
+                if blank:
+                    pass
+                elif hostname_filter.allows(line.rstrip()):
+                    hostname = line_filter(line)
                     if debug:
                         print("Match!!!! %s" % hostname)
                     matched += 1
-                    name_map[hostname] = None
+                    names.add(hostname)
                 else:
                     if debug:
                         print("Didn't match: %s" % line.strip())
@@ -93,21 +173,114 @@ def main():
 
                 if (curr % 1000000) == 0:
                     print("Processing: %i" % curr)
-        except UnicodeDecodeError as e:
+        except UnicodeDecodeError:
             print(curr)
             print(utils.format_last_exception())
             exit(1)
 
-    hostnames = list(name_map.keys())
-    hostnames.sort()
+    return matched, missed, names
 
-    print("Matched %i (%i unique), missed on %i." % (matched, len(hostnames), missed))
 
-    print("Writing out CSV.")
-    for hostname in hostnames:
-        out_writer.writerow([hostname])
+# Add up (matched, missed, names) results from each process, showing
+# progress after `every` results.
+def combine(results, every):
+    matched, missed, names = 0, 0, set()
+    for index, (chunk_matched, chunk_missed, chunk_names) in enumerate(results, 1):
+        matched += chunk_matched
+        missed += chunk_missed
+        names.update(chunk_names)
+        if (index % every) == 0:
+            print("Processing: %i" % (matched + missed))
+    return matched, missed, names
+
+
+# Run in each process: filter one range of a memory-mapped file.
+def filter_range(task):
+    input_filename, start, end, settings = task
+
+    with open(input_filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return filter_lines(lines_in_range(mapped, start, end), settings)
+
+
+# Run in each process: filter one chunk of lines.
+def filter_chunk(task):
+    chunk, settings = task
+    return filter_lines(chunk.split(b"\n"), settings)
+
+
+# Lines (as bytes) from part of a memory-mapped file, read a chunk at
+# a time rather than copying the whole range into memory at once.
+def lines_in_range(mapped, start, end):
+    position = start
+    while position < end:
+        chunk_end = min(position + chunk_size, end)
+        if chunk_end < end:
+            newline = mapped.find(b"\n", chunk_end, end)
+            chunk_end = (newline + 1) if newline >= 0 else end
+
+        for line in mapped[position:chunk_end].split(b"\n"):
+            yield line
+        position = chunk_end
+
+
+# Chunks of whole lines from a (possibly compressed) file.
+def chunks_of(input_filename):
+    with open_input(input_filename) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk + f.readline()
+
+
+# Lines are checked against the suffixes (as bytes) before they're
+# decoded, and only the few that end in one get decoded and run
+# through the full hostname filter.
+#
+# Blank lines are skipped without counting them as misses: splitting
+# the input into ranges and chunks leaves empty pieces at their ends.
+def filter_lines(lines, settings):
+    filter_name, suffixes, encoding = settings
+    line_filter = filters[filter_name]
+    hostname_filter = utils.HostnameFilter(suffixes, include_parents=True)
+    suffix_bytes = tuple(utils.normalize_suffix(suffix).encode(encoding) for suffix in suffixes)
+
+    matched, missed = 0, 0
+    names = set()
+
+    for line in lines:
+        line = line.rstrip()
+        if not line:
+            continue
+
+        if line.endswith(suffix_bytes):
+            line = line.decode(encoding)
+            if hostname_filter.allows(line):
+                matched += 1
+                names.add(line_filter(line))
+                continue
+
+        missed += 1
+
+    return matched, missed, names
+
+
+def compression_for(input_filename):
+    if input_filename.endswith(".gz"):
+        return gzip
+    elif input_filename.endswith(".bz2"):
+        return bz2
+    return None
+
+
+# Open a (possibly compressed) input file for reading bytes.
+def open_input(input_filename):
+    compression = compression_for(input_filename)
+    if compression:
+        return compression.open(input_filename, 'rb')
+    return open(input_filename, 'rb')
 
-    print("Done.")
 
 # Format-specific filters
 
@@ -120,4 +293,5 @@ def filter_ip_pair(line):
 
 filters = {'ip_pair': filter_ip_pair}
 
-main()
+if __name__ == '__main__':
+    main()
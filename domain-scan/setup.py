@@ -19,7 +19,7 @@ setup(
         'ipython',
         'requests',
         'strict-rfc3339',
-        'sslyze',
+        'sslyze>=1.1,<1.4',
         'cryptography',
         'censys',
         'six'
@@ -0,0 +1,1130 @@
+import asyncio
+import collections
+import csv
+import datetime
+import gzip
+import importlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from importlib.machinery import SourceFileLoader
+from unittest import mock
+
+from scanners import cache, psl, pshtt, starttls, utils
+
+
+class ResultWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'results', 'out.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.filename, newline='') as f:
+            return list(csv.reader(f))
+
+    def test_writes_header_and_rows(self):
+        writer = utils.ResultWriter(self.filename, ['Domain', 'Value'])
+        writer.writerow(['a.gov', '1'])
+        writer.writerows([['b.gov', '2'], ['c.gov', '3']])
+        writer.close()
+
+        self.assertEqual(writer.rows, 3)
+        self.assertEqual(self.read(), [
+            ['Domain', 'Value'], ['a.gov', '1'], ['b.gov', '2'], ['c.gov', '3']
+        ])
+
+    def test_concurrent_rows_stay_whole(self):
+        writer = utils.ResultWriter(self.filename, ['Domain', 'Value'], flush_interval=0.01)
+
+        def write(i):
+            writer.writerows([['%i.gov' % i, 'x' * 500, str(n)] for n in range(3)])
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(write, range(500)))
+        writer.close()
+
+        rows = self.read()[1:]
+        self.assertEqual(writer.rows, 1500)
+        self.assertEqual(len(rows), 1500)
+        for i in range(0, 1500, 3):
+            # each domain's rows were written together, in order
+            self.assertEqual([row[2] for row in rows[i:i + 3]], ['0', '1', '2'])
+            self.assertEqual(len(set(row[0] for row in rows[i:i + 3])), 1)
+
+    def test_zero_flush_interval_waits_for_rows(self):
+        writer = utils.ResultWriter(self.filename, ['Domain', 'Value'], flush_interval=0)
+        self.assertEqual(writer.flush_interval, 0.1)
+
+        # the writer thread blocks on the queue rather than spinning
+        with mock.patch.object(writer.queue, 'get', wraps=writer.queue.get) as get:
+            time.sleep(0.5)
+            self.assertLess(get.call_count, 10)
+
+        writer.writerow(['a.gov', '1'])
+        writer.close()
+        self.assertEqual(self.read(), [['Domain', 'Value'], ['a.gov', '1']])
+
+
+class PshttIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(utils, 'cache_store', cache.FileCache(self.dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        utils.pshtt_index.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        utils.pshtt_index.clear()
+
+    def cache(self, domain, data):
+        utils.cache_write(utils.json_for(data), domain, "pshtt")
+
+    def pshtt(self, canonical, live=True, redirect=False, https_live=True):
+        return [{
+            'Canonical URL': canonical,
+            'Live': live,
+            'Redirect': redirect,
+            'Redirect To': None,
+            'endpoints': {
+                'https': {'live': https_live, 'https_bad_hostname': False},
+                'httpswww': {'live': False},
+            }
+        }]
+
+    def test_helpers_read_the_index(self):
+        self.cache('a.gov', self.pshtt('https://www.a.gov'))
+        self.cache('b.gov', self.pshtt('http://b.gov', https_live=False, redirect=True))
+
+        self.assertTrue(utils.domain_uses_www('a.gov'))
+        self.assertFalse(utils.domain_doesnt_support_https('a.gov'))
+        self.assertTrue(utils.domain_doesnt_support_https('b.gov'))
+        self.assertTrue(utils.domain_is_redirect('b.gov'))
+        self.assertEqual(utils.domain_canonical('b.gov'), 'http://b.gov')
+        self.assertFalse(utils.domain_not_live('b.gov'))
+
+    def test_parsed_once(self):
+        self.cache('a.gov', self.pshtt('https://a.gov'))
+
+        with mock.patch.object(utils, 'data_for', wraps=utils.data_for) as data_for:
+            utils.domain_not_live('a.gov')
+            utils.domain_is_redirect('a.gov')
+            utils.domain_canonical('a.gov')
+            self.assertEqual(data_for.call_count, 1)
+
+    def test_missing_and_invalid(self):
+        self.assertFalse(utils.domain_canonical('missing.gov'))
+        self.assertNotIn('missing.gov', utils.pshtt_index)
+
+        utils.cache_write(utils.invalid({}), 'bad.gov', "pshtt")
+        self.assertFalse(utils.domain_not_live('bad.gov'))
+        self.assertIs(utils.pshtt_index['bad.gov'], False)
+
+    def test_scan_batch(self):
+        results = []
+        for domain in ['a.gov', 'b.gov']:
+            result = self.pshtt('https://%s' % domain)[0]
+            result['Domain'] = domain
+            result.update({header: False for header in pshtt.headers if header not in result})
+            results.append(result)
+        self.cache('c.gov', [dict(results[0], Domain='c.gov')])
+
+        raw = utils.json_for(results)
+        with mock.patch.object(utils, 'scan', return_value=raw) as scan:
+            rows = dict(pshtt.scan_batch(['a.gov', 'b.gov', 'c.gov', 'd.gov'], {}))
+
+        # one run of pshtt, for the uncached domains
+        scan.assert_called_once()
+        self.assertEqual(scan.call_args[0][0][1:4], ['a.gov', 'b.gov', 'd.gov'])
+
+        self.assertEqual(rows['b.gov'][0][0], 'https://b.gov')
+        self.assertEqual(len(rows['c.gov']), 1)
+        self.assertEqual(rows['d.gov'], [])
+        self.assertEqual(utils.data_for('b.gov', 'pshtt')[0]['Domain'], 'b.gov')
+        self.assertIsNone(utils.data_for('d.gov', 'pshtt'))
+
+    def test_eviction(self):
+        with mock.patch.object(utils, 'pshtt_index_size', 2):
+            for domain in ['a.gov', 'b.gov', 'c.gov']:
+                utils.index_pshtt(domain, self.pshtt('https://%s' % domain))
+            self.assertEqual(list(utils.pshtt_index.keys()), ['b.gov', 'c.gov'])
+
+    def test_preload(self):
+        self.cache('a.gov', self.pshtt('https://a.gov'))
+        self.cache('b.gov', self.pshtt('https://b.gov'))
+
+        self.assertEqual(utils.preload_pshtt_index(), 2)
+        self.assertEqual(utils.pshtt_index['b.gov']['Canonical URL'], 'https://b.gov')
+
+
+class CacheBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_backend(self, backend):
+        self.assertFalse(backend.exists('a.gov', 'pshtt'))
+        self.assertIsNone(backend.read('a.gov', 'pshtt'))
+
+        backend.write('{"a": 1}', 'a.gov', 'pshtt')
+        backend.write('{"b": 1}', 'b.gov', 'pshtt')
+        backend.write(utils.invalid({}), 'a.gov', 'sslyze')
+        backend.write('{"a": 2}', 'a.gov', 'pshtt')
+
+        self.assertTrue(backend.exists('a.gov', 'pshtt'))
+        self.assertEqual(cache.decode(backend.read('a.gov', 'pshtt')), {'a': 2})
+        self.assertEqual(sorted(backend.domains('pshtt')), ['a.gov', 'b.gov'])
+        self.assertEqual(backend.operations(), ['pshtt', 'sslyze'])
+
+    def test_files(self):
+        backend = cache.FileCache(self.dir)
+        self.check_backend(backend)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'pshtt', 'a.gov.json')))
+
+    def test_sqlite(self):
+        filename = os.path.join(self.dir, 'cache.sqlite3')
+        backend = cache.SqliteCache(filename, batch_size=1000, batch_interval=1000)
+        self.check_backend(backend)
+
+        # nothing committed yet, so a second connection doesn't see it
+        other = cache.SqliteCache(filename)
+        self.assertIsNone(other.read('a.gov', 'pshtt'))
+
+        backend.flush()
+        self.assertEqual(cache.decode(other.read('a.gov', 'pshtt')), {'a': 2})
+        other.close()
+        backend.close()
+
+    def test_sqlite_commits_in_batches(self):
+        backend = cache.SqliteCache(os.path.join(self.dir, 'cache.sqlite3'), batch_size=2, batch_interval=1000)
+        backend.write('1', 'a.gov', 'pshtt')
+        self.assertEqual(backend.pending, 1)
+        backend.write('2', 'b.gov', 'pshtt')
+        self.assertEqual(backend.pending, 0)
+        backend.close()
+
+    def test_sqlite_commits_when_writes_stop(self):
+        filename = os.path.join(self.dir, 'cache.sqlite3')
+        backend = cache.SqliteCache(filename, batch_size=1000, batch_interval=0.1)
+        backend.write('1', 'a.gov', 'pshtt')
+        time.sleep(0.5)
+        self.assertEqual(backend.pending, 0)
+
+        # the write lock's been given up, for other processes to write
+        other = cache.SqliteCache(filename, batch_size=1)
+        other.connection.execute("PRAGMA busy_timeout = 0")
+        other.write('2', 'b.gov', 'pshtt')
+        self.assertEqual(other.read('a.gov', 'pshtt'), '1')
+        other.close()
+        backend.close()
+
+    def test_sqlite_shards_commit_each_write(self):
+        backend = cache.backend_for('sqlite', self.dir, {'shard': '0/2'})
+        self.assertEqual(backend.batch_size, 1)
+        backend.close()
+
+
+def installed(module):
+    try:
+        importlib.import_module(module)
+        return True
+    except ImportError:
+        return False
+
+
+class CacheCodecTestCase(unittest.TestCase):
+    data = {
+        'accepted_targets': [{'name': 'a.gov', 'ciphers': ['ECDHE-RSA-AES128-GCM-SHA256'] * 3}],
+        'when': datetime.datetime(2017, 1, 2, 3, 4, 5),
+        'invalid': False,
+    }
+    decoded = dict(data, when='2017-01-02T03:04:05')
+
+    def round_trip(self, codec):
+        encoded = cache.encode(self.data, codec, default=utils.format_datetime)
+        self.assertEqual(cache.decode(encoded), self.decoded)
+        if isinstance(encoded, str):
+            encoded = encoded.encode('utf-8')
+        self.assertEqual(cache.decode(encoded), self.decoded)
+        return encoded
+
+    def test_json(self):
+        self.assertEqual(self.round_trip('json'), utils.json_for(self.data).encode('utf-8'))
+
+    def test_compact_is_smaller(self):
+        self.assertLess(len(self.round_trip('compact')), len(self.round_trip('json')))
+
+    @unittest.skipUnless(installed('msgpack'), 'msgpack not installed')
+    def test_msgpack(self):
+        self.round_trip('msgpack')
+
+    @unittest.skipUnless(installed('zstandard'), 'zstandard not installed')
+    def test_zstd(self):
+        self.assertTrue(self.round_trip('zstd').startswith(cache.zstd_magic))
+
+    def test_codecs_for(self):
+        self.assertEqual(cache.codecs_for(None), ('json', {}))
+        self.assertEqual(
+            cache.codecs_for('compact,sslyze:zstd,third_parties:msgpack'),
+            ('compact', {'sslyze': 'zstd', 'third_parties': 'msgpack'})
+        )
+        with self.assertRaises(ValueError):
+            cache.codecs_for('sslyze:gzip')
+
+    def test_check_codecs(self):
+        self.assertEqual(cache.check_codecs('compact'), ('compact', {}))
+        with self.assertRaises(ValueError):
+            cache.check_codecs('gzip')
+
+        # a codec whose package is missing is caught up front
+        with mock.patch.dict(sys.modules, {'zstandard': None}):
+            with self.assertRaises(ImportError):
+                cache.check_codecs('compact,sslyze:zstd')
+            self.assertEqual(cache.check_codecs('compact,pshtt:json'), ('compact', {'pshtt': 'json'}))
+
+    def test_cache_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        with mock.patch.object(utils, 'cache_store', cache.FileCache(directory)), \
+                mock.patch.object(utils, 'cache_codecs', ('compact', {})):
+            utils.cache_save({'a': [1, 2]}, 'a.gov', 'pshtt')
+            utils.cache_invalid('b.gov', 'pshtt')
+
+            self.assertEqual(utils.cache_load('a.gov', 'pshtt'), {'a': [1, 2]})
+            self.assertIsNone(utils.cache_load('c.gov', 'pshtt'))
+            self.assertIsNone(utils.data_for('b.gov', 'pshtt'))
+            self.assertEqual(utils.data_for('c.gov', 'pshtt'), {})
+
+
+class CacheExpiryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_max_ages_for(self):
+        self.assertEqual(cache.max_ages_for(None), (None, {}))
+        self.assertEqual(
+            cache.max_ages_for('30d,pshtt:7d,sslyze:12h'),
+            (30 * 86400, {'pshtt': 7 * 86400, 'sslyze': 12 * 3600})
+        )
+        self.assertEqual(cache.seconds_for('2w'), 14 * 86400)
+        for bad in ['7', 'd', '7y', 'pshtt:x']:
+            with self.assertRaises(ValueError):
+                cache.max_ages_for(bad)
+
+    def test_expired(self):
+        self.assertFalse(cache.expired(None, None))
+        self.assertTrue(cache.expired(None, 60))
+        self.assertFalse(cache.expired(1000, 60, now=1060))
+        self.assertTrue(cache.expired(1000, 60, now=1061))
+
+    def check_updated(self, backend):
+        self.assertIsNone(backend.updated('a.gov', 'pshtt'))
+        backend.write('{}', 'a.gov', 'pshtt', updated=1000)
+        self.assertEqual(backend.updated('a.gov', 'pshtt'), 1000)
+        backend.write('{}', 'a.gov', 'pshtt')
+        self.assertGreater(backend.updated('a.gov', 'pshtt'), 1000)
+
+    def test_files(self):
+        self.check_updated(cache.FileCache(self.dir))
+
+    def test_sqlite(self):
+        backend = cache.SqliteCache(os.path.join(self.dir, 'cache.sqlite3'))
+        self.check_updated(backend)
+        backend.write_many([('{}', 'b.gov', 'pshtt', 2000), ('{}', 'c.gov', 'pshtt')])
+        self.assertEqual(backend.updated('b.gov', 'pshtt'), 2000)
+        self.assertIsNotNone(backend.updated('c.gov', 'pshtt'))
+        backend.close()
+
+    def test_sqlite_without_timestamps(self):
+        filename = os.path.join(self.dir, 'cache.sqlite3')
+        connection = sqlite3.connect(filename)
+        connection.execute(
+            "CREATE TABLE cache (operation TEXT NOT NULL, domain TEXT NOT NULL, "
+            "content TEXT, PRIMARY KEY (operation, domain))")
+        connection.execute("INSERT INTO cache VALUES ('pshtt', 'a.gov', '{}')")
+        connection.commit()
+        connection.close()
+
+        backend = cache.SqliteCache(filename)
+        self.assertEqual(cache.decode(backend.read('a.gov', 'pshtt')), {})
+        self.assertIsNone(backend.updated('a.gov', 'pshtt'))
+        backend.close()
+
+    def test_cache_fresh(self):
+        backend = cache.FileCache(self.dir)
+        stale = set()
+
+        with mock.patch.object(utils, 'cache_store', backend), \
+                mock.patch.object(utils, 'cache_max_ages', (None, {'pshtt': 60})), \
+                mock.patch.object(utils, 'cache_stale', stale):
+            utils.cache_save({'a': 1}, 'a.gov', 'pshtt')
+            utils.cache_save({'a': 1}, 'a.gov', 'sslyze')
+            self.assertEqual(utils.cache_fresh('a.gov', 'pshtt', {}), {'a': 1})
+            self.assertIsNone(utils.cache_fresh('a.gov', 'pshtt', {'force': True}))
+            self.assertIsNone(utils.cache_fresh('b.gov', 'pshtt', {}))
+
+            old = time.time() - 120
+            os.utime(backend.path('a.gov', 'pshtt'), (old, old))
+            os.utime(backend.path('a.gov', 'sslyze'), (old, old))
+
+            self.assertIsNone(utils.cache_fresh('a.gov', 'pshtt', {}))
+            self.assertEqual(utils.cache_fresh('a.gov', 'sslyze', {}), {'a': 1})
+            self.assertEqual(stale, set())
+
+            options = {'stale-while-revalidate': True}
+            self.assertEqual(utils.cache_fresh('a.gov', 'pshtt', options), {'a': 1})
+            self.assertEqual(stale, {('a.gov', 'pshtt')})
+
+
+class SortCsvTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'tls.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rows):
+        with open(self.filename, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    def read(self):
+        with open(self.filename, newline='') as f:
+            return list(csv.reader(f))
+
+    def test_sorts_and_keeps_duplicates(self):
+        rows = [
+            ['c.gov', '1'], ['a.gov', '1'], ['b.gov', '1'], ['a.gov', '2'],
+            ['c.gov', '2'], ['a.gov', '3'], ['b.gov', '2'],
+        ]
+        header = ['Domain', 'Endpoint']
+        expected = [header] + sorted(rows)
+
+        # one chunk, several chunks, and a chunk per row
+        for chunk_size in [100, 3, 1]:
+            self.write([header] + rows)
+            utils.sort_csv(self.filename, chunk_size=chunk_size)
+            self.assertEqual(self.read(), expected)
+            self.assertEqual(os.listdir(self.dir), ['tls.csv'])
+
+    def test_header_only(self):
+        self.write([['Domain', 'Endpoint']])
+        utils.sort_csv(self.filename, chunk_size=2)
+        self.assertEqual(self.read(), [['Domain', 'Endpoint']])
+
+
+class HostnameSetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def gather(self, limit):
+        hostnames = utils.HostnameSet(['censys', 'rdns', 'ct'], limit=limit, directory=self.dir)
+        for name in ['c', 'a', 'b', 'a', 'd']:
+            hostnames.add('%s.gov' % name, 'censys')
+        for name in ['b', 'e', 'a', 'b']:
+            hostnames.add('%s.gov' % name, 'rdns')
+        for name in ['e', 'a']:
+            hostnames.add('%s.gov' % name, 'ct')
+        return hostnames
+
+    def test_merges_sources_in_order(self):
+        expected = [
+            ('a.gov', ['censys', 'rdns', 'ct']),
+            ('b.gov', ['censys', 'rdns']),
+            ('c.gov', ['censys']),
+            ('d.gov', ['censys']),
+            ('e.gov', ['rdns', 'ct']),
+        ]
+
+        for limit in [100, 2, 1]:
+            hostnames = self.gather(limit)
+            if limit < 5:
+                self.assertGreater(len(hostnames.runs), 1)
+            self.assertEqual(list(hostnames), expected)
+
+            hostnames.close()
+            self.assertEqual(os.listdir(self.dir), [])
+
+
+class HostnameFilterTestCase(unittest.TestCase):
+
+    def test_suffixes(self):
+        hostname_filter = utils.HostnameFilter(['.gov', 'fed.us'], include_parents=True)
+        for hostname in ['a.gov', 'www.a.gov', 'b.fed.us', 'x.b.fed.us']:
+            self.assertTrue(hostname_filter.allows(hostname), hostname)
+        for hostname in ['gov', 'a.xgov', 'a.gov.uk', 'fed.us', 'a.us', '']:
+            self.assertFalse(hostname_filter.allows(hostname), hostname)
+        self.assertEqual(hostname_filter.kept, 4)
+        self.assertEqual(hostname_filter.drops['suffix'], 6)
+
+    def test_parents_and_whitelist(self):
+        hostname_filter = utils.HostnameFilter(['.gov'], parents=['a.gov', 'b.gov'])
+        results = [
+            hostname_filter.allows(hostname) for hostname in
+            ['x.a.gov', 'a.gov', 'www.b.gov', 'y.b.gov', 'x.c.gov', 'x.a.mil']
+        ]
+        self.assertEqual(results, [True, False, False, True, False, False])
+        self.assertEqual(dict(hostname_filter.drops), {'suffix': 1, 'parents': 2, 'whitelist': 1})
+        self.assertEqual(hostname_filter.report(), 'Kept 2 hostnames, dropped 1 by suffix, 2 by parents, 1 by whitelist.')
+
+
+class PublicSuffixTestCase(unittest.TestCase):
+
+    def test_rules(self):
+        suffix_list = psl.SuffixList(psl.rules_from([
+            '// comment', '', 'gov', 'us', 'fed.us', 'k12.ca.us', '*.ck', '!www.ck',
+            '// ===BEGIN PRIVATE DOMAINS===', 'github.io',
+        ]))
+        expected = {
+            'gsa.gov': 'gsa.gov',
+            'www.18f.gsa.gov': 'gsa.gov',
+            'gov': 'gov',
+            'www.agency.fed.us': 'agency.fed.us',
+            'a.b.sd.k12.ca.us': 'sd.k12.ca.us',
+            'a.b.c.ck': 'b.c.ck',
+            'a.www.ck': 'www.ck',
+            'x.y.github.io': 'github.io',
+            'x.y.unlisted': 'y.unlisted',
+            'WWW.GSA.GOV.': 'GSA.GOV',
+        }
+        for hostname, base in expected.items():
+            self.assertEqual(suffix_list.base_domain_for(hostname), base, hostname)
+
+    def test_bundled_list(self):
+        self.assertEqual(utils.base_domain_for('www.sd.k12.ca.us'), 'sd.k12.ca.us')
+        self.assertEqual(utils.base_domain_for('www.agency.fed.us'), 'agency.fed.us')
+        self.assertEqual(utils.base_domain_for('x.y.github.io'), 'github.io')
+        self.assertEqual(
+            utils.base_domains_for(['a.gsa.gov', 'b.co.uk', 'a.gsa.gov']),
+            ['gsa.gov', 'b.co.uk', 'gsa.gov']
+        )
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = utils.TokenBucket(20, burst=3)
+        started = time.monotonic()
+        for i in range(3):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - started, 0.04)
+
+        # the next 4 wait for tokens at 20/s
+        for i in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+    def test_shared_between_threads(self):
+        bucket = utils.TokenBucket(50, burst=1)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(lambda i: bucket.acquire(), range(11)))
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+
+class ParallelBatchesTestCase(unittest.TestCase):
+
+    # Produces batches forever, so it's left blocked on the full queue
+    # unless it's told to stop.
+    def endless(self):
+        while True:
+            yield ['name']
+
+    def failing(self):
+        yield ['first']
+        time.sleep(0.2)
+        raise ValueError("bad file")
+
+    def test_error_stops_the_others(self):
+        producers = [self.endless, self.endless, self.failing]
+        started = time.monotonic()
+        with self.assertRaises(ValueError):
+            for batch in utils.parallel_batches(producers, 3, queue_size=2):
+                time.sleep(0.01)
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_consumer_stops_early(self):
+        batches = utils.parallel_batches([self.endless, self.endless], 2, queue_size=2)
+        self.assertEqual(next(batches), ['name'])
+
+        started = time.monotonic()
+        batches.close()
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_all_batches(self):
+        producers = [lambda i=i: [[i, 'a'], [i, 'b']] for i in range(5)]
+        batches = list(utils.parallel_batches(producers, 2))
+        self.assertEqual(sorted(batches), sorted([i, x] for i in range(5) for x in 'ab'))
+
+
+# The `scan` (or `gather`) script, loaded as a module, with its output in `dir`.
+def load_scan(dir, name='scan'):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    with mock.patch.object(sys, 'argv', [name, '--output=%s' % dir]):
+        return SourceFileLoader(name, path).load_module()
+
+
+class ScanScriptTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.argv = mock.patch.object(sys, 'argv', ['scan', '--output=%s' % self.dir])
+        self.argv.start()
+        self.scan = load_scan(self.dir)
+
+    def tearDown(self):
+        self.argv.stop()
+        shutil.rmtree(self.dir)
+
+    def write_csv(self, name, rows):
+        with open(os.path.join(self.dir, 'results', name), 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    def scan_domains(self, scanners, domains, **options):
+        path = os.path.join(self.dir, 'domains.csv')
+        with open(path, 'w', newline='') as f:
+            csv.writer(f).writerows([['Domain']] + [[domain] for domain in domains])
+        with mock.patch.dict(self.scan.options, options):
+            self.scan.scan_domains(scanners, path)
+
+    def results(self, name):
+        with open(os.path.join(self.dir, 'results', '%s.csv' % name), newline='') as f:
+            return sorted(tuple(row) for row in list(csv.reader(f))[1:])
+
+
+class ShardTestCase(ScanScriptTestCase):
+
+    def test_shard_of_is_stable(self):
+        # The same in every process, unlike hash(): these are fixed.
+        self.assertEqual(self.scan.shard_of('example.gov', 4), 3)
+        self.assertEqual(self.scan.shard_of('18f.gov', 4), 2)
+
+        domains = ['%i.gov' % i for i in range(1000)]
+        shards = [self.scan.shard_of(domain, 4) for domain in domains]
+        self.assertEqual(shards, [self.scan.shard_of(domain, 4) for domain in domains])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+    def test_merge_shards(self):
+        scanner = mock.Mock(headers=['Value'])
+        scanner.__name__ = 'scanners.fake'
+        self.write_csv('fake.shard-0-of-2.csv', [['Domain', 'Base Domain', 'Value'], ['a.gov', 'a.gov', '1']])
+        self.write_csv('fake.shard-1-of-2.csv', [['Domain', 'Base Domain', 'Value'], ['b.gov', 'b.gov', '2']])
+        with open(os.path.join(self.dir, 'results', 'meta.shard-0-of-2.json'), 'w') as f:
+            f.write('{"start_time": "2017-01-01", "end_time": "2017-01-03"}')
+        with open(os.path.join(self.dir, 'results', 'meta.shard-1-of-2.json'), 'w') as f:
+            f.write('{"start_time": "2017-01-02", "end_time": "2017-01-04"}')
+
+        with mock.patch.object(self.scan.utils, 'utc_timestamp', return_value='2017-01-02'):
+            self.scan.merge_shards([scanner], 2)
+
+        with open(os.path.join(self.dir, 'results', 'fake.csv'), newline='') as f:
+            self.assertEqual(list(csv.reader(f)), [
+                ['Domain', 'Base Domain', 'Value'], ['a.gov', 'a.gov', '1'], ['b.gov', 'b.gov', '2']
+            ])
+        with open(os.path.join(self.dir, 'results', 'meta.json')) as f:
+            meta = json.loads(f.read())
+        self.assertEqual((meta['start_time'], meta['end_time'], meta['shards']), ('2017-01-01', '2017-01-04', 2))
+
+    def test_processes_clear_preload_cache_once(self):
+        preload = os.path.join(self.dir, 'preload-list.json')
+        open(preload, 'w').close()
+
+        options = {'scan': 'pshtt', 'engine': 'library', 'processes': '2'}
+        with mock.patch.dict(self.scan.options, options), \
+                mock.patch.object(pshtt, 'preload_cache', preload), \
+                mock.patch.object(pshtt, 'pshtt_module'), \
+                mock.patch.object(self.scan, 'run_processes') as run_processes, \
+                mock.patch.object(self.scan, 'merge_shards'):
+            self.scan.run_scan('domains.csv', None)
+
+        self.assertFalse(os.path.exists(preload))
+        run_processes.assert_called_once_with('domains.csv', 2)
+
+
+class GatherTestCase(ScanScriptTestCase):
+
+    def test_several_suffixes(self):
+        gather = load_scan(self.dir, 'gather')
+        found = ['a.agency.gov', 'b.agency.fed.us', 'c.agency.com']
+        searched = []
+
+        def search(suffix, options, extra):
+            searched.append(suffix)
+            return [name for name in found if name.endswith(suffix)]
+
+        searcher = fake_scanner('searcher', gather=search, queries_by_suffix=lambda options: True)
+        lister = fake_scanner('lister', gather=mock.Mock(return_value=found))
+        with mock.patch.dict(sys.modules, {'gatherers.searcher': searcher, 'gatherers.lister': lister}):
+            gather.run({'_': ['searcher,lister'], 'suffix': 'gov, .fed.us'})
+
+        self.assertEqual(searched, ['.gov', '.fed.us'])
+        self.assertEqual(lister.gather.call_count, 1)
+        with open(os.path.join(self.dir, 'results', 'gathered.csv'), newline='') as f:
+            self.assertEqual(list(csv.reader(f)), [
+                ['Domain', 'Base Domain', 'searcher', 'lister'],
+                ['a.agency.gov', 'agency.gov', 'True', 'True'],
+                ['b.agency.fed.us', 'agency.fed.us', 'True', 'True']
+            ])
+
+
+class SinceGatheredTestCase(ScanScriptTestCase):
+
+    def gathered(self, name, domains):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', newline='') as f:
+            csv.writer(f).writerows([['Domain']] + [[domain] for domain in domains])
+        return path
+
+    def test_uncached_domains_with_results_are_carried(self):
+        # starttls caches nothing, so only its results say what's been scanned.
+        for scanner in (pshtt, starttls):
+            rows = [['%s.gov' % x, '%s.gov' % x] + [''] * len(scanner.headers) for x in 'ab']
+            self.write_csv('%s.csv' % self.scan.scanner_name(scanner), [['Domain', 'Base Domain'] + scanner.headers] + rows)
+
+        updated = {('a.gov', 'pshtt'): time.time(), ('b.gov', 'pshtt'): time.time() - 3 * 86400}
+        previous = self.gathered('previous.csv', ['a.gov', 'b.gov', 'c.gov'])
+        current = self.gathered('current.csv', ['a.gov', 'b.gov', 'c.gov', 'd.gov'])
+
+        with mock.patch.object(utils, 'cache_max_ages', (86400, {})), \
+                mock.patch.object(utils, 'cache_updated', side_effect=lambda *key: updated.get(key)):
+            domains, carried = self.scan.since_gathered([pshtt, starttls], current, previous)
+        shutil.rmtree(carried['dir'])
+
+        # b.gov's pshtt data is too old; c.gov has neither a cache entry nor results.
+        self.assertEqual(carried['domains'], {'a.gov'})
+        self.assertEqual(list(self.scan.gathered_from(domains)), ['b.gov', 'c.gov', 'd.gov'])
+
+
+# A stand-in scanner module for `scan`, with the given attributes.
+def fake_scanner(name, **attributes):
+    scanner = types.ModuleType('scanners.%s' % name)
+    scanner.headers = ['Value']
+    for key, value in attributes.items():
+        setattr(scanner, key, value)
+    return scanner
+
+
+class FilterScriptTestCase(unittest.TestCase):
+
+    lines = [
+        '1.2.3.4,a.agency.gov', '1.2.3.5,b.agency.gov', '', '1.2.3.4,a.agency.gov',
+        '1.2.3.6,x.example.com', '   ', '1.2.3.7,c.agency.fed.us', '1.2.3.8,notgov', '1.2.3.9,d.agency.gov'
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, opener=open):
+        path = os.path.join(self.dir, name)
+        with opener(path, 'wb') as f:
+            f.write(('\n'.join(self.lines * 20)).encode('latin-1'))
+        return path
+
+    def test_modes_agree(self):
+        from scripts import filter as filter_script
+        settings = ('ip_pair', ['.gov', '.fed.us'], 'latin-1')
+        expected = (100, 40, {'a.agency.gov', 'b.agency.gov', 'c.agency.fed.us', 'd.agency.gov'})
+
+        plain = self.write('rdns.csv')
+        packed = self.write('rdns.csv.gz', gzip.open)
+
+        # small chunks, so lines are split across several of them
+        with mock.patch.object(filter_script, 'chunk_size', 50):
+            self.assertEqual(filter_script.filter_serially(plain, settings, -1, False), expected)
+            self.assertEqual(filter_script.filter_serially(packed, settings, -1, False), expected)
+            self.assertEqual(filter_script.filter_mapped(plain, settings, 3), expected)
+            self.assertEqual(filter_script.filter_stream(packed, settings, 3), expected)
+
+
+class ScanDomainsTestCase(ScanScriptTestCase):
+
+    def test_failed_batch_falls_back_to_single_scans(self):
+        def scan_batch(domains, options):
+            yield domains[0], [['batch']]
+            raise ValueError("tool crashed")
+
+        scanner = fake_scanner(
+            'fake', batch_size=3, scan_batch=scan_batch,
+            scan=lambda domain, options: [['single']])
+        self.scan_domains([scanner], ['a.gov', 'b.gov', 'c.gov', 'd.gov'])
+
+        self.assertEqual(self.results('fake'), [
+            ('a.gov', 'a.gov', 'batch'), ('b.gov', 'b.gov', 'single'),
+            ('c.gov', 'c.gov', 'single'), ('d.gov', 'd.gov', 'batch')
+        ])
+
+
+# Fake scanners that note when each scan starts and ends, for checking
+# the order --pipeline and --async run them in.
+class ScanRecorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def note(self, event, domain, name):
+        with self.lock:
+            self.events.append((event, domain, name))
+
+    def scanner(self, name, depends=()):
+        def scan(domain, options):
+            self.note('start', domain, name)
+            time.sleep(random.random() / 200)
+            self.note('end', domain, name)
+            return [[name]]
+        return fake_scanner(name, depends=list(depends), scan=scan, workers=3)
+
+    def async_scanner(self, name, depends=()):
+        scanner = self.scanner(name, depends)
+
+        async def async_scan(domain, options):
+            self.note('start', domain, name)
+            await asyncio.sleep(random.random() / 200)
+            self.note('end', domain, name)
+            return [[name]]
+        scanner.async_scan = async_scan
+        return scanner
+
+    def check(self, test, scanners, domains, depth):
+        events = list(self.events)
+        runs = [(domain, name) for (event, domain, name) in events if event == 'start']
+        test.assertEqual(sorted(runs), sorted((domain, scanner_name) for domain in domains for scanner_name in scanners))
+
+        # a scanner only starts on a domain once its dependencies are done with it
+        for domain in domains:
+            for name, depends in scanners.items():
+                started = events.index(('start', domain, name))
+                for dependency in depends:
+                    test.assertLess(events.index(('end', domain, dependency)), started)
+
+        # no more than `depth` domains are being scanned at once
+        active, ends, peak = set(), {}, 0
+        for event, domain, name in events:
+            if event == 'start':
+                active.add(domain)
+                peak = max(peak, len(active))
+            else:
+                ends[domain] = ends.get(domain, 0) + 1
+                if ends[domain] == len(scanners):
+                    active.discard(domain)
+        test.assertLessEqual(peak, depth)
+        test.assertGreater(peak, 1)
+
+
+class PipelineTestCase(ScanScriptTestCase):
+
+    def test_pipeline(self):
+        recorder = ScanRecorder()
+        scanners = [
+            recorder.scanner('first'),
+            recorder.scanner('second', depends=['first']),
+            recorder.scanner('third', depends=['first', 'second'])
+        ]
+        domains = ['%i.gov' % i for i in range(40)]
+        self.scan_domains(scanners, domains, **{'pipeline': True, 'pipeline-depth': '4'})
+
+        recorder.check(self, {'first': [], 'second': ['first'], 'third': ['first', 'second']}, domains, 4)
+        for name in ('first', 'second', 'third'):
+            self.assertEqual(self.results(name), sorted((domain, domain, name) for domain in domains))
+
+
+class AsyncScanTestCase(ScanScriptTestCase):
+
+    def test_async(self):
+        # `second` has no async_scan, so runs in the thread pool.
+        recorder = ScanRecorder()
+        scanners = [
+            recorder.async_scanner('first'),
+            recorder.scanner('second', depends=['first']),
+            recorder.async_scanner('third', depends=['first', 'second'])
+        ]
+        domains = ['%i.gov' % i for i in range(40)]
+        self.scan_domains(scanners, domains, **{'async': True, 'pipeline-depth': '4'})
+
+        recorder.check(self, {'first': [], 'second': ['first'], 'third': ['first', 'second']}, domains, 4)
+        for name in ('first', 'second', 'third'):
+            self.assertEqual(self.results(name), sorted((domain, domain, name) for domain in domains))
+
+
+@unittest.skipUnless(installed('cryptography'), 'cryptography not installed')
+class SslyzeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from scanners import sslyze
+        self.sslyze = sslyze
+
+    def test_failed_batch_retries_each_target(self):
+        sslyze = self.sslyze
+        runs = []
+
+        def run(targets, options):
+            runs.append(targets)
+            if (len(targets) > 1) or (targets == ['bad.gov']):
+                return None
+            return {'target': targets[0]}
+
+        with mock.patch.object(sslyze, 'target_for', side_effect=lambda domain: domain), \
+                mock.patch.object(sslyze, 'cached', return_value=None), \
+                mock.patch.object(sslyze, 'run', side_effect=run), \
+                mock.patch.object(sslyze, 'results_for', side_effect=lambda target, results: results), \
+                mock.patch.object(sslyze, 'save', side_effect=lambda domain, data: data), \
+                mock.patch.object(sslyze, 'rows_for', side_effect=lambda target, data: [[data['target']]] if data else []), \
+                mock.patch.object(utils, 'cache_invalid') as cache_invalid:
+            results = dict(sslyze.scan_batch(['a.gov', 'bad.gov', 'c.gov'], {}))
+
+        self.assertEqual(runs, [['a.gov', 'bad.gov', 'c.gov'], ['a.gov'], ['bad.gov'], ['c.gov']])
+        self.assertEqual(results, {'a.gov': [['a.gov']], 'bad.gov': [], 'c.gov': [['c.gov']]})
+        cache_invalid.assert_called_once_with('bad.gov', 'sslyze')
+
+    # A self-signed certificate for `name`, signed with SHA-256.
+    def certificate(self, name):
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+        return x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(
+            key.public_key()).serial_number(1).not_valid_before(
+            datetime.datetime(2017, 1, 1)).not_valid_after(datetime.datetime(2018, 1, 1)).sign(
+            key, hashes.SHA256(), default_backend())
+
+    # Enough of sslyze 1.x's API for library_results.
+    def fake_sslyze(self, cert):
+        class ServerConnectivityError(Exception):
+            pass
+
+        class ServerConnectivityInfo(object):
+            def __init__(self, hostname):
+                self.hostname, self.port, self.ip_address = hostname, 443, '127.0.0.1'
+
+            def test_connectivity_to_server(self):
+                if self.hostname == 'down.gov':
+                    raise ServerConnectivityError("Could not connect")
+
+        def command(name):
+            return type(name, (object,), {'get_cli_argument': lambda self: name})
+
+        def result_for(server_info, command):
+            name = command.get_cli_argument()
+            if name == 'certinfo':
+                return types.SimpleNamespace(
+                    certificate_chain=[cert], verified_certificate_chain=[cert],
+                    has_sha1_in_certificate_chain=False)
+            accepted = []
+            if name == 'tlsv1_2':
+                accepted = [types.SimpleNamespace(openssl_name='ECDHE-RSA-AES128-GCM-SHA256', dh_info={'GroupSize': '256'})]
+            return types.SimpleNamespace(accepted_cipher_list=accepted)
+
+        class SynchronousScanner(object):
+            def run_scan_command(self, server_info, command):
+                return result_for(server_info, command)
+
+        class ConcurrentScanner(object):
+            def __init__(self):
+                self.queued = []
+
+            def queue_scan_command(self, server_info, command):
+                self.queued.append((server_info, command))
+
+            def get_results(self):
+                for server_info, command in reversed(self.queued):
+                    result = result_for(server_info, command)
+                    result.server_info, result.scan_command = server_info, command
+                    yield result
+
+        return types.SimpleNamespace(
+            ConcurrentScanner=ConcurrentScanner,
+            PluginRaisedExceptionScanResult=type('PluginRaisedExceptionScanResult', (object,), {}),
+            SynchronousScanner=SynchronousScanner,
+            ServerConnectivityInfo=ServerConnectivityInfo,
+            ServerConnectivityError=ServerConnectivityError,
+            commands={name: command(name) for name in self.sslyze.library_commands}
+        )
+
+    def pem(self, cert):
+        from cryptography.hazmat.primitives.serialization import Encoding
+        return {'as_pem': cert.public_bytes(Encoding.PEM).decode('utf-8')}
+
+    def test_cert_for(self):
+        sslyze = self.sslyze
+        pems = [self.pem(self.certificate('CA %i' % i)) for i in range(3)]
+
+        with mock.patch.object(sslyze, 'cert_index', collections.OrderedDict()), \
+                mock.patch.object(sslyze, 'cert_index_size', 10000), \
+                mock.patch.object(sslyze, 'parse_pem', wraps=sslyze.parse_pem) as parse_pem:
+            sslyze.init({'cert-cache-size': '2'})
+
+            # a repeated PEM is parsed once
+            first = sslyze.cert_for(pems[0])
+            self.assertIs(sslyze.cert_for(dict(pems[0])), first)
+            self.assertEqual(parse_pem.call_count, 1)
+
+            # and fields are only read from it once
+            with mock.patch.object(sslyze, 'cert_issuer_name', wraps=sslyze.cert_issuer_name) as issuer_name:
+                self.assertEqual(first.issuer_name(), 'CA 0')
+                self.assertEqual(sslyze.cert_for(pems[0]).issuer_name(), 'CA 0')
+                self.assertEqual(issuer_name.call_count, 1)
+
+            # past the size limit, the least recently used is evicted
+            sslyze.cert_for(pems[1])
+            sslyze.cert_for(pems[0])
+            sslyze.cert_for(pems[2])
+            self.assertEqual(len(sslyze.cert_index), 2)
+            self.assertEqual(parse_pem.call_count, 3)
+
+            sslyze.cert_for(pems[0])
+            self.assertEqual(parse_pem.call_count, 3)
+            sslyze.cert_for(pems[1])
+            self.assertEqual(parse_pem.call_count, 4)
+
+    def test_library_results_parse(self):
+        sslyze = self.sslyze
+        cert = self.certificate('Example CA')
+
+        with mock.patch.object(sslyze, 'sslyze_module', return_value=self.fake_sslyze(cert)):
+            single = sslyze.library_results(['a.gov'])
+            batch = sslyze.library_results(['a.gov', 'down.gov', 'b.gov'])
+
+        # round-tripped through JSON, as it would be through the cache
+        single, batch = json.loads(json.dumps(single)), json.loads(json.dumps(batch))
+
+        self.assertEqual(batch['invalid_targets'], [{'server_string': 'down.gov', 'error_message': 'Could not connect'}])
+        for target, results in [('a.gov', single), ('a.gov', batch), ('b.gov', batch)]:
+            rows = list(sslyze.rows_for(target, sslyze.results_for(target, results)))
+            self.assertEqual(rows, [[
+                target, False, False, False, False, True,
+                True, True, 256, False, False,
+                'RSA', 2048, 'sha256', False, False,
+                datetime.datetime(2017, 1, 1), datetime.datetime(2018, 1, 1),
+                'Example CA', 'Example CA', None
+            ]])
+
+
+class PshttLibraryTestCase(unittest.TestCase):
+
+    def test_library_results_parse(self):
+        def inspect_domains(domains, options):
+            for domain in domains:
+                result = {header: None for header in pshtt.headers}
+                result.update({'Domain': domain, 'Canonical URL': 'https://%s' % domain.lower(), 'Live': True})
+                yield result
+
+        module = mock.Mock(inspect_domains=mock.Mock(side_effect=inspect_domains))
+        with mock.patch.object(pshtt, 'pshtt_module', return_value=module):
+            results = pshtt.results_by_domain(pshtt.library_results(['A.gov', 'b.gov']))
+
+        self.assertEqual(module.inspect_domains.call_args[0][1], {
+            'user_agent': pshtt.user_agent, 'timeout': pshtt.timeout, 'preload_cache': pshtt.preload_cache
+        })
+        self.assertEqual(sorted(results), ['a.gov', 'b.gov'])
+
+        rows = list(pshtt.rows_for(results['a.gov']))
+        self.assertEqual(len(rows), 1)
+        row = dict(zip(pshtt.headers, rows[0]))
+        self.assertEqual((row['Canonical URL'], row['Live'], row['Valid HTTPS'], row['HSTS Header']),
+                         ('https://a.gov', True, False, None))
+
+    def test_library_errors(self):
+        module = mock.Mock(inspect_domains=mock.Mock(side_effect=OSError("no network")))
+        with mock.patch.object(pshtt, 'pshtt_module', return_value=module):
+            self.assertIsNone(pshtt.library_results(['a.gov']))
+
+
+class StarttlsTestCase(unittest.TestCase):
+
+    # Answers each GET from a list of statuses per domain.
+    class FakeSession(object):
+        def __init__(self, statuses):
+            self.statuses = statuses
+            self.posted = []
+
+        def get(self, url):
+            domain = url.split("/")[-1]
+            status, changed = self.statuses[domain].pop(0)
+            if isinstance(status, Exception):
+                raise status
+            if status is None:
+                return mock.Mock(json=mock.Mock(side_effect=ValueError("No JSON object could be decoded")))
+            return mock.Mock(json=lambda: {
+                'status': status,
+                'status_changed': changed,
+                'actual_targets': [{'name': 'mx.%s' % domain, 'failed': True, 'description': 'No STARTTLS'}]
+            })
+
+        def post(self, url, data):
+            self.posted.append(url.split("/")[-1])
+
+    def test_scan_batch(self):
+        fresh = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        stale = "2017-01-01T00:00:00.000000Z"
+        session = self.FakeSession({
+            'fresh.gov': [('DONE', fresh)],
+            'busy.gov': [('IN PROGRESS', stale), ('IN PROGRESS', stale), ('DONE', fresh)],
+            'stale.gov': [('DONE', stale), ('DONE', fresh)],
+        })
+
+        with mock.patch.object(utils, 'http_session', return_value=session), \
+                mock.patch.object(starttls, 'poll_interval', 0):
+            results = list(starttls.scan_batch(['fresh.gov', 'busy.gov', 'stale.gov'], {}))
+
+        # done ones first, then the rest as they finish
+        self.assertEqual([domain for domain, rows in results], ['fresh.gov', 'stale.gov', 'busy.gov'])
+        self.assertEqual(session.posted, ['stale.gov'])
+        for domain, rows in results:
+            self.assertEqual(rows, [[fresh, 'mx.%s' % domain, False, 'No STARTTLS', None, None, None, None, None]])
+
+    def test_scan_batch_errors(self):
+        fresh = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        stale = "2017-01-01T00:00:00.000000Z"
+        session = self.FakeSession({
+            'down.gov': [(ConnectionError("refused"), None)],
+            'garbled.gov': [('IN PROGRESS', stale), (None, None)],
+            'busy.gov': [('IN PROGRESS', stale), ('DONE', fresh)],
+            'fresh.gov': [('DONE', fresh)],
+        })
+
+        with mock.patch.object(utils, 'http_session', return_value=session), \
+                mock.patch.object(starttls, 'poll_interval', 0):
+            results = dict(starttls.scan_batch(['down.gov', 'garbled.gov', 'busy.gov', 'fresh.gov'], {}))
+
+        self.assertEqual(results['down.gov'], [])
+        self.assertEqual(results['garbled.gov'], [])
+        self.assertEqual(len(results['busy.gov']), 1)
+        self.assertEqual(len(results['fresh.gov']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
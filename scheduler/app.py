@@ -8,13 +8,14 @@ from celery.schedules import crontab
 import cfenv
 import pandas as pd
 from io import StringIO
-import requests
 import datetime as dt
 import json
 import boto
 from boto.s3.key import Key
 from werkzeug.utils import secure_filename
 import censys_api
+import ingest
+import utils
 from github import Github
 from github import InputGitTreeElement
 
@@ -143,15 +144,29 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 
 celery = make_celery(app)
 
+# How many rows are written to the database at once (see ingest.py).
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+
 @celery.task(name="app.save_csv_to_db")
-def save_csv_to_db(contents):
+def save_csv_to_db(contents, batch_size=None):
+    """
+    Loads an uploaded CSV of domains into the domains table, in batches,
+    adding new domains and updating the timestamp of ones already there.
+    Returns how many rows were written, and how fast.
+    """
     file = StringIO(contents)
-    df = pd.read_csv(file)
-    for index in df.index:
-        # dt.datetime.now is bad, change this in the near future
-        domain = Domains(df.ix[index]["b'Domain"], dt.datetime.now())
-        db.session.add(domain)
-        db.session.commit()
+    df = pd.read_csv(file, usecols=["b'Domain"])
+    # dt.datetime.now is bad, change this in the near future
+    timestamp = dt.datetime.now()
+    rows = ((domain, timestamp) for domain in df["b'Domain"])
+
+    connection = db.engine.raw_connection()
+    try:
+        return ingest.upsert(
+            connection, Domains.__tablename__, ["domain", "timestamp"], rows,
+            batch_size=batch_size or INGEST_BATCH_SIZE)
+    finally:
+        connection.close()
 
 @celery.task(name="app.reset")
 def reset():
@@ -165,20 +180,23 @@ def gatherer():
     """
     options = json.load(open("options.creds","r"))
     censys_list = censys_api.gather(".gov", options)
-    censys_list = list(set(censys_list))
-    censys_list = [elem for elem in censys_list if ".gov" in elem]
 
-    eot2016 = requests.get("https://github.com/GSA/data/raw/gh-pages/end-of-term-archive-csv/eot-2016-seeds.csv")
+    # Only .gov hostnames (parents included), each once.
+    hostname_filter = utils.HostnameFilter([".gov"], include_parents=True)
+    censys_list = [elem for elem in set(censys_list) if hostname_filter.allows(elem)]
+    print(hostname_filter.report())
+
+    eot2016 = utils.http_session().get("https://github.com/GSA/data/raw/gh-pages/end-of-term-archive-csv/eot-2016-seeds.csv")
     eot2016_string = eot2016.text
     eot2016_list = string_to_list(eot2016_string)
 
-    dap = requests.get("https://analytics.usa.gov/data/live/sites-extended.csv")
+    dap = utils.http_session().get("https://analytics.usa.gov/data/live/sites-extended.csv")
     dap_string = dap.text
     dap_list = string_to_list(dap_string)
     dap_list = dap_list[1:]
     dap_list = string_to_list(dap_string)
 
-    parents = requests.get("https://raw.githubusercontent.com/GSA/data/gh-pages/dotgov-domains/current-federal.csv")
+    parents = utils.http_session().get("https://raw.githubusercontent.com/GSA/data/gh-pages/dotgov-domains/current-federal.csv")
     parents_string = parents.text
     parents_list = string_to_df_to_list(parents_string)
 
@@ -190,14 +208,20 @@ def gatherer():
         "parents": []
     }
     
+    # Sets, so each membership check below is a hash lookup.
+    eot2016_set = set(eot2016_list)
+    dap_set = set(dap_list)
+    censys_set = set(censys_list)
+    parents_set = set(parents_list)
+
     domain_list = [domain.domain for domain in Domains.query.all()]
     print("started for loop")
     for domain in domain_list:
         master_data["domains"].append(domain)
-        master_data["eot"].append(domain in eot2016_list)
-        master_data["dap"].append(domain in dap_list)
-        master_data["censys"].append(domain in censys_list)
-        master_data["parents"].append(domain in parents)
+        master_data["eot"].append(domain in eot2016_set)
+        master_data["dap"].append(domain in dap_set)
+        master_data["censys"].append(domain in censys_set)
+        master_data["parents"].append(domain in parents_set)
 
     print("finished for loop")
     cols = ["domains", "eot", "dap", "censys", "parents"]
@@ -270,7 +294,7 @@ class Domains(db.Model):
     """
     __tablename__ = "domains"
     id = db.Column(db.Integer, primary_key=True)
-    domain = db.Column(db.String)
+    domain = db.Column(db.String, unique=True)
     timestamp = db.Column(db.DateTime)
     
     def __init__(self, domain, timestamp):
@@ -278,6 +302,33 @@ class Domains(db.Model):
         self.timestamp = timestamp
 
 
+class USWDS(db.Model):
+    """
+    The latest US Web Design Standards check of each domain.
+
+    Parameters:
+    @domain - the domain checked
+
+    @uswds - whether the domain's site uses the web design standards
+
+    @https - whether the site was reached over https
+
+    @timestamp - when the domain was checked
+    """
+    __tablename__ = "uswds"
+    id = db.Column(db.Integer, primary_key=True)
+    domain = db.Column(db.String, unique=True)
+    uswds = db.Column(db.Boolean)
+    https = db.Column(db.Boolean)
+    timestamp = db.Column(db.DateTime)
+
+    def __init__(self, domain, uswds, https, timestamp):
+        self.domain = domain
+        self.uswds = uswds
+        self.https = https
+        self.timestamp = timestamp
+
+
 if __name__ == '__main__':
     app.run(debug=True)
 
@@ -0,0 +1,142 @@
+import time
+
+import psycopg2.extras
+
+
+class BulkUpsert(object):
+    """
+    Loads rows into a Postgres table in batches, rather than with an
+    INSERT (and a commit) per row.
+
+    Rows are buffered, and every `batch_size` rows are sent as a single
+    multi-row INSERT (psycopg2's execute_values) and committed. Rows
+    whose `key` is already in the table are updated instead
+    (INSERT ... ON CONFLICT (key) DO UPDATE), so the key column needs
+    a unique index; see ensure_unique_index. Within a batch, the last
+    row for a key wins.
+
+    Parameters:
+    @connection - a DB-API (psycopg2) connection, e.g. db.engine.raw_connection()
+
+    @table - the table to load into
+
+    @columns - the columns each row has values for, in order
+
+    @key - the column to upsert on
+
+    @batch_size - how many rows to send at once
+
+    Use it as a context manager, or call close() when done, which sends
+    whatever's left and returns stats() on how it went.
+    """
+
+    def __init__(self, connection, table, columns, key="domain", batch_size=1000):
+        self.connection = connection
+        self.table = table
+        self.columns = list(columns)
+        self.key = key
+        self.key_index = self.columns.index(key)
+        self.batch_size = int(batch_size)
+
+        updates = [column for column in self.columns if column != key]
+        if updates:
+            conflict = "DO UPDATE SET %s" % ", ".join(
+                "%s = EXCLUDED.%s" % (column, column) for column in updates)
+        else:
+            conflict = "DO NOTHING"
+        self.statement = "INSERT INTO %s (%s) VALUES %%s ON CONFLICT (%s) %s" % (
+            table, ", ".join(self.columns), key, conflict)
+
+        self.pending = []
+        self.rows = 0
+        self.batches = 0
+        self.started = time.time()
+
+    def add(self, row):
+        self.pending.append(tuple(row))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # Postgres won't update the same row twice in one statement.
+        rows = list(dict((row[self.key_index], row) for row in self.pending).values())
+
+        cursor = self.connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, self.statement, rows, page_size=len(rows))
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        self.rows += len(rows)
+        self.batches += 1
+        self.pending = []
+
+    def stats(self):
+        seconds = time.time() - self.started
+        return {
+            "table": self.table,
+            "rows": self.rows,
+            "batches": self.batches,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds > 0 else None
+        }
+
+    def close(self):
+        self.flush()
+        return self.stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def ensure_unique_index(connection, table, column, latest="id"):
+    """
+    Upserting needs a unique index on the key column, which tables
+    created before it was declared unique won't have. Creating it fails
+    if the column already has duplicates, so those are removed first,
+    keeping the latest row (highest `latest`) for each value.
+    """
+    index = "%s_%s_key" % (table, column)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s", (table, index))
+        if cursor.fetchone() is not None:
+            return
+
+        cursor.execute(
+            "DELETE FROM %s older USING %s newer WHERE older.%s = newer.%s AND older.%s < newer.%s" % (
+                table, table, column, column, latest, latest))
+        if cursor.rowcount:
+            print("Removed %i duplicate rows from %s." % (cursor.rowcount, table))
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)" % (index, table, column))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def upsert(connection, table, columns, rows, key="domain", batch_size=1000):
+    """
+    Load an iterable of rows with a BulkUpsert, and return its stats.
+    """
+    ensure_unique_index(connection, table, key)
+    loader = BulkUpsert(connection, table, columns, key=key, batch_size=batch_size)
+    loader.add_all(rows)
+    return loader.close()
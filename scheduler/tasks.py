@@ -1,4 +1,16 @@
-from app import celery
+from app import celery, db, Domains, USWDS, INGEST_BATCH_SIZE, ensure_upload_folder
+from celery.schedules import crontab
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import datetime as dt
+import json
+import os
+import boto
+from boto.s3.key import Key
+import pandas as pd
+import censys_api
+import ingest
+import utils
 
 
 @celery.task(name="tasks.dummy")
@@ -6,25 +18,75 @@ def dummy():
     return "it worked!"
 
 
+# The web design standards service checks a batch of domains at once,
+# streaming back a result per domain (NDJSON) as each one finishes.
+# A few batches are kept in flight at a time, so the service always
+# has the next batch to work on while this task saves the last one.
+USWDS_BULK_URL = "https://domain-scan-python-services.app.cloud.gov/services/web-design-standards/bulk"
+USWDS_BATCH_SIZE = 250
+USWDS_BATCHES_IN_FLIGHT = 3
+
+
 @celery.task(name="tasks.uswds")
-def uswds():
+def uswds(batch_size=None):
     """
     Runs the us web design standards checker against the uploaded list of domains.
+
+    Results are saved as they come in, a batch at a time, replacing any
+    earlier result for the same domain. Returns each domain's result,
+    and how many rows were saved, and how fast.
     """
     results = {}
-    for domain in Domains.query.all():
-        payload = {"domain":domain.domain}
-        headers = {"Content-Type":"application/json"}
-        result = requests.get(
-            "https://domain-scan-python-services.app.cloud.gov/services/web-design-standards",
-            params=payload,
-        headers=headers)
-        result = json.loads(result.text)
-        uswds = USWDS(domain.domain, result["uswds"], result["https"], dt.datetime.now())
-        db.session.add(uswds)
-        db.session.commit()
-        results[domain.domain] = result
-    return results #maybe?
+    domains = [domain for (domain,) in db.session.query(Domains.domain)]
+    batches = [domains[i:i + USWDS_BATCH_SIZE] for i in range(0, len(domains), USWDS_BATCH_SIZE)]
+
+    connection = db.engine.raw_connection()
+    try:
+        ingest.ensure_unique_index(connection, USWDS.__tablename__, "domain")
+        loader = ingest.BulkUpsert(
+            connection, USWDS.__tablename__, ["domain", "uswds", "https", "timestamp"],
+            batch_size=batch_size or INGEST_BATCH_SIZE)
+
+        # Whatever's been checked is saved, even if saving fails partway.
+        try:
+            with ThreadPoolExecutor(max_workers=USWDS_BATCHES_IN_FLIGHT) as executor:
+                for batch_results in executor.map(uswds_batch, batches):
+                    for result in batch_results:
+                        domain = result.pop("domain")
+                        results[domain] = result
+                        if "error" in result:
+                            continue
+                        loader.add((domain, result["uswds"], result["https"], dt.datetime.now()))
+        finally:
+            ingest_stats = loader.close()
+    finally:
+        connection.close()
+
+    return {"results": results, "ingest": ingest_stats}
+
+
+# Results for one batch of domains from the bulk service. If the
+# request fails, or the stream breaks off partway, every domain without
+# a result gets an "error" one, so one bad batch doesn't sink the rest.
+def uswds_batch(domains):
+    results = []
+    try:
+        response = utils.http_session().post(
+            USWDS_BULK_URL,
+            json=domains,
+            stream=True,
+            # results can be a while coming, for slow sites
+            timeout=(10, 120))
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                results.append(json.loads(line))
+    except Exception as error:
+        message = "%s: %s" % (error.__class__.__name__, error)
+        print("USWDS batch failed: %s" % message)
+        checked = set(result.get("domain") for result in results)
+        results.extend({"domain": domain, "error": message} for domain in domains if domain not in checked)
+    return results
 
 
 def string_to_list(string):
@@ -37,7 +99,7 @@ def string_to_df_to_list(string):
 
 def upload_to_s3(csv_file_contents, bucket_name):
     vcap_services = os.getenv("VCAP_SERVICES")
-    vcap_services = json.loads(vcap_services)
+    vcap = json.loads(vcap_services)
     bucket = vcap["s3"][0]["credentials"]["bucket"]
     access_key_id = vcap["s3"][0]["credentials"]["access_key_id"]
     region = vcap["s3"][0]["credentials"]["region"]
@@ -64,19 +126,22 @@ def gatherer():
     data = {}
     options = json.load(open("options.creds","r"))
     censys_list = censys_api.gather(".gov", options)
-    censys_list = list(set(censys_list))
-    censys_list = [elem for elem in censys_list if ".gov" in elem]
-    eot2016 = requests.get("https://github.com/GSA/data/raw/gh-pages/end-of-term-archive-csv/eot-2016-seeds.csv")
+
+    # Only .gov hostnames (parents included), each once.
+    hostname_filter = utils.HostnameFilter([".gov"], include_parents=True)
+    censys_list = [elem for elem in set(censys_list) if hostname_filter.allows(elem)]
+    print(hostname_filter.report())
+    eot2016 = utils.http_session().get("https://github.com/GSA/data/raw/gh-pages/end-of-term-archive-csv/eot-2016-seeds.csv")
     eot2016_string = eot2016.text
     eot2016_list = string_to_list(eot2016_string)
 
-    dap = requests.get("https://analytics.usa.gov/data/live/sites-extended.csv")
+    dap = utils.http_session().get("https://analytics.usa.gov/data/live/sites-extended.csv")
     dap_string = dap.text
     dap_list = string_to_list(dap_string)
     dap_list = dap_list[1:]
     dap_list = string_to_list(dap_string)
 
-    parents = requests.get("https://raw.githubusercontent.com/GSA/data/gh-pages/dotgov-domains/current-federal.csv")
+    parents = utils.http_session().get("https://raw.githubusercontent.com/GSA/data/gh-pages/dotgov-domains/current-federal.csv")
     parents_string = parents.text
     parents_list = string_to_df_to_list(parents_string)
 
@@ -94,12 +159,18 @@ def gatherer():
         "domains":[],
         "censys": []
     }
+    # Sets, so each membership check below is a hash lookup.
+    eot2016_set = set(eot2016_list)
+    dap_set = set(dap_list)
+    censys_set = set(censys_list)
+    parents_set = set(parents_list)
+
     for domain in master_list:
         master_data["domains"].append(domain)
-        master_data["eot"].append(domain in eot2016_list)
-        master_data["dap"].append(domain in dap_list)
-        master_data["parents"].append(domain in parents_list)
-        master_data["censys"].append(domain in censys_list)
+        master_data["eot"].append(domain in eot2016_set)
+        master_data["dap"].append(domain in dap_set)
+        master_data["parents"].append(domain in parents_set)
+        master_data["censys"].append(domain in censys_set)
     df = pd.DataFrame(master_data)
     s = StringIO()
     df.to_csv(s)
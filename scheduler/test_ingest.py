@@ -0,0 +1,75 @@
+from unittest import mock
+
+import ingest
+
+
+def loader(batch_size):
+    connection = mock.Mock()
+    return connection, ingest.BulkUpsert(
+        connection, "domains", ["domain", "timestamp"], batch_size=batch_size)
+
+
+def test_bulk_upsert_sends_rows_in_batches():
+    connection, upsert = loader(batch_size=2)
+    with mock.patch("psycopg2.extras.execute_values") as execute_values:
+        upsert.add_all([("a.gov", 1), ("b.gov", 1), ("c.gov", 1)])
+        assert execute_values.call_count == 1
+        stats = upsert.close()
+
+    assert [call[0][2] for call in execute_values.call_args_list] == [
+        [("a.gov", 1), ("b.gov", 1)], [("c.gov", 1)]
+    ]
+    assert execute_values.call_args[0][1] == (
+        "INSERT INTO domains (domain, timestamp) VALUES %s "
+        "ON CONFLICT (domain) DO UPDATE SET timestamp = EXCLUDED.timestamp")
+    assert connection.commit.call_count == 2
+    assert (stats["rows"], stats["batches"]) == (3, 2)
+
+
+def test_bulk_upsert_keeps_last_row_for_a_key_in_a_batch():
+    connection, upsert = loader(batch_size=10)
+    with mock.patch("psycopg2.extras.execute_values") as execute_values:
+        upsert.add_all([("a.gov", 1), ("b.gov", 1), ("a.gov", 2)])
+        upsert.close()
+
+    assert sorted(execute_values.call_args[0][2]) == [("a.gov", 2), ("b.gov", 1)]
+
+
+def test_bulk_upsert_rolls_back_a_failed_batch():
+    connection, upsert = loader(batch_size=1)
+    with mock.patch("psycopg2.extras.execute_values", side_effect=ValueError("bad row")):
+        try:
+            upsert.add(("a.gov", 1))
+        except ValueError:
+            pass
+        else:
+            assert False, "expected the batch to fail"
+
+    connection.rollback.assert_called_once_with()
+    assert not connection.commit.called
+
+
+def test_ensure_unique_index_removes_duplicates_first():
+    connection = mock.Mock()
+    cursor = connection.cursor.return_value
+    cursor.fetchone.return_value = None
+    cursor.rowcount = 0
+
+    ingest.ensure_unique_index(connection, "domains", "domain")
+
+    statements = [call[0][0] for call in cursor.execute.call_args_list]
+    assert statements[1].startswith("DELETE FROM domains older USING domains newer")
+    assert "older.id < newer.id" in statements[1]
+    assert statements[2] == "CREATE UNIQUE INDEX IF NOT EXISTS domains_domain_key ON domains (domain)"
+    connection.commit.assert_called_once_with()
+
+
+def test_ensure_unique_index_does_nothing_once_it_exists():
+    connection = mock.Mock()
+    cursor = connection.cursor.return_value
+    cursor.fetchone.return_value = (1,)
+
+    ingest.ensure_unique_index(connection, "domains", "domain")
+
+    assert cursor.execute.call_count == 1
+    assert not connection.commit.called
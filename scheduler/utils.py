@@ -6,11 +6,15 @@ import sys
 import shutil
 import traceback
 import json
-import urllib
+import threading
 import csv
 import logging
 import datetime
+import collections
 import strict_rfc3339
+import requests
+import requests.adapters
+import urllib3.util.retry
 
 
 # Wrapper to a run() method to catch exceptions.
@@ -32,8 +36,52 @@ def download(url, destination):
     # make sure path is present
     mkdir_p(os.path.dirname(destination))
 
-    filename, headers = urllib.request.urlretrieve(url, destination)
-    return filename
+    response = http_session().get(url, stream=True)
+    response.raise_for_status()
+    with open(destination, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    return destination
+
+
+# Shared HTTP sessions, copied from domain-scan/scanners/utils.py: change and document them there.
+
+http_local = threading.local()
+
+
+class HTTPSession(requests.Session):
+
+    def __init__(self, timeout=30, retries=3, pool_size=10, backoff=0.5):
+        super(HTTPSession, self).__init__()
+        self.timeout = timeout
+
+        retry = urllib3.util.retry.Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(HTTPSession, self).request(method, url, **kwargs)
+
+
+# This thread's session, set up from the command line options.
+def http_session():
+    session = getattr(http_local, "session", None)
+    if session is None:
+        cli_options = options()
+        session = HTTPSession(
+            timeout=float(cli_options.get("http-timeout", 30)),
+            retries=int(cli_options.get("http-retries", 3)),
+            pool_size=int(cli_options.get("http-pool-size", 10))
+        )
+        http_local.session = session
+    return session
 
 
 # read options from the command line
@@ -386,3 +434,68 @@ def normalize_suffix(suffix):
 # Assumes suffixes always begin with a dot.
 def suffix_pattern(suffix):
     return re.compile("\\%s$" % suffix)
+
+
+# Filters hostnames down to the ones worth keeping, counting how many
+# each check drops:
+#
+# * suffix: doesn't end in one of `suffixes` (e.g. [".gov", ".fed.us"])
+# * parents: is a base domain (or www.base), unless `include_parents`
+# * whitelist: isn't under one of the `parents` base domains, if given
+#
+# Suffixes are matched a label at a time, from the right, against a
+# trie of all of them at once, and parents are kept in a set, so the
+# cost per hostname doesn't grow with the number of either.
+class HostnameFilter(object):
+
+    def __init__(self, suffixes, parents=None, include_parents=False):
+        self.suffixes = {}
+        for suffix in suffixes:
+            node = self.suffixes
+            for label in reversed(normalize_suffix(suffix).split(".")[1:]):
+                node = node.setdefault(label, {})
+            node[None] = True
+
+        self.parents = set(parents) if parents else None
+        self.include_parents = include_parents
+
+        self.kept = 0
+        self.drops = collections.OrderedDict([
+            ("suffix", 0), ("parents", 0), ("whitelist", 0)
+        ])
+
+    def allows(self, hostname):
+        if not self.has_suffix(hostname):
+            self.drops["suffix"] += 1
+            return False
+
+        if (not self.include_parents) or (self.parents is not None):
+            base = base_domain_for(hostname)
+
+            if (not self.include_parents) and ((hostname == base) or (hostname == "www.%s" % base)):
+                self.drops["parents"] += 1
+                return False
+
+            if (self.parents is not None) and (base not in self.parents):
+                self.drops["whitelist"] += 1
+                return False
+
+        self.kept += 1
+        return True
+
+    # Whether a hostname ends in one of the suffixes (with at least one
+    # label in front of it).
+    def has_suffix(self, hostname):
+        labels = hostname.split(".")
+        node = self.suffixes
+        for depth in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[depth])
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def report(self):
+        drops = ", ".join("%i by %s" % (count, name) for name, count in self.drops.items())
+        return "Kept %i hostnames, dropped %s." % (self.kept, drops)
@@ -1,6 +1,6 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 import json
-from web_design_standards_check import uswds_checker
+from web_design_standards_check import uswds_checker, bulk_uswds_checker
 from smart_open import smart_open
 import boto
 from app import env
@@ -22,6 +22,30 @@ def services():
     return json.dumps(uswds_checker(domain))
 
 
+# Checks a batch of domains at once. Takes a JSON list of domains (or
+# {"domains": [...]}), and streams back one JSON result per line
+# (NDJSON) as each domain is checked, in the order they finish. Each
+# result has the "domain" it's for, and the same fields as the
+# single-domain service, or an "error".
+#
+# ?concurrency= sets how many domains are fetched at once (default 50).
+@app.route("/services/web-design-standards/bulk", methods=["POST"])
+def services_bulk():
+    domains = request.get_json(force=True)
+    if isinstance(domains, dict):
+        domains = domains.get("domains")
+    if not isinstance(domains, list):
+        return Response("Expected a JSON list of domains.\n", status=400)
+
+    concurrency = int(request.args.get("concurrency", 50))
+
+    def results():
+        for result in bulk_uswds_checker(domains, concurrency=concurrency):
+            yield json.dumps(result) + "\n"
+
+    return Response(results(), mimetype="application/x-ndjson")
+
+
 @app.route("/services/pshtt", methods=["GET","POST"])
 def pshtt():
     result = subprocess.run(["pshtt_command", "whitehouse.gov"], stdout=subprocess.PIPE)
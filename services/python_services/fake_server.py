@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import threading
+import urllib.parse
+import socketserver
+import http.server
+
+
+class FakeServer(object):
+    '''A local HTTP server, for tests.
+
+        Serves `pages`, a dict of path (without any query string) to
+        what to serve there: either a body (bytes, served as HTML), or
+        a function that's given the request handler and returns
+        (status, headers, body), for pages that depend on the request.
+        Any other path gets a 404.
+
+        Use as a context manager: `url` is the server's base URL, and
+        `host` its host and port, e.g. to use as a domain.'''
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __enter__(self):
+        pages = self.pages
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                page = pages.get(urllib.parse.urlparse(self.path).path)
+                if page is None:
+                    status, headers, body = 404, {}, b''
+                elif callable(page):
+                    status, headers, body = page(self)
+                else:
+                    status, headers, body = 200, {}, page
+
+                self.send_response(status)
+                headers = dict({'Content-Type': 'text/html'}, **headers)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.host = '127.0.0.1:%i' % self.server.server_address[1]
+        self.url = 'http://%s' % self.host
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
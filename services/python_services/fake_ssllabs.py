@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import json
+import threading
+import urllib.parse
+
+from fake_server import FakeServer
+
+
+class FakeSSLLabs(object):
+    '''A local stand-in for the SSL Labs API, for tests.
+
+        Serves `info` and `analyze` the way the real API does, with
+        the X-Max-Assessments and X-Current-Assessments headers.
+        Starting an assessment when `max_assessments` are already
+        running gets a 429. An assessment is READY after it's been
+        polled `polls` times, or an ERROR for hosts in `errors`.
+
+        Keeps track of the most assessments ever running at once
+        (`peak`) and of every request made (`requests`).
+
+        Use as a context manager: `api` is the base URL to give to
+        ssllabsscanner.Scheduler.'''
+
+    def __init__(self, max_assessments=3, polls=2, errors=(), cool_off=0):
+        self.max_assessments = max_assessments
+        self.polls = polls
+        self.errors = set(errors)
+        self.cool_off = cool_off
+
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = 0
+        self.requests = []
+
+    def __enter__(self):
+        self.server = FakeServer({
+            '/api/v2/info': self.serve,
+            '/api/v2/analyze': self.serve
+        }).__enter__()
+        self.api = self.server.url + '/api/v2/'
+        return self
+
+    def __exit__(self, *args):
+        self.server.__exit__(*args)
+
+    def serve(self, request):
+        url = urllib.parse.urlparse(request.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        status, body = self.respond(url.path.rsplit("/", 1)[-1], params)
+
+        with self.lock:
+            headers = {
+                'Content-Type': 'application/json',
+                'X-Max-Assessments': str(self.max_assessments),
+                'X-Current-Assessments': str(len(self.running))
+            }
+        return status, headers, json.dumps(body).encode('utf-8')
+
+    def respond(self, path, params):
+        with self.lock:
+            self.requests.append((path, params))
+
+            if path == 'info':
+                return 200, {
+                    'maxAssessments': self.max_assessments,
+                    'currentAssessments': len(self.running),
+                    'newAssessmentCoolOff': self.cool_off
+                }
+
+            host = params.get('host')
+            if params.get('startNew') == 'on':
+                if len(self.running) >= self.max_assessments:
+                    return 429, {'errors': [{'message': 'Concurrent assessment limit reached'}]}
+                self.running[host] = 0
+                self.peak = max(self.peak, len(self.running))
+                return 200, {'host': host, 'status': 'DNS'}
+
+            if host not in self.running:
+                return 400, {'errors': [{'message': 'No assessment for %s' % host}]}
+
+            self.running[host] += 1
+            if self.running[host] < self.polls:
+                return 200, {'host': host, 'status': 'IN_PROGRESS'}
+
+            del self.running[host]
+            if host in self.errors:
+                return 200, {'host': host, 'status': 'ERROR', 'statusMessage': 'Unable to connect to the server'}
+            return 200, {'host': host, 'status': 'READY', 'endpoints': [{'grade': 'A'}]}
@@ -2,28 +2,36 @@
 
 import requests
 import time
-import sys
+import heapq
 import logging
+import collections
+
+import utils
 
 API = 'https://api.ssllabs.com/api/v2/'
 
 
-def requestAPI(path, payload={}):
+def requestAPI(path, payload={}, session=None, api=API):
     '''This is a helper method that takes the path to the relevant
         API call and the user-defined payload and requests the
         data/server test from Qualys SSL Labs.
-        Returns JSON formatted data'''
+        Returns JSON formatted data, or None if the request failed'''
+
+    response = request(path, payload, session=session, api=api)
+    if (response is None) or (response.status_code != 200):
+        return None
+    return response.json()
+
 
-    url = API + path
+# The raw response to an API call, or None if it couldn't be made.
+def request(path, payload={}, session=None, api=API, timeout=60):
+    url = api + path
 
     try:
-        response = requests.get(url, params=payload)
-    except requests.exception.RequestException:
+        return (session or utils.http_session()).get(url, params=payload, timeout=timeout)
+    except requests.exceptions.RequestException:
         logging.exception('Request failed.')
-        sys.exit(1)
-
-    data = response.json()
-    return data
+        return None
 
 
 def resultsFromCache(host, publish='off', startNew='off', fromCache='on', all='done'):
@@ -40,20 +48,184 @@ def resultsFromCache(host, publish='off', startNew='off', fromCache='on', all='d
 
 
 def newScan(host, publish='off', startNew='on', all='done', ignoreMismatch='on'):
-    path = 'analyze'
-    payload = {
-                'host': host,
-                'publish': publish,
-                'startNew': startNew,
-                'all': all,
-                'ignoreMismatch': ignoreMismatch
-              }
-    results = requestAPI(path, payload)
+    scheduler = Scheduler(publish=publish, all=all, ignoreMismatch=ignoreMismatch)
+    for scanned, results in scheduler.run([host]):
+        return results
+
+
+class Scheduler(object):
+    '''Runs SSL Labs assessments for many hosts at once.
+
+        SSL Labs limits how many assessments a client can have running
+        at a time, and tells us the limit (and how many we have running)
+        in the X-Max-Assessments and X-Current-Assessments headers of
+        every response. The scheduler keeps that many in flight: a new
+        assessment starts whenever there's room (and the API's cool-off
+        between new assessments has passed), and every running one is
+        polled from the same loop.
+
+        Each host is polled every `poll_interval` seconds at first,
+        backing off (doubling) to at most `max_poll_interval` while it's
+        still in progress. Being told to slow down (HTTP 429) or that the
+        service is overloaded (503/529), and failed requests, also back
+        off rather than give up, up to `max_failures` times in a row for
+        one host. Requests share one pooled session (utils.HTTPSession).
+
+        run(hosts) yields (host, results) as each assessment finishes,
+        in the order they finish. A host whose assessment couldn't be
+        run gets results with a status of ERROR, like SSL Labs' own.'''
+
+    def __init__(self, api=API, session=None, publish='off', all='done', ignoreMismatch='on',
+                 poll_interval=5, max_poll_interval=30, backoff=15, max_backoff=15 * 60,
+                 max_failures=10):
+        self.api = api
+        # Backing off is up to the scheduler, so the session doesn't retry.
+        self.session = session or utils.HTTPSession(retries=0)
+        self.options = {'publish': publish, 'all': all, 'ignoreMismatch': ignoreMismatch}
+
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+
+        # Until the API tells us otherwise, run one at a time.
+        self.max_assessments = 1
+        self.current_assessments = 0
+        self.cool_off = 0
+
+    def run(self, hosts):
+        waiting = collections.deque(hosts)
+        if not waiting:
+            return
+
+        self.fetch_info()
+
+        # Running assessments, as (time to poll, host) in a heap.
+        running = []
+        intervals = {}
+        failures = collections.Counter()
+        next_start = 0
+
+        while waiting or running:
+            now = time.time()
+
+            # Start as many new assessments as there's room for.
+            while waiting and (now >= next_start) and self.has_room(len(running)):
+                host = waiting.popleft()
+                response = self.analyze(host, new=True)
+                delay = self.delay_for(response, host, failures)
+
+                if delay is not None:
+                    if failures[host] >= self.max_failures:
+                        yield host, self.failed(host, response)
+                    else:
+                        waiting.appendleft(host)
+                        next_start = now + delay
+                    break
+
+                failures[host] = 0
+                next_start = now + self.cool_off
+                results = response.json()
+
+                if self.finished(results):
+                    self.current_assessments = max(self.current_assessments - 1, 0)
+                    yield host, results
+                else:
+                    intervals[host] = self.poll_interval
+                    heapq.heappush(running, (now + intervals[host], host))
+
+            # Poll whatever's due.
+            while running and (running[0][0] <= now):
+                when, host = heapq.heappop(running)
+                response = self.analyze(host)
+                delay = self.delay_for(response, host, failures)
+
+                if delay is not None:
+                    if failures[host] >= self.max_failures:
+                        self.current_assessments = max(self.current_assessments - 1, 0)
+                        yield host, self.failed(host, response)
+                    else:
+                        heapq.heappush(running, (now + delay, host))
+                    continue
+
+                failures[host] = 0
+                results = response.json()
+
+                if self.finished(results):
+                    self.current_assessments = max(self.current_assessments - 1, 0)
+                    yield host, results
+                else:
+                    intervals[host] = min(intervals[host] * 2, self.max_poll_interval)
+                    heapq.heappush(running, (now + intervals[host], host))
+
+            # Sleep until there's something to do.
+            wake = []
+            if running:
+                wake.append(running[0][0])
+            if waiting and self.has_room(len(running)):
+                wake.append(next_start)
+            if wake:
+                time.sleep(max(min(wake) - time.time(), 0))
+            elif waiting:
+                # Nothing of ours is running, but there's no room: our
+                # assessments are in use elsewhere. Check back later.
+                time.sleep(self.poll_interval)
+                self.fetch_info()
+
+    # Read the assessment limits and cool-off from the info endpoint.
+    def fetch_info(self):
+        response = request('info', session=self.session, api=self.api)
+        if (response is None) or (response.status_code != 200):
+            return
+
+        self.read_limits(response)
+        info = response.json()
+        self.max_assessments = int(info.get('maxAssessments', self.max_assessments))
+        self.current_assessments = int(info.get('currentAssessments', self.current_assessments))
+        self.cool_off = info.get('newAssessmentCoolOff', 0) / 1000.0
+
+    def analyze(self, host, new=False):
+        payload = dict(self.options, host=host)
+        if new:
+            payload['startNew'] = 'on'
+
+        response = request('analyze', payload, session=self.session, api=self.api)
+        if response is not None:
+            self.read_limits(response)
+        return response
+
+    def read_limits(self, response):
+        if 'X-Max-Assessments' in response.headers:
+            self.max_assessments = int(response.headers['X-Max-Assessments'])
+        if 'X-Current-Assessments' in response.headers:
+            self.current_assessments = int(response.headers['X-Current-Assessments'])
+
+    # Whether another assessment can start, given how many are running.
+    # The headers can lag behind, so whichever count is higher is used.
+    def has_room(self, running):
+        return max(self.current_assessments, running) < self.max_assessments
+
+    # How long to wait before trying a host again, or None if the
+    # response is a usable one.
+    def delay_for(self, response, host, failures):
+        if (response is not None) and (response.status_code == 200):
+            return None
+
+        failures[host] += 1
+        if response is None:
+            logging.warning("[%s] SSL Labs request failed, backing off." % host)
+        else:
+            logging.warning("[%s] SSL Labs responded with %i, backing off." % (host, response.status_code))
 
-    payload.pop('startNew')
+        return min(self.backoff * (2 ** (failures[host] - 1)), self.max_backoff)
 
-    while results['status'] != 'READY' and results['status'] != 'ERROR':
-        time.sleep(30)
-        results = requestAPI(path, payload)
+    def finished(self, results):
+        return results.get('status') in ('READY', 'ERROR')
 
-    return results
+    def failed(self, host, response):
+        if response is None:
+            message = "Request failed."
+        else:
+            message = "HTTP %i." % response.status_code
+        return {'host': host, 'status': 'ERROR', 'statusMessage': message}
@@ -1,6 +1,14 @@
 import requests
 import json
 
+import threading
+import time
+
+import ssllabsscanner
+import web_design_standards_check
+from fake_ssllabs import FakeSSLLabs
+from fake_server import FakeServer
+
 
 def web_design_standards_utility(domain):
     payload = {"domain":domain}
@@ -32,3 +40,117 @@ def test_web_design_standards_false_true():
 
 # It is hard to find a *.gov that doesn't implement https
 # so it's a hard case to test.
+
+
+def fast_scheduler(api, **options):
+    return ssllabsscanner.Scheduler(
+        api=api, poll_interval=0.01, max_poll_interval=0.05,
+        backoff=0.01, max_backoff=0.05, **options)
+
+
+def test_ssllabs_scheduler_keeps_max_assessments_in_flight():
+    hosts = ["host%i.gov" % i for i in range(10)]
+    with FakeSSLLabs(max_assessments=3, polls=3, errors=["host4.gov"]) as fake:
+        results = dict(fast_scheduler(fake.api).run(hosts))
+
+    assert sorted(results) == sorted(hosts)
+    assert results["host0.gov"]["status"] == "READY"
+    assert results["host4.gov"]["status"] == "ERROR"
+    assert fake.peak == 3
+
+    # one new assessment per host: never turned away with a 429
+    started = [params["host"] for path, params in fake.requests if params.get("startNew") == "on"]
+    assert sorted(started) == sorted(hosts)
+
+
+def test_ssllabs_scheduler_gives_up_after_failures():
+    with FakeSSLLabs() as fake:
+        api = fake.api
+    results = dict(fast_scheduler(api, max_failures=2).run(["gone.gov"]))
+    assert results["gone.gov"]["status"] == "ERROR"
+
+
+uswds_page = b'<html><body><div class="usa-banner"></div></body></html>'
+plain_page = b'<html><body><div class="banner"></div></body></html>'
+
+
+def test_bulk_web_design_standards_checker():
+    # Serves a page that uses USWDS to 127.0.0.1, and one that doesn't
+    # to localhost, over plain HTTP, so that HTTPS fails.
+    def page(request):
+        if request.headers["Host"].startswith("127.0.0.1"):
+            return 200, {}, uswds_page
+        return 200, {}, plain_page
+
+    with FakeServer({"/": page}) as server:
+        port = server.host.split(":")[1]
+        domains = [server.host, "localhost:%s" % port, "127.0.0.1:1"]
+        results = {
+            result.pop("domain"): result
+            for result in web_design_standards_check.bulk_uswds_checker(domains)
+        }
+
+    assert results[domains[0]] == {"uswds": True, "https": False}
+    assert results[domains[1]] == {"uswds": False, "https": False}
+    assert "error" in results[domains[2]]
+
+
+def test_bulk_web_design_standards_checker_queues_without_timing_out():
+    # Every page takes a while, and there are more domains than can be
+    # checked at once, so some wait longer than the timeout to start.
+    lock = threading.Lock()
+    active = [0, 0]  # now, peak
+
+    def slow_page(request):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.5)
+        with lock:
+            active[0] -= 1
+        return 200, {}, uswds_page
+
+    paths = ["/%i" % i for i in range(8)]
+    with FakeServer({path: slow_page for path in paths}) as server:
+        domains = [server.host + path for path in paths]
+        results = list(web_design_standards_check.bulk_uswds_checker(domains, concurrency=2, timeout=1))
+
+    assert sorted(result["domain"] for result in results) == sorted(domains)
+    assert all(result.get("uswds") for result in results), results
+    assert active[1] <= 2
+
+
+def test_web_design_standards_checker_streams(monkeypatch):
+    # The failed HTTPS attempts aren't retried.
+    session = web_design_standards_check.utils.HTTPSession(retries=0)
+    monkeypatch.setattr(web_design_standards_check.utils, "http_session", lambda: session)
+
+    # USWDS turns up early in a big page, which isn't read to the end.
+    big_page = b'<html><body><div class="usa-banner"></div>' + b'<p>filler</p>' * 500000 + b'</body></html>'
+    with FakeServer({"/uswds": big_page, "/plain": plain_page}) as server:
+        assert web_design_standards_check.uswds_checker(server.host + "/uswds") == {"uswds": True, "https": False}
+        assert web_design_standards_check.uswds_checker(server.host + "/plain") == {"uswds": False, "https": False}
+
+
+def test_uswds_detector():
+    def detect(page, chunk=7):
+        detector = web_design_standards_check.UswdsDetector()
+        for i in range(0, len(page), chunk):
+            if detector.feed(page[i:i + chunk]):
+                break
+        return detector.result()
+
+    assert detect(b'<html><body><div class="a usa-banner"></div></body></html>')
+    assert detect(b'<html><body><span class="usa&#45;grid"></span></body></html>')
+    assert not detect(b'<html><body><!-- <div class="usa-x"> --><p class="x"></p></body></html>')
+    assert not detect(b'<html><script>var s = \'<div class="usa-x">\';</script></html>')
+
+    # stops reading at the first match
+    detector = web_design_standards_check.UswdsDetector()
+    assert detector.feed(b'<html><body><div class="usa-banner">')
+    assert detector.result()
+
+    # and doesn't read past the size cap
+    detector = web_design_standards_check.UswdsDetector(max_size=100)
+    assert detector.feed(b'<html><body>' + b'<p>filler</p>' * 10)
+    assert not detector.result()
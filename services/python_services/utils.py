@@ -6,11 +6,14 @@ import sys
 import shutil
 import traceback
 import json
-import urllib
+import threading
 import csv
 import logging
 import datetime
 import strict_rfc3339
+import requests
+import requests.adapters
+import urllib3.util.retry
 
 
 # Wrapper to a run() method to catch exceptions.
@@ -32,8 +35,52 @@ def download(url, destination):
     # make sure path is present
     mkdir_p(os.path.dirname(destination))
 
-    filename, headers = urllib.request.urlretrieve(url, destination)
-    return filename
+    response = http_session().get(url, stream=True)
+    response.raise_for_status()
+    with open(destination, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    return destination
+
+
+# Shared HTTP sessions, copied from domain-scan/scanners/utils.py: change and document them there.
+
+http_local = threading.local()
+
+
+class HTTPSession(requests.Session):
+
+    def __init__(self, timeout=30, retries=3, pool_size=10, backoff=0.5):
+        super(HTTPSession, self).__init__()
+        self.timeout = timeout
+
+        retry = urllib3.util.retry.Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(HTTPSession, self).request(method, url, **kwargs)
+
+
+# This thread's session, set up from the command line options.
+def http_session():
+    session = getattr(http_local, "session", None)
+    if session is None:
+        cli_options = options()
+        session = HTTPSession(
+            timeout=float(cli_options.get("http-timeout", 30)),
+            retries=int(cli_options.get("http-retries", 3)),
+            pool_size=int(cli_options.get("http-pool-size", 10))
+        )
+        http_local.session = session
+    return session
 
 
 # read options from the command line
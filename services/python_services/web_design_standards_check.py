@@ -1,6 +1,16 @@
-import lxml.html
+import asyncio
+
+import aiohttp
+import lxml.etree
 import requests
 
+import utils
+
+# The most of a page that's read, looking for USWDS.
+max_size = 10 * 1024 * 1024
+chunk_size = 64 * 1024
+
+
 # This checks static sites only for now
 # we'll need to use selenium for react sites
 # or javascript
@@ -8,15 +18,142 @@ def uswds_checker(domain):
     https = True
     url = "https://"+domain
     try:
-        response = requests.get(url).text
+        uswds = detect(utils.http_session().get(url, stream=True))
     except requests.exceptions.SSLError:
         https = False
         url = "http://"+domain
-        response = requests.get(url).text
-    html = lxml.html.fromstring(response)
-    if len(html.xpath("//*[contains(@class, 'usa-')]")) > 0:
-        return {"uswds":True, "https":https}
-    else:
-        return {"uswds":False, "https":https}
+        uswds = detect(utils.http_session().get(url, stream=True))
+    return {"uswds": uswds, "https": https}
+
+
+# Read a (streamed) response until USWDS turns up.
+def detect(response):
+    detector = UswdsDetector()
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if detector.feed(chunk):
+                break
+    finally:
+        response.close()
+    return detector.result()
+
+
+class UswdsDetector(object):
+    """
+    Whether a page uses USWDS: whether any element has "usa-" in its
+    class attribute (i.e. //*[contains(@class, 'usa-')]).
+
+    Fed the page a chunk at a time, as it downloads, and parsed with
+    lxml's incremental HTML parser (the same parser lxml.html uses),
+    so there's no need to hold (or download) the whole page: feed()
+    says when to stop, at the first element that matches, or past
+    `max_size` bytes. Elements are thrown away once they're parsed,
+    so only a small window of the document is kept in memory.
+    """
+
+    def __init__(self, max_size=max_size):
+        self.max_size = max_size
+        self.parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+        self.size = 0
+        self.empty = True
+        self.found = False
+        self.done = False
+
+    # Parse another chunk of the page. Returns True once there's no
+    # need to read any more of it.
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.empty and chunk.strip():
+            self.empty = False
+
+        self.parser.feed(chunk)
+        self.read_events()
+
+        self.done = self.found or (self.size >= self.max_size)
+        return self.done
+
+    def read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if "usa-" in (element.get("class") or ""):
+                    self.found = True
+                    return
+            else:
+                element.clear()
+                parent = element.getparent()
+                while (parent is not None) and (element.getprevious() is not None):
+                    del parent[0]
 
+    def result(self):
+        # Like lxml.html.fromstring, there's nothing to say about a
+        # page with nothing in it.
+        if self.empty:
+            raise lxml.etree.ParserError("Document is empty")
 
+        if not self.done:
+            self.parser.close()
+            self.read_events()
+        return self.found
+
+
+# The same check, as a coroutine, over a shared aiohttp session.
+async def uswds_checker_async(session, domain):
+    https = True
+    try:
+        uswds = await detect_async(session, "https://"+domain)
+    except aiohttp.ClientSSLError:
+        https = False
+        uswds = await detect_async(session, "http://"+domain)
+    return {"uswds": uswds, "https": https}
+
+
+async def detect_async(session, url):
+    detector = UswdsDetector()
+    async with session.get(url) as response:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if detector.feed(chunk):
+                break
+    return detector.result()
+
+
+# Check many domains at once, up to `concurrency` at a time. Yields a
+# result for each domain (with the domain in it) as soon as it's done,
+# so results come back in the order they finish. A domain that can't
+# be checked gets an "error" instead.
+#
+# Each check waits its turn on a semaphore, and only then starts its
+# `timeout`, so domains waiting behind others don't time out.
+#
+# This is a plain generator, driving its own event loop, so that it
+# can feed a streaming response.
+def bulk_uswds_checker(domains, concurrency=50, timeout=30):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_session():
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+    async def check(session, domain):
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(uswds_checker_async(session, domain), timeout)
+            except asyncio.TimeoutError:
+                result = {"error": "Timed out after %s seconds" % timeout}
+            except Exception as error:
+                result = {"error": "%s: %s" % (error.__class__.__name__, error)}
+        result["domain"] = domain
+        return result
+
+    session = loop.run_until_complete(open_session())
+    tasks = [loop.create_task(check(session, domain)) for domain in domains]
+
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield loop.run_until_complete(future)
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(session.close())
+        loop.close()